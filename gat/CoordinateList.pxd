@@ -15,3 +15,4 @@ cdef class CoordinateList:
 
     cdef off_t toMMAP(self, void *, int, off_t)
     cdef void fromMMAP(self)
+    cdef void attachMMAP(self, void *, off_t, size_t)
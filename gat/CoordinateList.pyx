@@ -24,3 +24,12 @@ cdef class CoordinateList:
         at *mmap* with *offset*.
         '''
         raise NotImplementedError()
+
+    cdef void attachMMAP(self,
+                         void * mmap,
+                         off_t offset,
+                         size_t n):
+        '''use the *n* elements in shared memory at *mmap*
+        with *offset* as contents of the list.
+        '''
+        raise NotImplementedError()
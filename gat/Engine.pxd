@@ -1,4 +1,5 @@
 from libc.stdio cimport FILE
+from libc.stdint cimport uint64_t
 
 cdef extern from "gat_utils.h":
     long searchsorted(void * base,
@@ -17,9 +18,17 @@ cdef extern from "gat_utils.h":
     int toCompressedFile(unsigned char *, size_t, FILE *)
     int fromCompressedFile(unsigned char *, size_t, FILE *)
 
+    ctypedef struct xoshiro256_state:
+        uint64_t s[4]
+
+    void xoshiro256_seed(xoshiro256_state *, uint64_t) nogil
+    uint64_t xoshiro256_next(xoshiro256_state *) nogil
+    void xoshiro256_fill(xoshiro256_state *, uint64_t *, size_t) nogil
+
 cdef class IntervalContainer:
     cdef int shared_fd     	   
     cdef str shared_fn
+    cdef shared_layout
     cdef intervals
     cdef str name
  
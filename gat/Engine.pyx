@@ -6,6 +6,8 @@ import re
 import os
 import math
 import random
+import zlib
+import hashlib
 
 import gat.IOTools as IOTools
 import gat.Experiment as E
@@ -14,16 +16,18 @@ import gat.Stats
 cimport cython
 from libc.stdio cimport FILE, fopen, fclose, feof
 from libc.stdio cimport fread, fwrite, ftell, fseek, SEEK_SET
-from libc.stdlib cimport realloc, malloc, calloc, free, atol
-from libc.string cimport memcpy, memmove, memchr, strlen
+from libc.stdlib cimport qsort, realloc, malloc, calloc, free, atol
+from libc.stdint cimport uint32_t, int64_t, uint64_t, UINT32_MAX, UINT64_MAX
+from libc.string cimport memcpy, memmove, memchr, memset, strlen
 from libc.math cimport floor
 from libc.errno cimport errno
 from posix.types cimport off_t
 from posix.mman cimport mmap, munmap, shm_open, shm_unlink
-from posix.mman cimport MAP_SHARED, PROT_READ, PROT_WRITE
+from posix.mman cimport MAP_SHARED, MAP_PRIVATE, PROT_READ, PROT_WRITE
 from posix.stat cimport S_IRUSR, S_IWUSR
 from posix.fcntl cimport O_CREAT, O_RDWR, O_RDONLY
-from posix.unistd cimport ftruncate
+from posix.unistd cimport ftruncate, close
+from cpython.bytes cimport PyBytes_AsString, PyBytes_FromStringAndSize
 
 # import SegmentList and PositionList
 from CoordinateList cimport CoordinateList
@@ -31,6 +35,8 @@ from CoordinateList cimport CoordinateList
 cimport SegmentList
 import SegmentList
 from SegmentList cimport SegmentList, PositionDifference, Segment, Position, force_bytes, force_str
+from SegmentList cimport searchEnd, searchStart, gallopEnd, gallopStart, useGallop
+from SegmentList cimport overlapSegmentArrays, intersectSegmentArrays
 
 from PositionList cimport PositionList
 
@@ -116,8 +122,11 @@ cdef int cmpSegmentsStartAndEnd( const_void_ptr s1, const_void_ptr s2 ):
     return <PositionDifference>(<Segment *>s1).end - <PositionDifference>(<Segment *>s2).end
 
 @cython.profile(False)
-cdef int cmpPosition( const_void_ptr s1, const_void_ptr s2 ):
-    return (<Position*>s1)[0] - (<Position*>s2)[0]
+cdef int cmpPosition( const_void_ptr s1, const_void_ptr s2 ) nogil:
+    # avoid overflow of unsigned difference
+    cdef Position a = (<Position*>s1)[0]
+    cdef Position b = (<Position*>s2)[0]
+    return (a > b) - (a < b)
 
 @cython.profile(False)
 cdef int cmpDouble( const_void_ptr s1, const_void_ptr s2 ):
@@ -126,6 +135,192 @@ cdef int cmpDouble( const_void_ptr s1, const_void_ptr s2 ):
     cdef double db = (<double*>s2)[0]
     return (da > db) - (da < db)
 
+############################################################
+############################################################
+############################################################
+## Random number generation
+############################################################
+# number of random numbers generated in one go
+DEF RNG_BUFFER_SIZE = 1024
+
+cdef class RandomNumberGenerator:
+    '''random number generator for the samplers.
+
+    Random numbers are produced by a xoshiro256** generator
+    implemented in C. They are generated in bulk into a buffer,
+    avoiding the overhead of calling into numpy for every random
+    number in the inner loops of the samplers.
+
+    If *seed* is not given, the generator is seeded from numpy's
+    global random number generator. Thus a run with a fixed
+    ``--random-seed`` is reproducible.
+
+    The generator can be switched to independent streams derived
+    from its seed with :meth:`seedStream`.
+
+    If *unreduce* is given, the generator will be re-constituted
+    from a pickled state (see __reduce__).
+    '''
+
+    cdef xoshiro256_state state
+    cdef uint64_t buffer[RNG_BUFFER_SIZE]
+    cdef int buffer_pos
+    cdef object entropy
+
+    def __init__(self, seed=None, unreduce=None):
+        if unreduce:
+            self.setState(unreduce)
+        else:
+            self.seed(seed)
+
+    def __reduce__(self):
+        return (buildRandomNumberGenerator, self.getState())
+
+    def seed(self, seed=None):
+        '''(re-)initialize generator with *seed*.'''
+        if seed is None:
+            seed = numpy.random.randint(0, 2 ** 31)
+        self.entropy = seed
+        xoshiro256_seed(&self.state, <uint64_t>seed)
+        # mark buffer as exhausted
+        self.buffer_pos = RNG_BUFFER_SIZE
+
+    def seedStream(self, *key):
+        '''switch to the independent stream identified by *key*.
+
+        The stream is derived from the seed of the generator and
+        *key* using numpy's SeedSequence. Thus the random numbers
+        for a given key do not depend on how many numbers have been
+        drawn from other streams. Elements of *key* can be integers
+        or strings.
+        '''
+        seed_sequence = buildSeedSequence(self.entropy, key)
+        xoshiro256_seed(&self.state,
+                        seed_sequence.generate_state(1, numpy.uint64)[0])
+        self.buffer_pos = RNG_BUFFER_SIZE
+
+    property entropy:
+        def __get__(self): return self.entropy
+
+    def getState(self):
+        '''return state of generator as a tuple.
+
+        Only unused random numbers in the buffer are saved.
+        '''
+        return (self.entropy,
+                tuple([self.state.s[x] for x in range(4)]),
+                self.buffer_pos,
+                PyBytes_FromStringAndSize(
+                    <char*>&self.buffer[self.buffer_pos],
+                    sizeof(uint64_t) * (RNG_BUFFER_SIZE - self.buffer_pos)))
+
+    def setState(self, state):
+        '''set state of generator from a tuple (see getState).'''
+        cdef int x
+        self.entropy, words, self.buffer_pos, data = state
+        for x in range(4):
+            self.state.s[x] = words[x]
+        memcpy(&self.buffer[self.buffer_pos],
+               PyBytes_AsString(data),
+               sizeof(uint64_t) * (RNG_BUFFER_SIZE - self.buffer_pos))
+
+    cdef inline uint64_t next(self):
+        '''return next 64-bit random number, refilling
+        the buffer if necessary.'''
+        if self.buffer_pos == RNG_BUFFER_SIZE:
+            xoshiro256_fill(&self.state, self.buffer, RNG_BUFFER_SIZE)
+            self.buffer_pos = 0
+        self.buffer_pos += 1
+        return self.buffer[self.buffer_pos - 1]
+
+    cpdef long randint(self, long low, long high) except? -1:
+        '''return a random integer from the half-open
+        interval [*low*, *high*).'''
+        cdef uint64_t r, bound, limit
+        if high <= low:
+            raise ValueError("low >= high: %i >= %i" % (low, high))
+        bound = <uint64_t>(high - low)
+        # reject numbers in the incomplete last block to
+        # avoid modulo bias
+        limit = UINT64_MAX - UINT64_MAX % bound
+        r = self.next()
+        while r >= limit:
+            r = self.next()
+        return low + <long>(r % bound)
+
+    cpdef double random(self) except? -1:
+        '''return a random float from the half-open interval [0, 1).'''
+        # use upper 53 bits
+        return (self.next() >> 11) * (1.0 / 9007199254740992.0)
+
+    def shuffle(self, list values):
+        '''shuffle *values* in-place.'''
+        cdef long i, j
+        for i from len(values) > i > 0:
+            j = self.randint(0, i + 1)
+            values[i], values[j] = values[j], values[i]
+
+
+cdef class NumpyRandomNumberGenerator(RandomNumberGenerator):
+    '''random number generator delegating to numpy's
+    global random number generator.
+
+    This is the method used by previous versions of gat. It is
+    slower than the default generator. Note that it does not
+    reproduce previous results of :class:`SamplerAnnotator`, as
+    the sampler now uses random numbers in a different order.
+
+    :meth:`seedStream` re-seeds numpy's global generator with a
+    stream derived from the seed in the same way as
+    :meth:`RandomNumberGenerator.seedStream`.
+    '''
+
+    def __reduce__(self):
+        return (NumpyRandomNumberGenerator, (self.entropy,))
+
+    def seed(self, seed=None):
+        '''(re-)initialize numpy's global generator with *seed*.
+
+        If *seed* is not given, numpy's global generator is left
+        as is and the seed for streams is taken from it.
+        '''
+        if seed is None:
+            seed = numpy.random.randint(0, 2 ** 31)
+        else:
+            numpy.random.seed(seed)
+        self.entropy = seed
+
+    def seedStream(self, *key):
+        '''switch numpy's global generator to the independent
+        stream identified by *key*.'''
+        numpy.random.seed(
+            buildSeedSequence(self.entropy, key).generate_state(
+                4, numpy.uint32))
+
+    cpdef long randint(self, long low, long high) except? -1:
+        return numpy.random.randint(low, high)
+
+    cpdef double random(self) except? -1:
+        return numpy.random.random_sample()
+
+
+def buildSeedSequence(entropy, key):
+    '''return a numpy SeedSequence for the stream identified by
+    *key* of a generator seeded with *entropy*.
+
+    Elements of *key* can be integers or strings.
+    '''
+    spawn_key = tuple([x if isinstance(x, int)
+                       else zlib.crc32(force_bytes(x))
+                       for x in key])
+    return numpy.random.SeedSequence(entropy, spawn_key=spawn_key)
+
+
+def buildRandomNumberGenerator(*args):
+    '''unpickling - return a rebuilt RandomNumberGenerator object.'''
+    return RandomNumberGenerator(unreduce=args)
+
+
 cdef class SegmentListSamplerSlow:
 
     cdef SegmentList segment_list
@@ -251,31 +446,71 @@ cdef class SegmentListSampler:
     In order to avoid edge effects the position
     of the sample within a workspace segment is
     sampled again.
+
+    The segment containing a random position is looked up
+    with a guide table (Chen & Asau, 1974) over the cumulative
+    segment sizes. The guide table divides the workspace into
+    *nsegments* intervals of equal size and stores the first
+    segment reaching into each interval, so that a lookup takes
+    expected constant time.
+
+    Random numbers are taken from *rng*. If not given,
+    a new :class:`RandomNumberGenerator` will be created.
     '''
 
     cdef SegmentList segment_list
     cdef Position * cdf
+    cdef Position * guide
     cdef Position total_size
     cdef int nsegments
+    cdef RandomNumberGenerator rng
 
-    def __init__(self, SegmentList segment_list ):
-        cdef Position i, totsize
+    def __init__(self,
+                 SegmentList segment_list,
+                 RandomNumberGenerator rng=None):
+        cdef Position i, k
+        cdef uint64_t lower
+        self.cdf = NULL
+        self.guide = NULL
         assert len(segment_list) > 0, "sampling from empty segment list"
         assert segment_list.isNormalized
 
+        if rng is None:
+            rng = RandomNumberGenerator()
+        self.rng = rng
         self.segment_list = segment_list
         self.nsegments = len(segment_list)
         self.cdf = <Position*>malloc( sizeof(Position) * self.nsegments )
-        if not self.cdf:
+        self.guide = <Position*>malloc( sizeof(Position) * self.nsegments )
+        if not self.cdf or not self.guide:
             raise MemoryError(
                 "out of memory when allocation %i bytes" %
-                sizeof(sizeof(Position) * self.nsegments))
+                (2 * sizeof(Position) * self.nsegments))
         self.total_size = 0
         for i from 0 <= i < len(segment_list):
             self.total_size += segment_length( segment_list.segments[i] )
-            # -1, as searchsorted inserts on left
+            # -1, to find the first segment with cdf >= position
             self.cdf[i] = self.total_size -1
 
+        assert self.total_size > 0, "sampling from empty workspace"
+
+        # guide[k] is the first segment containing a position in the
+        # k-th interval [ceil(k * total / n), ceil((k+1) * total / n))
+        i = 0
+        for k from 0 <= k < self.nsegments:
+            lower = (<uint64_t>k * self.total_size + self.nsegments - 1) // self.nsegments
+            while i < self.nsegments - 1 and self.cdf[i] < lower:
+                i += 1
+            self.guide[k] = i
+
+    cdef inline Position lookup(self, Position pos):
+        '''return index of segment containing position *pos*.'''
+        cdef Position i = self.guide[
+            <uint64_t>pos * self.nsegments // self.total_size]
+        while self.cdf[i] < pos:
+            i += 1
+        return i
+
     cpdef sample( self, Position sample_length ):
         '''return a sampled segment of size sample_length.
 
@@ -284,9 +519,6 @@ cdef class SegmentListSampler:
         if it extends beyond a workspace boundary.
         '''
 
-        # note: could be made quicker by
-        # - creating a sample random integers once, see numpy.random_integers?
-        # - avoiding the binary search?
         cdef Position start, end
         cdef PositionDifference overlap
         cdef size_t segment_index
@@ -295,14 +527,8 @@ cdef class SegmentListSampler:
         cdef Position random_pos_in_workspace
         cdef long random_pos_in_segment, sampling_start
         # sample a position 
-        # r = rand() / (RAND_MAX / total_size + 1)
-        random_pos_in_workspace = numpy.random.randint(0, self.total_size)
-        segment_index = searchsorted( self.cdf,
-                                      self.nsegments,
-                                      sizeof(Position),
-                                      &random_pos_in_workspace,
-                                      &cmpPosition,
-                                      )
+        random_pos_in_workspace = self.rng.randint(0, self.total_size)
+        segment_index = self.lookup(random_pos_in_workspace)
 
         assert 0 <= segment_index < self.nsegments, \
             "range error for %i: %i >= %i" % (random_pos_in_workspace, segment_index, self.nsegments)
@@ -323,9 +549,8 @@ cdef class SegmentListSampler:
         if segment_index > 0:
             sampling_start = lmax( self.segment_list.segments[segment_index-1].end,
                                    sampling_start)
-        random_pos_in_segment = numpy.random.randint( \
-            sampling_start,
-            chosen_segment.end )
+        random_pos_in_segment = self.rng.randint(sampling_start,
+                                                 chosen_segment.end)
 
         # adjust position by sampled amount
         # adjust start position to negative coordinate
@@ -351,6 +576,9 @@ cdef class SegmentListSampler:
         if self.cdf != NULL:
             free(self.cdf)
             self.cdf = NULL
+        if self.guide != NULL:
+            free(self.guide)
+            self.guide = NULL
 
 cdef class HistogramSamplerSlow:
 
@@ -384,7 +612,81 @@ cdef class HistogramSamplerSlow:
 
         return base
 
-cdef class HistogramSampler:
+cdef class LengthSampler:
+    '''base class for samplers of segment lengths.'''
+
+    cdef RandomNumberGenerator rng
+
+    cpdef Position sample(self):
+        '''return a new segment length.'''
+        raise NotImplementedError("sample not implemented")
+
+cdef class EmpiricalLengthSampler(LengthSampler):
+    '''sample a segment length from the lengths of
+    segments in *segment_list*.
+
+    The observed lengths are kept in a sorted array and each
+    draw picks one uniformly at random. Sampling is exact for
+    any range of lengths and memory use is proportional to the
+    number of segments. Empty segments are ignored.
+
+    Random numbers are taken from *rng*. If not given,
+    a new :class:`RandomNumberGenerator` will be created.
+    '''
+
+    cdef Position * lengths
+    cdef Position nlengths
+
+    def __init__(self,
+                 SegmentList segment_list,
+                 RandomNumberGenerator rng=None):
+        cdef Position i, l
+        self.lengths = NULL
+
+        if rng is None:
+            rng = RandomNumberGenerator()
+        self.rng = rng
+
+        assert len(segment_list) > 0, "sampling from empty segment list"
+
+        self.lengths = <Position*>malloc(sizeof(Position) * segment_list.nsegments)
+        if not self.lengths:
+            raise MemoryError(
+                "out of memory when allocation %i bytes" %
+                (sizeof(Position) * segment_list.nsegments))
+
+        self.nlengths = 0
+        for i from 0 <= i < segment_list.nsegments:
+            l = segment_length(segment_list.segments[i])
+            if l > 0:
+                self.lengths[self.nlengths] = l
+                self.nlengths += 1
+
+        assert self.nlengths > 0, "sampling from empty segments"
+        qsort(<void*>self.lengths,
+              self.nlengths,
+              sizeof(Position),
+              &cmpPosition)
+
+    cpdef Position sample(self):
+        '''return a new segment length.'''
+        return self.lengths[self.rng.randint(0, self.nlengths)]
+
+    def __len__(self):
+        return self.nlengths
+
+    def __dealloc__(self):
+        if self.lengths != NULL:
+            free(self.lengths)
+            self.lengths = NULL
+
+cdef class HistogramSampler(LengthSampler):
+    '''sample a value from a histogram with buckets of size
+    *bucket_size*.
+
+    Random numbers are taken from *rng*. If not given,
+    a new :class:`RandomNumberGenerator` will be created.
+    '''
 
     cdef Position * cdf
     cdef Position bucket_size
@@ -394,10 +696,15 @@ cdef class HistogramSampler:
     @cython.boundscheck(False)
     def __init__(self,
                  numpy.ndarray[DTYPE_INT_t, ndim=1] histogram,
-                 Position bucket_size ):
+                 Position bucket_size,
+                 RandomNumberGenerator rng=None):
         cdef Position i
         self.cdf = NULL
 
+        if rng is None:
+            rng = RandomNumberGenerator()
+        self.rng = rng
+
         self.nbuckets = len(histogram)
         assert self.nbuckets > 0, "sampling from empty histogram"
 
@@ -417,7 +724,7 @@ cdef class HistogramSampler:
 
         # 1 to avoid 0 length
         if self.total_size > 1:
-            r = numpy.random.randint( 1, self.total_size )
+            r = self.rng.randint(1, self.total_size)
         else:
             r = 1
 
@@ -430,7 +737,7 @@ cdef class HistogramSampler:
         base = index * self.bucket_size
 
         if self.bucket_size > 1 :
-            return base + numpy.random.randint(0, self.bucket_size)
+            return base + self.rng.randint(0, self.bucket_size)
 
         return base
 
@@ -439,8 +746,806 @@ cdef class HistogramSampler:
             free(self.cdf)
             self.cdf = NULL
 
+cdef Position getRandomPosition(SegmentList segment_list,
+                                RandomNumberGenerator rng) except? 0:
+    '''return a random position within *segment_list*.
+
+    See :meth:`SegmentList.getRandomPosition`.
+    '''
+    cdef Position pos = rng.randint(0, segment_list.sum())
+    cdef int idx
+    cdef Position l
+    for idx from 0 <= idx < segment_list.nsegments:
+        l = segment_length(segment_list.segments[idx])
+        if pos > l:
+            pos -= l
+        else:
+            return segment_list.segments[idx].start + pos
+    assert False
+
+cdef Position getRandomPositionInArray(Segment * segments,
+                                       Py_ssize_t nsegments,
+                                       Position total,
+                                       RandomNumberGenerator rng) except? 0:
+    '''return a random position within the first *nsegments*
+    of *segments* covering *total* bases.
+
+    See :func:`getRandomPosition`.
+    '''
+    cdef Position pos = rng.randint(0, total)
+    cdef Py_ssize_t idx
+    cdef Position l
+    for idx from 0 <= idx < nsegments:
+        l = segment_length(segments[idx])
+        if pos > l:
+            pos -= l
+        else:
+            return segments[idx].start + pos
+    assert False
+
+cdef int fillFromStart(SegmentList result,
+                       Segment * segments,
+                       Py_ssize_t nsegments,
+                       Position total,
+                       Position start,
+                       PositionDifference remainder) except -1:
+    '''add segments to *result* filling *segments* from *start*
+    until *remainder* bases have been covered.
+
+    Filling wraps around at the end. If *remainder* is larger
+    than *total*, all of *segments* are added.
+
+    See :meth:`SegmentList.getFilledSegmentsFromStart`.
+    '''
+    cdef Py_ssize_t idx
+    cdef Position end
+
+    if remainder > total:
+        for idx from 0 <= idx < nsegments:
+            result._add(segments[idx])
+        return 0
+
+    idx = 0
+    while idx < nsegments and segments[idx].end <= start:
+        idx += 1
+    if idx == nsegments:
+        idx = 0
+        start = segments[idx].start
+
+    while remainder > 0:
+        start = lmax(segments[idx].start, start)
+        end = lmin(segments[idx].end, start + remainder)
+        remainder -= end - start
+        result._add(Segment(start, end))
+        idx += 1
+        if idx == nsegments:
+            idx = 0
+            start = segments[idx].start
+    return 0
+
+cdef int fillFromEnd(SegmentList result,
+                     Segment * segments,
+                     Py_ssize_t nsegments,
+                     Position total,
+                     Position end,
+                     PositionDifference remainder) except -1:
+    '''add segments to *result* filling *segments* backwards from
+    *end* until *remainder* bases have been covered.
+
+    Filling wraps around at the start. If *remainder* is larger
+    than *total*, all of *segments* are added.
+
+    See :meth:`SegmentList.getFilledSegmentsFromEnd`.
+    '''
+    cdef Py_ssize_t idx
+    cdef Position start
+
+    if remainder > total:
+        for idx from 0 <= idx < nsegments:
+            result._add(segments[idx])
+        return 0
+
+    idx = nsegments - 1
+    while idx >= 0 and segments[idx].start >= end:
+        idx -= 1
+    if idx < 0:
+        idx = nsegments - 1
+        end = segments[idx].end
+
+    while remainder > 0:
+        end = lmin(segments[idx].end, end)
+        start = lmax(segments[idx].start, end - remainder)
+        remainder -= end - start
+        result._add(Segment(start, end))
+        idx -= 1
+        if idx < 0:
+            idx = nsegments - 1
+            end = segments[idx].end
+    return 0
+
+cdef struct CoverageNode:
+    Position start
+    Position end
+    int left
+    int right
+    uint32_t priority
+
+cdef void splitCoverage(CoverageNode * nodes,
+                        int t,
+                        Position key,
+                        int * left,
+                        int * right) nogil:
+    '''split treap *t* into nodes with start < *key* and
+    start >= *key*.'''
+    if t < 0:
+        left[0] = -1
+        right[0] = -1
+    elif nodes[t].start < key:
+        splitCoverage(nodes, nodes[t].right, key, &nodes[t].right, right)
+        left[0] = t
+    else:
+        splitCoverage(nodes, nodes[t].left, key, left, &nodes[t].left)
+        right[0] = t
+
+cdef int mergeCoverage(CoverageNode * nodes, int a, int b) nogil:
+    '''merge treaps *a* and *b*. All nodes in *a* need
+    to be before those in *b*.'''
+    if a < 0:
+        return b
+    if b < 0:
+        return a
+    if nodes[a].priority > nodes[b].priority:
+        nodes[a].right = mergeCoverage(nodes, nodes[a].right, b)
+        return a
+    else:
+        nodes[b].left = mergeCoverage(nodes, a, nodes[b].left)
+        return b
+
+cdef class WorkspaceCoverage:
+    '''incrementally updated union of segments placed
+    into a workspace.
+
+    Placed segments are kept as disjoint segments in a
+    treap (a randomized binary search tree) ordered by start
+    coordinate. Overlapping and adjacent segments are merged on
+    insertion, which takes expected O(log n) time. The number of
+    nucleotides in the union (:attr:`total`) and the number of
+    those nucleotides within *workspace* (:attr:`covered`) are
+    known at all times.
+    '''
+
+    cdef SegmentList workspace
+    cdef CoverageNode * nodes
+    cdef int root
+    cdef int nnodes
+    cdef int allocated
+    cdef int free_node
+    cdef int nsegments
+    cdef uint32_t priority_state
+    cdef int * buffer
+    cdef int buffer_size
+    cdef Position total
+    cdef PositionDifference covered
+
+    def __init__(self, SegmentList workspace, int allocate=1000):
+        assert workspace.isNormalized, "workspace is not normalized"
+        self.nodes = NULL
+        self.buffer = NULL
+        self.workspace = workspace
+        self.allocated = max(allocate, 1)
+        self.nodes = <CoverageNode*>malloc(self.allocated * sizeof(CoverageNode))
+        self.buffer = <int*>malloc(self.allocated * sizeof(int))
+        if not self.nodes or not self.buffer:
+            raise MemoryError(
+                "out of memory when allocation %i bytes" %
+                (self.allocated * (sizeof(CoverageNode) + sizeof(int))))
+        self.buffer_size = 0
+        # fixed seed - priorities only determine the tree shape
+        self.priority_state = 2463534242
+        self.clear()
+
+    cdef clear(self):
+        '''remove all segments.'''
+        self.root = -1
+        self.nnodes = 0
+        self.free_node = -1
+        self.nsegments = 0
+        self.total = 0
+        self.covered = 0
+
+    cdef int newNode(self, Position start, Position end) except -1:
+        '''return index of a new node for segment *start*-*end*.'''
+        cdef int idx
+        if self.free_node >= 0:
+            idx = self.free_node
+            self.free_node = self.nodes[idx].left
+        else:
+            if self.nnodes == self.allocated:
+                self.allocated *= 2
+                self.nodes = <CoverageNode*>realloc(
+                    self.nodes, self.allocated * sizeof(CoverageNode))
+                self.buffer = <int*>realloc(
+                    self.buffer, self.allocated * sizeof(int))
+                if not self.nodes or not self.buffer:
+                    raise MemoryError(
+                        "out of memory when allocation %i bytes" %
+                        (self.allocated * (sizeof(CoverageNode) + sizeof(int))))
+            idx = self.nnodes
+            self.nnodes += 1
+
+        # xorshift32
+        self.priority_state ^= self.priority_state << 13
+        self.priority_state ^= self.priority_state >> 17
+        self.priority_state ^= self.priority_state << 5
+
+        self.nodes[idx] = CoverageNode(start, end, -1, -1, self.priority_state)
+        self.nsegments += 1
+        return idx
+
+    cdef void freeNode(self, int idx):
+        self.nodes[idx].left = self.free_node
+        self.free_node = idx
+        self.nsegments -= 1
+
+    cdef void collect(self, int t):
+        '''append nodes in treap *t* to buffer in order.'''
+        if t < 0:
+            return
+        self.collect(self.nodes[t].left)
+        self.buffer[self.buffer_size] = t
+        self.buffer_size += 1
+        self.collect(self.nodes[t].right)
+
+    cpdef PositionDifference add(self, Position start, Position end) except? -1:
+        '''add segment *start*-*end* to the union.
+
+        returns the number of nucleotides within the workspace that
+        have been newly covered.
+        '''
+        cdef int left, middle, right, previous, idx, x
+        cdef Position cursor
+        cdef PositionDifference gain = 0
+        cdef Segment merged
+        cdef CoverageNode s
+
+        if start >= end:
+            return 0
+
+        # allocate first, nodes might move
+        x = self.newNode(start, end)
+
+        # segments starting before start
+        splitCoverage(self.nodes, self.root, start, &left, &right)
+        # segments starting within or adjacent to new segment
+        splitCoverage(self.nodes, right, end + 1, &middle, &right)
+
+        # last segment starting before start - merge if adjacent
+        # or overlapping
+        previous = left
+        if previous >= 0:
+            while self.nodes[previous].right >= 0:
+                previous = self.nodes[previous].right
+            if self.nodes[previous].end >= start:
+                splitCoverage(self.nodes, left,
+                              self.nodes[previous].start,
+                              &left, &previous)
+            else:
+                previous = -1
+
+        self.buffer_size = 0
+        self.collect(previous)
+        self.collect(middle)
+
+        # count gaps filled by the new segment
+        merged = Segment(start, end)
+        cursor = start
+        for idx from 0 <= idx < self.buffer_size:
+            s = self.nodes[self.buffer[idx]]
+            if s.start > cursor:
+                gain += self.workspace.overlap(Segment(cursor, s.start))
+                self.total += s.start - cursor
+            cursor = max(cursor, s.end)
+            merged.start = min(merged.start, s.start)
+            merged.end = max(merged.end, s.end)
+            self.freeNode(self.buffer[idx])
+
+        if cursor < end:
+            gain += self.workspace.overlap(Segment(cursor, end))
+            self.total += end - cursor
+
+        self.nodes[x].start = merged.start
+        self.nodes[x].end = merged.end
+        self.root = mergeCoverage(self.nodes,
+                                  mergeCoverage(self.nodes, left, x),
+                                  right)
+
+        self.covered += gain
+        return gain
+
+    cdef Position getRandomPosition(self, RandomNumberGenerator rng) except? 0:
+        '''return a random position within the union.'''
+        cdef Position pos = rng.randint(0, self.total)
+        cdef int idx
+        cdef Position l
+        self.buffer_size = 0
+        self.collect(self.root)
+        for idx from 0 <= idx < self.buffer_size:
+            l = self.nodes[self.buffer[idx]].end - self.nodes[self.buffer[idx]].start
+            if pos >= l:
+                pos -= l
+            else:
+                return self.nodes[self.buffer[idx]].start + pos
+        assert False
+
+    cpdef PositionDifference trim_ends(self,
+                                       Position pos,
+                                       Position size,
+                                       int forward) except? -1:
+        '''remove *size* nucleotides starting from the segment
+        that includes *pos*.
+
+        The flag *forward* gives the direction. See
+        :meth:`SegmentList.trim_ends`.
+
+        returns the number of nucleotides within the workspace
+        that have been removed.
+        '''
+        cdef SegmentList segments = self.asSegmentList()
+        cdef PositionDifference covered = self.covered
+        cdef int idx
+
+        segments.trim_ends(pos, size, forward)
+        segments.merge(0)
+
+        self.clear()
+        for idx from 0 <= idx < segments.nsegments:
+            self.add(segments.segments[idx].start, segments.segments[idx].end)
+
+        return covered - self.covered
+
+    cpdef SegmentList asSegmentList(self):
+        '''return union as a normalized :class:`SegmentList`.'''
+        cdef int idx
+        cdef SegmentList result = SegmentList(allocate=self.nsegments)
+        self.buffer_size = 0
+        self.collect(self.root)
+        for idx from 0 <= idx < self.buffer_size:
+            result._add(Segment(self.nodes[self.buffer[idx]].start,
+                                self.nodes[self.buffer[idx]].end))
+        result.flag = 1
+        return result
+
+    property total:
+        def __get__(self): return self.total
+
+    property covered:
+        def __get__(self): return self.covered
+
+    def __len__(self):
+        return self.nsegments
+
+    def __dealloc__(self):
+        if self.nodes != NULL:
+            free(self.nodes)
+            self.nodes = NULL
+        if self.buffer != NULL:
+            free(self.buffer)
+            self.buffer = NULL
+
+
+cdef struct GapNode:
+    Position start
+    Position length
+    int left
+    int right
+    uint32_t priority
+    int count
+    uint64_t total
+
+cdef inline void updateGap(GapNode * nodes, int t) nogil:
+    '''update subtree aggregates of node *t*.'''
+    nodes[t].count = 1
+    nodes[t].total = nodes[t].length
+    if nodes[t].left >= 0:
+        nodes[t].count += nodes[nodes[t].left].count
+        nodes[t].total += nodes[nodes[t].left].total
+    if nodes[t].right >= 0:
+        nodes[t].count += nodes[nodes[t].right].count
+        nodes[t].total += nodes[nodes[t].right].total
+
+cdef void splitGaps(GapNode * nodes,
+                    int t,
+                    Position length,
+                    Position start,
+                    int * left,
+                    int * right) nogil:
+    '''split treap *t* into gaps ordered before (*length*, *start*)
+    and the rest.'''
+    if t < 0:
+        left[0] = -1
+        right[0] = -1
+    elif nodes[t].length < length or \
+            (nodes[t].length == length and nodes[t].start < start):
+        splitGaps(nodes, nodes[t].right, length, start, &nodes[t].right, right)
+        updateGap(nodes, t)
+        left[0] = t
+    else:
+        splitGaps(nodes, nodes[t].left, length, start, left, &nodes[t].left)
+        updateGap(nodes, t)
+        right[0] = t
+
+cdef int mergeGaps(GapNode * nodes, int a, int b) nogil:
+    '''merge treaps *a* and *b*. All gaps in *a* need
+    to be ordered before those in *b*.'''
+    if a < 0:
+        return b
+    if b < 0:
+        return a
+    if nodes[a].priority > nodes[b].priority:
+        nodes[a].right = mergeGaps(nodes, nodes[a].right, b)
+        updateGap(nodes, a)
+        return a
+    else:
+        nodes[b].left = mergeGaps(nodes, a, nodes[b].left)
+        updateGap(nodes, b)
+        return b
+
+cdef class FreeGapIndex:
+    '''index of the free gaps in a workspace.
+
+    Gaps are kept in a treap ordered by length. Each node stores
+    the number of gaps and their total length in its subtree, so
+    that the number of positions at which a segment of a certain
+    length fits into a gap can be computed in O(log n) and a
+    position drawn uniformly from them.
+
+    Initially, the gaps are the segments in *workspace*. Placing
+    a segment splits the gap it was placed into.
+    '''
+
+    cdef GapNode * nodes
+    cdef int root
+    cdef int nnodes
+    cdef int allocated
+    cdef int free_node
+    cdef uint32_t priority_state
+
+    def __init__(self, SegmentList workspace):
+        cdef int idx
+        assert workspace.isNormalized, "workspace is not normalized"
+        self.nodes = NULL
+        self.allocated = max(2 * len(workspace), 1)
+        self.nodes = <GapNode*>malloc(self.allocated * sizeof(GapNode))
+        if not self.nodes:
+            raise MemoryError(
+                "out of memory when allocation %i bytes" %
+                (self.allocated * sizeof(GapNode)))
+        self.root = -1
+        self.nnodes = 0
+        self.free_node = -1
+        # fixed seed - priorities only determine the tree shape
+        self.priority_state = 2463534242
+        for idx from 0 <= idx < workspace.nsegments:
+            self.addGap(workspace.segments[idx].start,
+                        segment_length(workspace.segments[idx]))
+
+    cdef int addGap(self, Position start, Position length) except -1:
+        '''add a gap of *length* at *start*.'''
+        cdef int idx, left, right
+        if length == 0:
+            return 0
+        if self.free_node >= 0:
+            idx = self.free_node
+            self.free_node = self.nodes[idx].left
+        else:
+            if self.nnodes == self.allocated:
+                self.allocated *= 2
+                self.nodes = <GapNode*>realloc(
+                    self.nodes, self.allocated * sizeof(GapNode))
+                if not self.nodes:
+                    raise MemoryError(
+                        "out of memory when allocation %i bytes" %
+                        (self.allocated * sizeof(GapNode)))
+            idx = self.nnodes
+            self.nnodes += 1
+
+        # xorshift32
+        self.priority_state ^= self.priority_state << 13
+        self.priority_state ^= self.priority_state >> 17
+        self.priority_state ^= self.priority_state << 5
+
+        self.nodes[idx] = GapNode(start, length, -1, -1,
+                                  self.priority_state, 1, length)
+        splitGaps(self.nodes, self.root, length, start, &left, &right)
+        self.root = mergeGaps(self.nodes,
+                              mergeGaps(self.nodes, left, idx),
+                              right)
+        return 0
+
+    cpdef uint64_t weight(self, Position length):
+        '''return number of positions at which a segment of
+        *length* can be placed.'''
+        assert length > 0, "weight of segment of length 0"
+        return self.weight_of(self.root, length)
+
+    cpdef Position place(self,
+                         Position length,
+                         RandomNumberGenerator rng) except? 0:
+        '''place a segment of *length* at a random free position.
+
+        All positions at which the segment fits into a gap are
+        equally likely. The gap is split by the placed segment.
+
+        returns the start of the placed segment.
+        '''
+        cdef uint64_t w = self.weight(length)
+        cdef uint64_t u, wl
+        cdef int t, left, middle, right
+        cdef Position start, gap_start, gap_length
+
+        if w == 0:
+            raise ValueError("no gap for segment of length %i" % length)
+
+        u = <uint64_t>rng.randint(0, w)
+
+        # find gap containing u-th position
+        t = self.root
+        while True:
+            if self.nodes[t].length < length:
+                t = self.nodes[t].right
+                continue
+            wl = 0
+            if self.nodes[t].left >= 0:
+                # only gaps of at least length contribute
+                wl = self.weight_of(self.nodes[t].left, length)
+            if u < wl:
+                t = self.nodes[t].left
+                continue
+            u -= wl
+            if u < self.nodes[t].length - length + 1:
+                break
+            u -= self.nodes[t].length - length + 1
+            t = self.nodes[t].right
+
+        gap_start = self.nodes[t].start
+        gap_length = self.nodes[t].length
+        start = gap_start + <Position>u
+
+        # remove gap and add remaining parts
+        splitGaps(self.nodes, self.root, gap_length, gap_start,
+                  &left, &right)
+        splitGaps(self.nodes, right, gap_length, gap_start + 1,
+                  &middle, &right)
+        self.nodes[middle].left = self.free_node
+        self.free_node = middle
+        self.root = mergeGaps(self.nodes, left, right)
+
+        self.addGap(gap_start, start - gap_start)
+        self.addGap(start + length, gap_start + gap_length - start - length)
+        return start
+
+    cdef uint64_t weight_of(self, int t, Position length):
+        '''return number of positions for *length* in subtree *t*.'''
+        # sum over all gaps of at least length
+        cdef uint64_t count = 0
+        cdef uint64_t total = 0
+        while t >= 0:
+            if self.nodes[t].length < length:
+                t = self.nodes[t].right
+            else:
+                count += 1
+                total += self.nodes[t].length
+                if self.nodes[t].right >= 0:
+                    count += self.nodes[self.nodes[t].right].count
+                    total += self.nodes[self.nodes[t].right].total
+                t = self.nodes[t].left
+        return total - count * (length - 1)
+
+    def __len__(self):
+        if self.root < 0:
+            return 0
+        return self.nodes[self.root].count
+
+    def __dealloc__(self):
+        if self.nodes != NULL:
+            free(self.nodes)
+            self.nodes = NULL
+
+
+cdef int shufflePositions(Position * values,
+                          Py_ssize_t n,
+                          RandomNumberGenerator rng) except -1:
+    '''shuffle *n* *values* in-place.
+
+    Random numbers are drawn in the same order as in
+    :meth:`RandomNumberGenerator.shuffle`.
+    '''
+    cdef Py_ssize_t i, j
+    cdef Position tmp
+    for i from n > i > 0:
+        j = rng.randint(0, i + 1)
+        tmp = values[i]
+        values[i] = values[j]
+        values[j] = tmp
+    return 0
+
+cdef int samplePoints(Position * points,
+                      Py_ssize_t n,
+                      Position high,
+                      RandomNumberGenerator rng) except -1:
+    '''fill *points* with *n* sorted random positions
+    from the closed interval [0, *high*].
+
+    As the points are uniformly distributed, they are sorted
+    by distributing them into *n* buckets followed by an
+    insertion sort in expected linear time.
+    '''
+    cdef Py_ssize_t i, j, bucket
+    cdef Position value
+    cdef uint64_t range_size = <uint64_t>high + 1
+    cdef Position * values = <Position*>malloc(sizeof(Position) * n)
+    cdef Py_ssize_t * offsets = <Py_ssize_t*>calloc(n + 1, sizeof(Py_ssize_t))
+    if not values or not offsets:
+        free(values)
+        free(offsets)
+        raise MemoryError(
+            "out of memory when allocation %i bytes" %
+            ((sizeof(Position) + sizeof(Py_ssize_t)) * n))
+
+    for i from 0 <= i < n:
+        values[i] = rng.randint(0, range_size)
+        offsets[<uint64_t>values[i] * n // range_size + 1] += 1
+
+    for i from 0 < i <= n:
+        offsets[i] += offsets[i - 1]
+
+    for i from 0 <= i < n:
+        bucket = <uint64_t>values[i] * n // range_size
+        points[offsets[bucket]] = values[i]
+        offsets[bucket] += 1
+
+    # points are in the correct bucket, sort within buckets
+    for i from 1 <= i < n:
+        value = points[i]
+        j = i - 1
+        while j >= 0 and points[j] > value:
+            points[j + 1] = points[j]
+            j -= 1
+        points[j + 1] = value
+
+    free(values)
+    free(offsets)
+    return 0
+
+
+cdef class SamplerSetup:
+    '''pre-computed data for sampling segments from a
+    length distribution into a workspace.
+
+    The set up depends only on *segments* and *workspace*
+    and is shared between all samples of the same pair.
+
+    *working_segments* are the segments overlapping the workspace,
+    *ltotal* is the number of nucleotides in segments overlapping
+    the workspace. *length_sampler* samples from the segment
+    length distribution and *workspace_sampler* places segments
+    into the workspace. Both are None if no segment overlaps the
+    workspace.
+
+    If *nbuckets* is 0, lengths are sampled exactly from the
+    observed segment lengths (see :class:`EmpiricalLengthSampler`).
+    Otherwise, they are sampled from a histogram with *nbuckets*
+    bins of size *bucket_size* (see :class:`HistogramSampler`).
+    '''
+
+    cdef SegmentList segments
+    cdef SegmentList workspace
+    cdef SegmentList working_segments
+    cdef PositionDifference ltotal
+    cdef LengthSampler length_sampler
+    cdef SegmentListSampler workspace_sampler
+
+    def __init__(self,
+                 SegmentList segments,
+                 SegmentList workspace,
+                 Position bucket_size,
+                 Position nbuckets,
+                 RandomNumberGenerator rng):
+
+        cdef SegmentList tmp_segments
+
+        self.segments = segments
+        self.workspace = workspace
+
+        # collect all segments in workspace
+        self.working_segments = segments.clone()
+        self.working_segments.filter(workspace)
+        if len(self.working_segments) == 0:
+            self.ltotal = 0
+            return
+
+        # get nucleotides that need to be sampled
+        # only count overlap within workspace
+        tmp_segments = self.working_segments.clone()
+        tmp_segments.intersect(workspace)
+        self.ltotal = tmp_segments.sum()
+
+        # set up segment length sampler
+        if nbuckets == 0:
+            self.length_sampler = EmpiricalLengthSampler(
+                self.working_segments, rng)
+        else:
+            histogram, bucket_size = self.working_segments.getLengthDistribution(
+                bucket_size,
+                nbuckets)
+            self.length_sampler = HistogramSampler(histogram, bucket_size, rng)
+
+        # set up segment sampler
+        self.workspace_sampler = SegmentListSampler(workspace, rng)
+
+
 cdef class Sampler:
-    pass
+    '''base class for samplers.
+
+    Random numbers are taken from a :class:`RandomNumberGenerator`
+    that can be set with :meth:`setRandomNumberGenerator`. If none
+    has been set, a new generator will be created on first use.
+
+    Samplers cache their set up for each pair of segments and
+    workspace, see :meth:`getSetup`. The cache assumes that
+    segment lists are not modified while they are being sampled
+    from. Use :meth:`clearCache` to release it.
+    '''
+
+    cdef RandomNumberGenerator rng
+    cdef dict setups
+
+    def setRandomNumberGenerator(self, RandomNumberGenerator rng):
+        '''set the random number generator to use.'''
+        self.rng = rng
+        self.clearCache()
+
+    def clearCache(self):
+        '''remove all cached sampler set ups.'''
+        self.setups = None
+
+    cdef SamplerSetup getSetup(self,
+                               SegmentList segments,
+                               SegmentList workspace,
+                               Position bucket_size,
+                               Position nbuckets):
+        '''return the set up for sampling *segments* into *workspace*.
+
+        The set up is computed on first use and cached. Segment lists
+        are matched by identity, the cached set up keeps references
+        to them.
+        '''
+        cdef SamplerSetup setup
+        if self.setups is None:
+            self.setups = {}
+        key = (id(segments), id(workspace))
+        setup = self.setups.get(key, None)
+        if setup is None:
+            setup = SamplerSetup(segments, workspace,
+                                 bucket_size, nbuckets,
+                                 self.getRNG())
+            self.setups[key] = setup
+        return setup
+
+    def getRandomNumberGenerator(self):
+        '''return the random number generator in use.'''
+        return self.getRNG()
+
+    cdef RandomNumberGenerator getRNG(self):
+        # created lazily so that constructing a sampler
+        # does not advance numpy's global random state
+        if self.rng is None:
+            self.rng = RandomNumberGenerator()
+        return self.rng
+
+    def __setstate__(self, state):
+        '''unpickling - restore random number generator.'''
+        self.rng = state
 
 cdef class SamplerAnnotator(Sampler):
     '''
@@ -456,10 +1561,10 @@ cdef class SamplerAnnotator(Sampler):
     or after sampling. The truncation can happen before and/or after
     the algorithm finishes.
 
-    The sampling algorithm avoids checking for segment overlap until
-    the number of nucleotides sampled reaches the expected count.
-    Then, overlapping and adjacent segments are merged and the actual
-    number of nucleotides overlapping the workspace computed.
+    Sampled segments are added to a :class:`WorkspaceCoverage`
+    that merges overlapping and adjacent segments on insertion
+    and keeps track of the number of nucleotides overlapping
+    the workspace.
 
     In case of over-shoot, a random segment and position within the current 
     sample is chosen and the overshoot is removed by trimming in a random
@@ -486,10 +1591,12 @@ cdef class SamplerAnnotator(Sampler):
 
     *bucket_size* - bin size for empirical length distribution
 
-    *nbuckets* - number of bins of the empirical length distribution
+    *nbuckets* - number of bins of the empirical length distribution.
+    If 0, segment lengths are sampled exactly from the observed
+    lengths and *bucket_size* is ignored.
 
-    The product of *bucket_size* and *nbuckets* needs to be larger than
-    the largest segment in the input set.
+    If *nbuckets* is given, the product of *bucket_size* and *nbuckets*
+    needs to be larger than the largest segment in the input set.
 
     returns a SegmentList of sampled segments.
     '''
@@ -510,7 +1617,8 @@ cdef class SamplerAnnotator(Sampler):
     def __reduce__(self):
         return (buildSamplerAnnotator, (self.bucket_size, 
                                         self.nbuckets, 
-                                        self.nunsuccessful_rounds))
+                                        self.nunsuccessful_rounds),
+                self.rng)
 
     cpdef SegmentList sample(self,
                              SegmentList segments,
@@ -518,126 +1626,76 @@ cdef class SamplerAnnotator(Sampler):
         '''return a sampled list of segments.'''
 
         cdef PositionDifference remaining
-        cdef PositionDifference true_remaining
-        cdef PositionDifference overlap, ltotal, length
+        cdef PositionDifference gain, length
 
         cdef int nunsuccessful_rounds
         cdef int max_unsuccessful_rounds
-        cdef Position start, end
-        cdef Segment segment, sampled_segment
-        cdef SegmentList sampled_segments
-        cdef SegmentList unintersected_segments
+        cdef Position start, end, pos
+        cdef PositionDifference overlap
         cdef SegmentList intersected_segments
-        cdef SegmentList working_segments
-        cdef SegmentList tmp_segments
-        cdef SegmentListSampler sls, temp_sampler
+        cdef WorkspaceCoverage coverage
+        cdef SegmentListSampler sls
+        cdef LengthSampler hs
+        cdef SamplerSetup setup
+        cdef RandomNumberGenerator rng = self.getRNG()
 
         assert segments.isNormalized, "segment list is not normalized"
         assert workspace.isNormalized, "workspace is not normalized"
 
-        unintersected_segments = SegmentList()
-        intersected_segments = SegmentList()
-
-        # collect all segments in workspace
+        # segments in workspace, length and segment sampler.
         # This method does not truncate.
-        working_segments = segments.clone()
-        working_segments.filter(workspace)
-        if len(working_segments) == 0:
-            return intersected_segments
+        setup = self.getSetup(segments, workspace,
+                              self.bucket_size, self.nbuckets)
+        if len(setup.working_segments) == 0:
+            return SegmentList()
 
-        # get nucleotides that need to be sampled
-        # only count overlap within workspace
-        tmp_segments = working_segments.clone()
-        tmp_segments.intersect(workspace)
-        ltotal = tmp_segments.sum()        
+        hs = setup.length_sampler
+        sls = setup.workspace_sampler
 
-        # create space for sampled segments, add additional 10%
+        # union of sampled segments, add additional 10%
         # safety margin to avoid realloc calls
-        sampled_segments = SegmentList(allocate=int(1.1 * len(segments)))
-
-        # build a segment length histogram
-        histogram, bucket_size = working_segments.getLengthDistribution(self.bucket_size,
-                                                                        self.nbuckets)
-
-        hs = HistogramSampler(histogram, bucket_size)
-
-        # set up segment sampler
-        sls = SegmentListSampler(workspace)
+        coverage = WorkspaceCoverage(workspace,
+                                     allocate=int(1.1 * len(segments)))
 
-        remaining = ltotal
-        true_remaining = remaining
+        # nucleotides that need to be sampled
+        remaining = setup.ltotal
         nunsuccessful_rounds = 0
         max_unsuccessful_rounds = 20
 
-        while true_remaining > 0 and nunsuccessful_rounds < max_unsuccessful_rounds:
+        while remaining > 0 and nunsuccessful_rounds < max_unsuccessful_rounds:
 
             ###################################################################
             # Sample a segment length from the histogram
             length = hs.sample()
             assert length > 0
 
-            ###################################################################
-            # If we can now potentially get required number of nucleotides, recompute
-            # the required amount since we might need more due to overlap
-            if remaining <= length:
-                # add current sampled segments to list of segments
-                unintersected_segments.extend(sampled_segments)
-                # merge overlapping and adjacent segments
-                unintersected_segments.merge(0)
-
-                # reset sampled segments
-                sampled_segments.clear()
-
-                ############################################
-                # compute overlap with workspace
-                intersected_segments = unintersected_segments.clone()
-                intersected_segments.intersect(workspace)
-
-                assert intersected_segments.sum() <= unintersected_segments.sum()
-
-                # recompute bases remaining to be covered
-                remaining = ltotal - <PositionDifference>intersected_segments.sum()
-
-                # check if we managed to increase coverage
-                if true_remaining == remaining:
-                    nunsuccessful_rounds += 1
-                else:
-                    true_remaining = remaining
+            # sample a position until we get a nonzero overlap
+            start, end, overlap = sls.sample(length)
 
-            # deal with overshoot
-            if true_remaining < 0:
-                temp_sampler = SegmentListSampler( unintersected_segments )
+            # add to sampled segments and get increase in coverage
+            gain = coverage.add(start, end)
 
-                # sample a position from current list of sampled segments
-                start, end, overlap = temp_sampler.sample(1)
-
-                # causes a potential bias for overlapping segments:
-                # in case of overlapping segments, the
-                # segment chosen is always the first
-                unintersected_segments.trim_ends(
-                    start, 
-                    -true_remaining,
-                    numpy.random.randint(0, 2))
-
-                # trimming might remove residues outside the workspace
-                # hence - recompute true_remaining by going back to loop.
-                true_remaining = 1
-                continue
+            # check if we managed to increase coverage when
+            # we could potentially get the required number of nucleotides
+            if gain == 0 and remaining <= length:
+                nunsuccessful_rounds += 1
 
-            # sample a position until we get a nonzero overlap
-            start, end, overlap = sls.sample( length )
+            remaining -= gain
 
-            sampled_segment = Segment( start, end )
-
-            if true_remaining > 0:
-                sampled_segments._add( sampled_segment )
-                remaining -= overlap
+            # deal with overshoot
+            # trimming might remove residues outside the workspace
+            # hence - repeat until coverage is not above target
+            while remaining < 0:
+                # sample a position from current list of sampled segments
+                pos = coverage.getRandomPosition(rng)
+                remaining += coverage.trim_ends(pos,
+                                                -remaining,
+                                                rng.randint(0, 2))
 
         self.nunsuccessful_rounds = nunsuccessful_rounds
 
-        # merge overlapping/adjacent
-        intersected_segments = unintersected_segments.clone()
-        intersected_segments.merge(0)
+        # sampled segments are merged
+        intersected_segments = coverage.asSegmentList()
 
         # remove all segments outside workspace
         intersected_segments.filter(workspace)
@@ -674,10 +1732,12 @@ cdef class SamplerSegments(Sampler):
 
     *bucket_size* - bin size for empirical length distribution
 
-    *nbuckets* - number of bins of the empirical length distribution
+    *nbuckets* - number of bins of the empirical length distribution.
+    If 0, segment lengths are sampled exactly from the observed
+    lengths and *bucket_size* is ignored.
 
-    The product of *bucket_size* and *nbuckets* needs to be larger than
-    the largest segment in the input set.
+    If *nbuckets* is given, the product of *bucket_size* and *nbuckets*
+    needs to be larger than the largest segment in the input set.
 
     returns a SegmentList of sampled segments.
     '''
@@ -692,7 +1752,8 @@ cdef class SamplerSegments(Sampler):
 
     def __reduce__(self):
         return (buildSamplerSegments, (self.bucket_size, 
-                                       self.nbuckets ))
+                                       self.nbuckets ),
+                self.rng)
 
     cpdef SegmentList sample( self,
                                            SegmentList segments,
@@ -701,27 +1762,23 @@ cdef class SamplerSegments(Sampler):
 
         cdef Position length
         cdef SegmentListSampler sls
+        cdef LengthSampler hs
         cdef SegmentList sample
+        cdef SamplerSetup setup
 
         assert workspace.isNormalized, "workspace is not normalized"
 
         sample = SegmentList(allocate=len(segments))
     
-        # collect all segments in workspace
-        working_segments = segments.clone()
-        working_segments.filter(workspace)
+        # segments in workspace, length and segment sampler
+        setup = self.getSetup(segments, workspace,
+                              self.bucket_size, self.nbuckets)
 
-        if len(working_segments) == 0:
+        if len(setup.working_segments) == 0:
             return sample
 
-        # build length histogram
-        histogram, bucket_size = working_segments.getLengthDistribution(
-            self.bucket_size,
-            self.nbuckets)
-        hs = HistogramSampler(histogram, bucket_size)
-
-        # create segment sampler
-        sls = SegmentListSampler(workspace)
+        hs = setup.length_sampler
+        sls = setup.workspace_sampler
 
         for x in xrange(len(segments)):
 
@@ -737,8 +1794,8 @@ cdef class SamplerSegments(Sampler):
         return sample
 
 def buildSamplerSegments( *args ):
-    '''unpickling - return a rebuild SamplerAnnotator object.'''
-    return SamplerAnnotator( *args )
+    '''unpickling - return a rebuild SamplerSegments object.'''
+    return SamplerSegments( *args )
 
 ########################################################
 ########################################################
@@ -759,10 +1816,25 @@ cdef class SamplerBruteForce(Sampler):
 
     *bucket_size* - bin size for empirical length distribution
 
-    *nbuckets* - number of bins of the empirical length distribution
+    *nbuckets* - number of bins of the empirical length distribution.
+    If 0, segment lengths are sampled exactly from the observed
+    lengths and *bucket_size* is ignored.
 
-    The product of *bucket_size* and *nbuckets* needs to be larger than
-    the largest segment in the input set.
+    If *nbuckets* is given, the product of *bucket_size* and *nbuckets*
+    needs to be larger than the largest segment in the input set.
+
+    *ntries_inner* - number of consecutive failed placements
+    before sampling restarts.
+
+    *ntries_outer* - number of restarts before giving up.
+
+    *free_gaps* - if True, segments are placed directly into the
+    free gaps of the workspace using a :class:`FreeGapIndex`.
+    All positions at which a segment fits are equally likely and
+    no placement is rejected. Segments are placed fully within the
+    workspace and the last segment is shortened to the number of
+    remaining nucleotides. If False, random positions are rejected
+    if they overlap a previously sampled segment.
 
     returns a SegmentList of sampled segments.
 
@@ -772,23 +1844,79 @@ cdef class SamplerBruteForce(Sampler):
     cdef Position nbuckets
     cdef int ntries_inner
     cdef int ntries_outer
+    cdef bint free_gaps
 
     def __init__( self, 
                   bucket_size=1, 
                   nbuckets=100000,
                   ntries_inner=100,
-                  ntries_outer=10):
+                  ntries_outer=10,
+                  free_gaps=False):
 
         self.bucket_size = bucket_size
         self.nbuckets = nbuckets
         self.ntries_inner = ntries_inner
         self.ntries_outer = ntries_outer
+        self.free_gaps = free_gaps
 
     def __reduce__(self):
         return (buildSamplerBruteForce, (self.bucket_size, 
                                          self.nbuckets, 
                                          self.ntries_inner,
-                                         self.ntries_outer))
+                                         self.ntries_outer,
+                                         self.free_gaps),
+                self.rng)
+
+    cdef SegmentList sampleFromGaps(self,
+                                    SegmentList segments,
+                                    SegmentList workspace,
+                                    LengthSampler hs):
+        '''place segments into free gaps of the workspace.'''
+
+        cdef Position start, length
+        cdef FreeGapIndex gaps
+        cdef SegmentList sample = SegmentList(allocate=len(segments))
+        cdef RandomNumberGenerator rng = self.getRNG()
+        cdef int ntries_outer = self.ntries_outer
+        cdef int ntries_inner
+        cdef PositionDifference remaining
+
+        while ntries_outer > 0:
+
+            sample.clear()
+            gaps = FreeGapIndex(workspace)
+
+            remaining = segments.sum()
+            ntries_inner = self.ntries_inner
+
+            while remaining > 0 and ntries_inner > 0:
+
+                # Sample a segment length from the histogram
+                length = hs.sample()
+                assert length > 0
+                if length > remaining:
+                    length = remaining
+
+                # no free gap large enough
+                if gaps.weight(length) == 0:
+                    ntries_inner -= 1
+                    continue
+
+                start = gaps.place(length, rng)
+                sample._add(Segment(start, start + length))
+                ntries_inner = self.ntries_inner
+                remaining -= length
+
+            if ntries_inner > 0:
+                break
+
+            ntries_outer -= 1
+
+        if ntries_outer == 0:
+            raise ValueError("sampling did not converge: %s" % str(sample))
+
+        sample.normalize()
+        return sample
 
     cpdef SegmentList sample(self,
                              SegmentList segments,
@@ -797,27 +1925,26 @@ cdef class SamplerBruteForce(Sampler):
 
         cdef Position start, end, length
         cdef SegmentListSampler sls
+        cdef LengthSampler hs
         cdef SegmentList sample
+        cdef SamplerSetup setup
     
         assert workspace.isNormalized, "workspace is not normalized"
 
         sample = SegmentList(allocate=len(segments))
 
-        # collect all segments in workspace
-        working_segments = segments.clone()
-        working_segments.filter(workspace)
+        # segments in workspace, length and segment sampler
+        setup = self.getSetup(segments, workspace,
+                              self.bucket_size, self.nbuckets)
 
-        if len(working_segments) == 0:
+        if len(setup.working_segments) == 0:
             return sample
 
-        # build length histogram
-        histogram, bucket_size = working_segments.getLengthDistribution(
-            self.bucket_size,
-            self.nbuckets)
-        hs = HistogramSampler(histogram, bucket_size)
+        hs = setup.length_sampler
+        if self.free_gaps:
+            return self.sampleFromGaps(segments, workspace, hs)
 
-        # create segment sampler
-        sls = SegmentListSampler(workspace)
+        sls = setup.workspace_sampler
 
         cdef int ntries_outer = self.ntries_outer
         cdef int ntries_inner
@@ -829,7 +1956,6 @@ cdef class SamplerBruteForce(Sampler):
 
             remaining = segments.sum()
             ntries_inner = self.ntries_inner
-            # print "starting inner tries"
 
             while remaining > 0 and ntries_inner > 0:
 
@@ -840,8 +1966,6 @@ cdef class SamplerBruteForce(Sampler):
                 # sample a position until we get a nonzero overlap
                 start, end, overlap = sls.sample(length)
 
-                # print str(sample), start, end, overlap, remaining
-
                 if overlap > remaining:
                     ntries_inner -= 1
                     continue
@@ -854,8 +1978,6 @@ cdef class SamplerBruteForce(Sampler):
                 # required in order to sort samples
                 sample.normalize()
 
-                # print "adding", start, end, str(sample)
-
                 ntries_inner = self.ntries_inner
 
                 remaining -= overlap
@@ -888,10 +2010,12 @@ cdef class SamplerUniform(Sampler):
 
     *bucket_size* - bin size for empirical length distribution
 
-    *nbuckets* - number of bins of the empirical length distribution
+    *nbuckets* - number of bins of the empirical length distribution.
+    If 0, segment lengths are sampled exactly from the observed
+    lengths and *bucket_size* is ignored.
 
-    The product of *bucket_size* and *nbuckets* needs to be larger than
-    the largest segment in the input set.
+    If *nbuckets* is given, the product of *bucket_size* and *nbuckets*
+    needs to be larger than the largest segment in the input set.
     '''
 
     cdef Position bucket_size
@@ -922,7 +2046,8 @@ cdef class SamplerUniform(Sampler):
                                       self.nbuckets, 
                                       self.current_orientation,
                                       self.current_workspace,
-                                      self.current_position) )
+                                      self.current_position),
+                self.rng)
 
     cpdef SegmentList sample( self,
                                            SegmentList segments,
@@ -931,14 +2056,17 @@ cdef class SamplerUniform(Sampler):
         assert workspace.isNormalized, "workspace is not normalized"
 
         cdef SegmentList sample
-        cdef SegmentListSampler sls
+        cdef SegmentList working_segments
+        cdef LengthSampler hs
+        cdef SamplerSetup setup
         cdef Position increment = self.increment
         cdef Position start, end, x, length, i, added, nsegments, nworkspaces
         cdef Position current_offset, current_workspace
 
-        # collect all segments in workspace
-        working_segments = SegmentList( clone = segments )
-        working_segments.filter( workspace )
+        # segments in workspace and length sampler
+        setup = self.getSetup(segments, workspace,
+                              self.bucket_size, self.nbuckets)
+        working_segments = setup.working_segments
 
         # allocate sample large enough
         sample = SegmentList( allocate = (len(workspace) / increment + workspace.sum() ) )
@@ -946,11 +2074,7 @@ cdef class SamplerUniform(Sampler):
         if len(working_segments) == 0:
             return sample
 
-        # build length histogram
-        histogram, bucket_size = working_segments.getLengthDistribution( self.bucket_size,
-                                                                         self.nbuckets )
-
-        hs = HistogramSampler( histogram, bucket_size )
+        hs = setup.length_sampler
 
         sample = SegmentList( allocate = increment )
 
@@ -1027,7 +2151,8 @@ cdef class SamplerShift(Sampler):
 
     def __reduce__(self):
         return (buildSamplerShift, (self.radius, 
-                                    self.extension)), 
+                                    self.extension),
+                self.rng)
     
     cpdef SegmentList sample(self,
                              SegmentList segments,
@@ -1045,14 +2170,16 @@ cdef class SamplerShift(Sampler):
 
         cdef Segment segment
         cdef SegmentList sample, working_segments
-        cdef Position length, direction, extended_length
+        cdef Position length, total
         cdef Position x, midpoint
-        cdef PositionDifference shift, start, end, ws_start, ws_end, shift_area
-        cdef PositionDifference remainder, remainder_left, remainder_right
+        cdef PositionDifference start, end, ws_start, ws_end, shift_area
+        cdef PositionDifference remainder
         cdef double half_radius = self.radius / 2
         cdef PositionDifference half_extension = self.extension // 2
         cdef Segment * _working_segments
-        cdef SegmentList ws
+        cdef Segment * window
+        cdef Py_ssize_t cursor, idx, nwindow, allocated
+        cdef RandomNumberGenerator rng = self.getRNG()
 
         # collect all segments in workspace
         working_segments = SegmentList( clone = segments )
@@ -1060,49 +2187,103 @@ cdef class SamplerShift(Sampler):
         _working_segments = working_segments.segments
 
         # allocate sample large enough
-        sample = SegmentList( len(working_segments) * 2 )
+        sample = SegmentList( allocate = len(working_segments) * 2 )
+
+        if len(working_segments) == 0:
+            return sample
+
+        # scratch buffer for the part of the workspace within the
+        # shift window, grown as required
+        allocated = 16
+        window = <Segment*>malloc(allocated * sizeof(Segment))
+        if not window:
+            raise MemoryError(
+                "out of memory when allocation %i bytes" %
+                (allocated * sizeof(Segment)))
 
-        if len(working_segments) == 0:
-            return sample
-        
-        for x from 0 <= x < len(working_segments):
-            segment = _working_segments[x]
-            length = segment.end - segment.start
-            midpoint = segment.start + length // 2
-            if self.extension:
-                shift_area = half_extension
-            else:
-                shift_area = <Position>floor(length * half_radius)
+        try:
+            cursor = 0
+            for x from 0 <= x < len(working_segments):
+                segment = _working_segments[x]
+                length = segment.end - segment.start
+                midpoint = segment.start + length // 2
+                if self.extension:
+                    shift_area = half_extension
+                else:
+                    shift_area = <Position>floor(length * half_radius)
+
+                # get workspace around segment
+                ws_start = lmax(0, midpoint - shift_area)
+                ws_end = lmax(0, midpoint + shift_area)
+
+                # move the workspace cursor to the first workspace
+                # segment ending after the window start. Windows are
+                # centered on the segments, so the cursor usually
+                # only moves forward.
+                while cursor < workspace.nsegments and \
+                        workspace.segments[cursor].end <= ws_start:
+                    cursor += 1
+                while cursor > 0 and \
+                        workspace.segments[cursor - 1].end > ws_start:
+                    cursor -= 1
+
+                # copy workspace within window, truncated to window
+                nwindow = 0
+                total = 0
+                idx = cursor
+                while idx < workspace.nsegments and \
+                        workspace.segments[idx].start < ws_end:
+                    if nwindow == allocated:
+                        allocated *= 2
+                        window = <Segment*>realloc(
+                            window, allocated * sizeof(Segment))
+                        if not window:
+                            raise MemoryError(
+                                "out of memory when allocation %i bytes" %
+                                (allocated * sizeof(Segment)))
+                    window[nwindow].start = lmax(
+                        workspace.segments[idx].start, ws_start)
+                    window[nwindow].end = lmin(
+                        workspace.segments[idx].end, ws_end)
+                    total += segment_length(window[nwindow])
+                    nwindow += 1
+                    idx += 1
 
-            # get workspace around segment
-            ws_start = lmax(0, midpoint - shift_area)
-            ws_end = lmax(0, midpoint + shift_area) 
-            ws = workspace.getOverlappingSegmentsWithRange( ws_start, ws_end )
-            ws.truncate( Segment( ws_start, ws_end ) )
+                # no space to shift - keep segment in place
+                if total == 0:
+                    sample._add(segment)
+                    continue
 
-            start = ws.getRandomPosition()
-            if numpy.random.randint( 0,2 ):
-                end = start + length
-            else:
-                end = start
-                start = end - length
-
-            # ws_start is now the intersection of workspace and sampling space
-            ws_start, ws_end = ws.min(), ws.max()
-
-            remainder = length
-            if start < ws_start:
-                # start might be further than length outside of range
-                remainder = lmin(ws_start - start, length)
-                sample.extend( ws.getFilledSegmentsFromStart( start, length - remainder ) )
-                sample.extend( ws.getFilledSegmentsFromEnd( ws_end, remainder ) )
-            elif end > ws_end:
-                # end might be further than length outside of range
-                remainder = lmin(end - ws_end, length)
-                sample.extend( ws.getFilledSegmentsFromEnd( end, length - remainder ) )
-                sample.extend( ws.getFilledSegmentsFromStart( ws_start, remainder ) )
-            else:
-                sample.extend( ws.getFilledSegmentsFromStart( start, length ) )
+                start = getRandomPositionInArray(window, nwindow, total, rng)
+                if rng.randint(0, 2):
+                    end = start + length
+                else:
+                    end = start
+                    start = end - length
+
+                # ws_start is now the intersection of workspace and sampling space
+                ws_start, ws_end = window[0].start, window[nwindow - 1].end
+
+                remainder = length
+                if start < ws_start:
+                    # start might be further than length outside of range
+                    remainder = lmin(ws_start - start, length)
+                    fillFromStart(sample, window, nwindow, total,
+                                  start, length - remainder)
+                    fillFromEnd(sample, window, nwindow, total,
+                                ws_end, remainder)
+                elif end > ws_end:
+                    # end might be further than length outside of range
+                    remainder = lmin(end - ws_end, length)
+                    fillFromEnd(sample, window, nwindow, total,
+                                end, length - remainder)
+                    fillFromStart(sample, window, nwindow, total,
+                                  ws_start, remainder)
+                else:
+                    fillFromStart(sample, window, nwindow, total,
+                                  start, length)
+        finally:
+            free(window)
 
         sample.normalize()
         return sample
@@ -1150,10 +2331,6 @@ cdef class SamplerLocalPermutation(Sampler):
                                            SegmentList workspace ):
         '''create a random sample of segments.
 
-        .. note::
-            Still needs to optimized for speed.
-            The algorithm is not fully implemented yet.
-
         *segments* - a list of segments
         
         *workspace* - the workspace to use
@@ -1162,70 +2339,97 @@ cdef class SamplerLocalPermutation(Sampler):
         '''
 
         assert workspace.isNormalized, "workspace is not normalized"
+        assert segments.isNormalized, "segment list is not normalized"
 
-        cdef Segment segment
-        cdef SegmentList working_segments
         cdef PositionDifference work_start, work_end, start, end, last
         cdef PositionDifference total_length, free_length
-        cdef Segment* _working_segments
         cdef PositionDifference shift
-        cdef SegmentList sample = SegmentList()
-        
-        for work_start, work_end in workspace:
+        cdef Py_ssize_t workspace_idx, first, last_idx, x, nlengths
+        cdef Position * lengths
+        cdef Position * points
+        cdef SegmentList sample = SegmentList(allocate=2 * len(segments))
+        cdef RandomNumberGenerator rng = self.getRNG()
 
-            # collect all segments in this workspace segment
-            working_segments = segments.getOverlappingSegments( Segment( work_start, work_end) )
-            if len(working_segments) == 0: continue
-            _working_segments = working_segments.segments
-            
-            lengths = [ x[1] - x[0] for x in working_segments ]
-            total_length = sum( lengths )
-            
-            # modify workspace to deal with overhanging segments
-            # extend workspace
-            work_start = lmin( working_segments.min(), work_start )
-            work_end = lmax( working_segments.max(), work_end )
-            free_length = work_end - work_start - total_length
-            
-            # 1. permutate order of segments
-            random.shuffle( lengths )
-        
-            # 2. determine size of space between samples
-            # sample points in free area. The distance
-            # between the points is the space left.
-            points = []
-            for x in range(len(lengths) ):
-                points.append( random.randint( 0, free_length ) )
-            points.sort()
-
-            # cycle shift to avoid edge effects
-            shift = random.randint( 0, free_length )
-
-            # 3. move segments to appropriate place
-            start = work_start + shift
-            last = 0
-            for x in range(len(lengths)):
-                start += points[x] - last
-                # wrap around if beyond end of workspace
-                if start > work_end:
-                    start = work_start + start - work_end
-                end = start + lengths[x]
-                if end < work_end:
-                    sample._add( Segment(start, end ) )
-                    start += lengths[x]
-                else:
-                    # wrap around segment
-                    sample._add( Segment(start, work_end ) )
-                    end = work_start + end - work_end
-                    sample._add( Segment( work_start, end ) )
+        if len(segments) == 0:
+            return sample
 
-                start = end
-                last = points[x]
-                
-            assert start + (points[-1] - last) <= work_end, "start=%i, points[-1]=%i, work_end=%i" % \
-                (start, points[-1] -last, work_end)
-        
-            sample.normalize()
+        lengths = <Position*>malloc(sizeof(Position) * segments.nsegments)
+        points = <Position*>malloc(sizeof(Position) * segments.nsegments)
+        if not lengths or not points:
+            free(lengths)
+            free(points)
+            raise MemoryError(
+                "out of memory when allocation %i bytes" %
+                (2 * sizeof(Position) * segments.nsegments))
+
+        try:
+            first = 0
+            for workspace_idx from 0 <= workspace_idx < workspace.nsegments:
+                work_start = workspace.segments[workspace_idx].start
+                work_end = workspace.segments[workspace_idx].end
+
+                # collect all segments overlapping this workspace segment
+                while first < segments.nsegments and \
+                        segments.segments[first].end <= work_start:
+                    first += 1
+                last_idx = first
+                total_length = 0
+                while last_idx < segments.nsegments and \
+                        segments.segments[last_idx].start < work_end:
+                    lengths[last_idx - first] = segment_length(
+                        segments.segments[last_idx])
+                    total_length += lengths[last_idx - first]
+                    last_idx += 1
+
+                nlengths = last_idx - first
+                if nlengths == 0:
+                    continue
+
+                # modify workspace to deal with overhanging segments
+                # extend workspace
+                work_start = lmin(segments.segments[first].start, work_start)
+                work_end = lmax(segments.segments[last_idx - 1].end, work_end)
+                free_length = work_end - work_start - total_length
+
+                # 1. permutate order of segments
+                shufflePositions(lengths, nlengths, rng)
+
+                # 2. determine size of space between samples
+                # sample points in free area. The distance
+                # between the points is the space left.
+                samplePoints(points, nlengths, free_length, rng)
+
+                # cycle shift to avoid edge effects
+                shift = rng.randint(0, free_length + 1)
+
+                # 3. move segments to appropriate place
+                start = work_start + shift
+                last = 0
+                for x from 0 <= x < nlengths:
+                    start += points[x] - last
+                    # wrap around if beyond end of workspace
+                    if start > work_end:
+                        start = work_start + start - work_end
+                    end = start + lengths[x]
+                    if end < work_end:
+                        sample._add(Segment(start, end))
+                    else:
+                        # wrap around segment
+                        sample._add(Segment(start, work_end))
+                        end = work_start + end - work_end
+                        sample._add(Segment(work_start, end))
+
+                    start = end
+                    last = points[x]
+
+                assert start + (points[nlengths - 1] - last) <= work_end, \
+                    "start=%i, points[-1]=%i, work_end=%i" % \
+                    (start, points[nlengths - 1] - last, work_end)
+        finally:
+            free(lengths)
+            free(points)
+
+        sample.normalize()
         return sample
 
 ########################################################
@@ -1266,9 +2470,6 @@ cdef class SamplerGlobalPermutation(Sampler):
                                            SegmentList workspace ):
         '''create a random sample of segments.
 
-        .. note::
-            Still needs to optimized for speed
-
         *segments* - a list of segments
         
         *workspace* - the workspace to use
@@ -1278,19 +2479,27 @@ cdef class SamplerGlobalPermutation(Sampler):
 
         assert workspace.isNormalized, "workspace is not normalized"
 
-        cdef Segment segment
         cdef SegmentList working_segments, working_workspace
-        cdef PositionDifference work_start, work_end, start, end, last_end
-        cdef PositionDifference total_length, free_length
+        cdef PositionDifference work_end, start
+        cdef PositionDifference total_length, free_length, count, shift
+        cdef PositionDifference gap_length, length, increment
+        cdef PositionDifference last_ungapped_position
+        cdef Py_ssize_t idx, max_idx, segment_idx, nsegments, wrap_idx
+        cdef Position * lengths
+        cdef Position * points
+        cdef Segment * ws
         
-        cdef SegmentList sample = SegmentList()
+        cdef SegmentList sample, wrapped
+        cdef RandomNumberGenerator rng = self.getRNG()
 
         # collect all segments in workspace
         # This method does not truncate.
         working_segments = SegmentList( clone = segments )
         working_segments.filter( workspace )
 
-        if len(working_segments) == 0: return sample
+        nsegments = working_segments.nsegments
+        sample = SegmentList(allocate=2 * nsegments)
+        if nsegments == 0: return sample
         
         # create a copy of the workspace
         working_workspace = SegmentList( clone = workspace )
@@ -1298,88 +2507,103 @@ cdef class SamplerGlobalPermutation(Sampler):
         # extend workspace segments with segments
         working_workspace.extend( working_segments )
         working_workspace.merge(0)
+        ws = working_workspace.segments
+        max_idx = working_workspace.nsegments
+
+        lengths = <Position*>malloc(sizeof(Position) * nsegments)
+        points = <Position*>malloc(sizeof(Position) * nsegments)
+        if not lengths or not points:
+            free(lengths)
+            free(points)
+            raise MemoryError(
+                "out of memory when allocation %i bytes" %
+                (2 * sizeof(Position) * nsegments))
 
-        # get lengths of segments inside and extending from workspace
-        lengths = [ x[1] - x[0] for x in working_segments ]
-        total_length = sum( lengths )
-
-        # compute workspace size free of segments
-        free_length = working_workspace.sum()
-        free_length -= total_length
-
-        # 1. permutate order of segments
-        random.shuffle( lengths )
-
-        # 2. determine size of space between samples
-        # sample points in free area. The distance
-        # between the points is the space left.
-        points = []
-        for x in range(len(lengths) ):
-            points.append( random.randint( 0, free_length ) )
-        points.sort()
-
-        # 3. cycle shift to avoid edge effects
-        shift = random.randint( 0, free_length )
-
-        # find starting position 
-        count = 0
-        idx = 0
-        for start,end in working_workspace:
-            count += end - start
-            if count > shift: 
-                count -= end - start
-                break
-            idx += 1
+        try:
+            # get lengths of segments inside and extending from workspace
+            total_length = 0
+            for idx from 0 <= idx < nsegments:
+                lengths[idx] = segment_length(working_segments.segments[idx])
+                total_length += lengths[idx]
 
-        # idx is now the segment to start inserting in
-        # add missing residues
-        start += shift - count
+            # compute workspace size free of segments
+            free_length = working_workspace.sum() - total_length
 
-        # 4. move segments to appropriate place
-        last_end = 0
-        global_work_start, global_work_end = working_workspace.min(), working_workspace.max()
-        work_start, work_end = working_workspace[idx]
+            # 1. permutate order of segments
+            shufflePositions(lengths, nsegments, rng)
 
-        #print "starting adding", start
-        max_idx = len(working_workspace)
-        last_ungapped_position = 0
-        for segment_idx in range( len(lengths) ):
-            
-            # place a gap
-            gap_length = points[segment_idx] - last_ungapped_position
-            assert gap_length >= 0
-            #print "gap_length", gap_length
-            # print "gap"
-            while gap_length > 0:
-                increment = lmin( work_end - start, gap_length )
-                # print idx, start, start + increment, gap_length
-                start += increment
-                if start == work_end:
-                    idx += 1
-                    if idx >= max_idx: idx = 0
-                    work_start, work_end = working_workspace[idx]
-                    start = work_start
-                gap_length -= increment
-                last_ungapped_position += increment
-
-            # place a segment of a certain length
-            # the segment is split into multiple components at
-            # workspace gaps
-            length = lengths[segment_idx]
-            #print "segment", length
-
-            while length > 0:
-                increment = lmin( work_end - start, length )
-                #print idx, 'start=',start, 'end=', start + increment, 'len=',length
-                if increment > 0:
-                    sample._add( Segment( start, start + increment ) )
-                start += increment
-                if start == work_end:
-                    idx += 1
-                    if idx >= max_idx: idx = 0
-                    work_start, work_end = working_workspace[idx]
-                    start = work_start
-                length -= increment
+            # 2. determine size of space between samples
+            # sample points in free area. The distance
+            # between the points is the space left.
+            samplePoints(points, nsegments, free_length, rng)
+
+            # 3. cycle shift to avoid edge effects
+            shift = rng.randint(0, free_length + 1)
+
+            # find starting position 
+            count = 0
+            for idx from 0 <= idx < max_idx:
+                count += segment_length(ws[idx])
+                if count > shift: 
+                    count -= segment_length(ws[idx])
+                    break
+
+            # idx is now the segment to start inserting in
+            # add missing residues
+            start = ws[idx].start + shift - count
+            work_end = ws[idx].end
+
+            # 4. move segments to appropriate place
+            # The workspace is traversed at most once, segments
+            # added after wrapping around are before all others.
+            wrap_idx = 0
+            last_ungapped_position = 0
+            for segment_idx from 0 <= segment_idx < nsegments:
+
+                # place a gap
+                gap_length = points[segment_idx] - last_ungapped_position
+                assert gap_length >= 0
+                while gap_length > 0:
+                    increment = lmin( work_end - start, gap_length )
+                    start += increment
+                    if start == work_end:
+                        idx += 1
+                        if idx >= max_idx:
+                            idx = 0
+                            wrap_idx = sample.nsegments
+                        start, work_end = ws[idx].start, ws[idx].end
+                    gap_length -= increment
+                    last_ungapped_position += increment
+
+                # place a segment of a certain length
+                # the segment is split into multiple components at
+                # workspace gaps
+                length = lengths[segment_idx]
+
+                while length > 0:
+                    increment = lmin( work_end - start, length )
+                    if increment > 0:
+                        sample._add( Segment( start, start + increment ) )
+                    start += increment
+                    if start == work_end:
+                        idx += 1
+                        if idx >= max_idx:
+                            idx = 0
+                            wrap_idx = sample.nsegments
+                        start, work_end = ws[idx].start, ws[idx].end
+                    length -= increment
+        finally:
+            free(lengths)
+            free(points)
+
+        # rotate so that segments are sorted
+        if wrap_idx > 0:
+            wrapped = SegmentList(allocate=sample.nsegments)
+            for idx from wrap_idx <= idx < sample.nsegments:
+                wrapped._add(sample.segments[idx])
+            for idx from 0 <= idx < wrap_idx:
+                wrapped._add(sample.segments[idx])
+            sample = wrapped
 
         sample.normalize()
 
@@ -1409,11 +2633,188 @@ cdef class SamplerDummy(Sampler):
 ############################################################
 ## Counters
 ############################################################
+cdef inline Py_ssize_t searchCost(Py_ssize_t nsegments) nogil:
+    '''return the number of steps of the two binary searches
+    for a query in *nsegments* segments.'''
+    cdef Py_ssize_t depth = 1
+    while (<Py_ssize_t>1 << depth) <= nsegments:
+        depth += 1
+    return 2 * depth
+
+cdef inline bint preferSearch(Py_ssize_t nquery, Py_ssize_t nsegments) nogil:
+    '''return True if *nquery* segments are overlapped faster
+    with two binary searches each than by merging with
+    *nsegments* segments.'''
+    return nquery * searchCost(nsegments) < nquery + nsegments
+
+cdef uint64_t overlapWithPrefixSums(Segment * query,
+                                    Py_ssize_t nquery,
+                                    Segment * segments,
+                                    uint64_t * cumulative,
+                                    Py_ssize_t lo,
+                                    Py_ssize_t hi) nogil:
+    '''return the number of nucleotides in *query* overlapping
+    *segments* from *lo* to *hi*.
+
+    Both need to be sorted and non-overlapping. *cumulative*
+    contains the number of bases in the segments before each
+    segment.
+    '''
+    cdef Py_ssize_t x, first = lo, last
+    cdef uint64_t overlap = 0
+    cdef Segment s
+    for x from 0 <= x < nquery:
+        s = query[x]
+        # queries are sorted, search onwards from previous result
+        first = gallopEnd(segments, first, hi, s.start)
+        if first == hi:
+            break
+        last = gallopStart(segments, first, hi, s.end)
+        if last == first:
+            continue
+        overlap += cumulative[last] - cumulative[first]
+        # truncate first and last segment to query
+        if segments[first].start < s.start:
+            overlap -= s.start - segments[first].start
+        if segments[last - 1].end > s.end:
+            overlap -= segments[last - 1].end - s.end
+    return overlap
+
+cdef numpy.ndarray buildCumulative(numpy.ndarray segments):
+    '''return the number of bases before each segment in
+    *segments*, an array of start and end coordinates.'''
+    cumulative = numpy.zeros(len(segments) + 1, dtype=numpy.uint64)
+    numpy.cumsum(segments[:, 1].astype(numpy.uint64) - segments[:, 0],
+                 out=cumulative[1:])
+    return cumulative
+
+
+cdef class PrefixSumIndex:
+    '''read-only index of a :class:`SegmentList` for computing
+    nucleotide overlap.
+
+    The index keeps the sorted segments together with the number
+    of bases covered before each segment. The overlap with a
+    query segment requires two binary searches and the difference
+    of two prefix sums.
+
+    :meth:`overlapWithSegments` chooses between binary searches
+    and merging the two lists depending on their relative size.
+    The index can be used in place of the annotations with
+    :class:`CounterNucleotideOverlap` and
+    :class:`CounterNucleotideDensity`.
+    '''
+
+    cdef numpy.ndarray segments
+    cdef numpy.ndarray cumulative
+    # data of the arrays above for use without the GIL
+    cdef Segment * _segments
+    cdef uint64_t * _cumulative
+    cdef Py_ssize_t nsegments
+
+    def __init__(self, SegmentList segments=None, unreduce=None):
+        if unreduce:
+            self.segments, self.cumulative = unreduce
+            self._attach()
+            return
+
+        assert segments.isNormalized, "index of non-normalized list"
+        cdef numpy.ndarray[numpy.uint32_t, ndim=2] data = numpy.empty(
+            (segments.nsegments, 2), dtype=numpy.uint32)
+        if segments.nsegments > 0:
+            memcpy(data.data, segments.segments,
+                   segments.nsegments * sizeof(Segment))
+        self.segments = data
+        self.cumulative = buildCumulative(data)
+        self._attach()
+
+    cdef _attach(self):
+        self._segments = <Segment*>self.segments.data
+        self._cumulative = <uint64_t*>self.cumulative.data
+        self.nsegments = len(self.segments)
+
+    def __reduce__(self):
+        return (buildPrefixSumIndex, (self.segments, self.cumulative))
+
+    def __len__(self):
+        return len(self.segments)
+
+    cpdef Position sum(self):
+        '''return total length of all segments.'''
+        return self.cumulative[-1]
+
+    cdef uint64_t overlap(self, Segment * query, Py_ssize_t nquery) nogil:
+        '''return the number of nucleotides in *query* overlapping
+        the segments in the index.'''
+        if preferSearch(nquery, self.nsegments):
+            return overlapWithPrefixSums(query, nquery,
+                                         self._segments,
+                                         self._cumulative,
+                                         0, self.nsegments)
+        return overlapSegmentArrays(query, nquery,
+                                    self._segments,
+                                    self.nsegments)
+
+    cpdef Position overlapWithRange(self, Position start, Position end):
+        '''return the number of nucleotides overlapping with a range.'''
+        cdef Segment s = Segment(start, end)
+        return overlapWithPrefixSums(&s, 1,
+                                     self._segments,
+                                     self._cumulative,
+                                     0, self.nsegments)
+
+    cpdef Position overlapWithSegments(self, SegmentList other):
+        '''return the number of nucleotides overlapping between
+        the index and *other*.
+
+        *other* needs to be normalized.
+        '''
+        assert other.isNormalized, "intersection with non-normalized list"
+        cdef uint64_t overlap
+        with nogil:
+            overlap = self.overlap(other.segments, other.nsegments)
+        return overlap
+
+
+def buildPrefixSumIndex(*args):
+    '''pickling helper function.
+
+    Return a re-constructed PrefixSumIndex object.
+    '''
+    return PrefixSumIndex(unreduce=args)
+
+
+# counting modes of the built-in counters, see getCountMode
+DEF COUNT_NUCLEOTIDES = 0
+DEF COUNT_DENSITY = 1
+DEF COUNT_SEGMENTS = 2
+DEF COUNT_SEGMENT_MIDPOINTS = 3
+DEF COUNT_ANNOTATIONS = 4
+DEF COUNT_ANNOTATION_MIDPOINTS = 5
+
 cdef class Counter:
     '''base class for objects that compute counts
     between two segment lists.
     '''
 
+    def countContigs(self,
+                     segments,
+                     annotations,
+                     workspace,
+                     contigs,
+                     aggregator=sum):
+        '''return the count between *segments* and *annotations*
+        across *contigs*.
+
+        *segments*, *annotations* and *workspace* are dictionaries
+        of segment lists by contig. The counts for each contig are
+        combined with *aggregator*.
+        '''
+        return aggregator([self(segments[contig],
+                                annotations[contig],
+                                workspace[contig])
+                           for contig in contigs])
+
 cdef class CounterNucleotideOverlap(Counter):
     """return number of nucleotides overlapping between segments and
     annotations."""
@@ -1421,18 +2822,23 @@ cdef class CounterNucleotideOverlap(Counter):
     name = "nucleotide-overlap"
 
     def __call__(self, SegmentList segments,
-                 SegmentList annotations,
+                 annotations,
                  SegmentList workspace=None):
+        '''*annotations* can be a :class:`SegmentList` or a
+        :class:`PrefixSumIndex`.'''
         return annotations.overlapWithSegments(segments)
 
 cdef class CounterNucleotideDensity(Counter):
     name = "nucleotide-density"
 
     def __call__(self, SegmentList segments,
-                 SegmentList annotations,
+                 annotations,
                  SegmentList workspace ):
         '''return number of nucleotides overlapping between segments and annotations.
         divided by the size of the workspace
+
+        *annotations* can be a :class:`SegmentList` or a
+        :class:`PrefixSumIndex`.
         '''
         cdef Position l
         l = len(workspace)
@@ -1471,6 +2877,861 @@ cdef class CounterAnnotationMidpointOverlap(Counter):
             segments,
             mode="midpoint")
 
+cdef Py_ssize_t distancesToAnnotations(Segment * segments,
+                                       Py_ssize_t nsegments,
+                                       Segment * annotations,
+                                       Py_ssize_t nannotations,
+                                       Position * distances) nogil:
+    '''store the distance of each segment in *segments* to the
+    closest segment in *annotations* in *distances*.
+
+    Both need to be sorted and non-overlapping, thus starts and
+    ends of *annotations* are both sorted. The closest annotations
+    are found by a search for the first annotation ending after the
+    start of a segment. As *segments* are sorted, the search
+    continues from the previous segment.
+
+    returns the number of distances, 0 if there are no annotations.
+    '''
+    cdef Py_ssize_t x, idx = 0
+    cdef Position distance
+    if nannotations == 0:
+        return 0
+    for x from 0 <= x < nsegments:
+        idx = gallopEnd(annotations, idx, nannotations, segments[x].start)
+        # annotation overlapping or following the segment
+        if idx < nannotations:
+            if annotations[idx].start < segments[x].end:
+                distance = 0
+            else:
+                distance = annotations[idx].start - segments[x].end
+        else:
+            distance = UINT32_MAX
+        # annotation preceding the segment
+        if idx > 0 and segments[x].start - annotations[idx - 1].end < distance:
+            distance = segments[x].start - annotations[idx - 1].end
+        distances[x] = distance
+    return nsegments
+
+cdef class CounterDistance(Counter):
+    '''base class for counters of the distance between
+    segments and the closest annotation.
+
+    The distance is the number of bases between a segment and
+    the closest annotation, 0 if they overlap or are adjacent.
+    Segments on contigs without annotations are ignored.
+
+    Distances are pooled across contigs before they are summarized,
+    see :meth:`countContigs`.
+    '''
+
+    def distances(self, SegmentList segments, SegmentList annotations):
+        '''return a numpy array with the distance of each
+        segment in *segments* to the closest annotation.'''
+        assert segments.isNormalized, "distance from non-normalized list"
+        assert annotations.isNormalized, "distance to non-normalized list"
+        cdef numpy.ndarray[numpy.uint32_t, ndim=1] result = \
+            numpy.empty(segments.nsegments, dtype=numpy.uint32)
+        cdef Py_ssize_t n
+        with nogil:
+            n = distancesToAnnotations(segments.segments,
+                                       segments.nsegments,
+                                       annotations.segments,
+                                       annotations.nsegments,
+                                       <Position*>result.data)
+        return result[:n]
+
+    def summarize(self, distances):
+        '''return the summary statistic of *distances*.'''
+        raise NotImplementedError(
+            "summarize() not implemented in %s" % self.__class__.__name__)
+
+    def __call__(self, segments, annotations, workspace=None):
+        '''return the summary of distances between *segments*
+        and the closest *annotations*.'''
+        return self.summarize(self.distances(segments, annotations))
+
+    def countContigs(self,
+                     segments,
+                     annotations,
+                     workspace,
+                     contigs,
+                     aggregator=sum):
+        '''return the summary of distances between *segments*
+        and the closest *annotations* pooled across *contigs*.
+
+        *aggregator* is ignored.
+        '''
+        return self.summarize(numpy.concatenate(
+            [self.distances(segments[contig], annotations[contig])
+             for contig in contigs] +
+            [numpy.zeros(0, dtype=numpy.uint32)]))
+
+cdef class CounterDistanceMean(CounterDistance):
+    name = "distance-mean"
+
+    def summarize(self, distances):
+        '''return the mean distance, 0 if there are none.'''
+        if len(distances) == 0:
+            return 0
+        return float(numpy.mean(distances))
+
+cdef class CounterDistanceMedian(CounterDistance):
+    name = "distance-median"
+
+    def summarize(self, distances):
+        '''return the median distance, 0 if there are none.'''
+        if len(distances) == 0:
+            return 0
+        return float(numpy.median(distances))
+
+cdef class CounterDistanceWithin(CounterDistance):
+    '''count segments within a distance of *threshold* to the
+    closest annotation.'''
+
+    name = "distance-within"
+
+    cdef readonly Position threshold
+
+    def __init__(self, Position threshold=1000):
+        self.threshold = threshold
+
+    def __reduce__(self):
+        return (buildCounterDistanceWithin, (self.threshold,))
+
+    def summarize(self, distances):
+        '''return the number of distances up to the threshold.'''
+        return int(numpy.count_nonzero(distances <= self.threshold))
+
+def buildCounterDistanceWithin(*args):
+    '''pickling helper function.
+
+    Return a re-constructed CounterDistanceWithin object.
+    '''
+    return CounterDistanceWithin(*args)
+
+############################################################
+############################################################
+############################################################
+## Counting against all annotation tracks at once
+############################################################
+cdef int getCountMode(counter):
+    '''return the counting mode of *counter* for
+    :class:`AnnotationIndex` or -1 if it is not supported.'''
+    # compare exact types, subclasses might count differently
+    cdef type t = type(counter)
+    if t is CounterNucleotideOverlap:
+        return COUNT_NUCLEOTIDES
+    elif t is CounterNucleotideDensity:
+        return COUNT_DENSITY
+    elif t is CounterSegmentOverlap:
+        return COUNT_SEGMENTS
+    elif t is CounterSegmentMidpointOverlap:
+        return COUNT_SEGMENT_MIDPOINTS
+    elif t is CounterAnnotationOverlap:
+        return COUNT_ANNOTATIONS
+    elif t is CounterAnnotationMidpointOverlap:
+        return COUNT_ANNOTATION_MIDPOINTS
+    return -1
+
+cdef double countSegmentArrays(int mode,
+                               Segment * segments,
+                               Py_ssize_t nsegments,
+                               Segment * annotations,
+                               Py_ssize_t nannotations,
+                               Py_ssize_t workspace_size) nogil:
+    '''return the count for counting *mode* between *segments* and
+    *annotations*.
+
+    This is the C equivalent of calling the counter returned
+    by :func:`getCountMode`. Both arrays need to be sorted and
+    non-overlapping. *workspace_size* is the number of workspace
+    segments and only used for densities.
+    '''
+    if mode == COUNT_NUCLEOTIDES:
+        return overlapSegmentArrays(segments, nsegments,
+                                    annotations, nannotations)
+    elif mode == COUNT_DENSITY:
+        if workspace_size == 0:
+            return 0
+        return <double>overlapSegmentArrays(
+            segments, nsegments,
+            annotations, nannotations) / workspace_size
+    elif mode == COUNT_SEGMENTS:
+        return intersectSegmentArrays(segments, nsegments,
+                                      annotations, nannotations, False)
+    elif mode == COUNT_SEGMENT_MIDPOINTS:
+        return intersectSegmentArrays(segments, nsegments,
+                                      annotations, nannotations, True)
+    elif mode == COUNT_ANNOTATIONS:
+        return intersectSegmentArrays(annotations, nannotations,
+                                      segments, nsegments, False)
+    elif mode == COUNT_ANNOTATION_MIDPOINTS:
+        return intersectSegmentArrays(annotations, nannotations,
+                                      segments, nsegments, True)
+    return 0
+
+cdef void countTracks(Segment * segments,
+                      Py_ssize_t nsegments,
+                      Segment * annotations,
+                      int * labels,
+                      Py_ssize_t nannotations,
+                      int modes,
+                      Py_ssize_t * active,
+                      Py_ssize_t * seen,
+                      uint64_t * counts,
+                      Py_ssize_t nlabels) nogil:
+    '''count *segments* against labelled *annotations* in a
+    single sweep, adding to *counts* per label.
+
+    *modes* is a bit mask of the counting modes to compute. The
+    counts for mode ``m`` and label ``l`` are stored at
+    ``counts[m * nlabels + l]``. Nucleotide density is counted as
+    nucleotides.
+
+    *segments* need to be sorted and non-overlapping, *annotations*
+    sorted by start. Annotations with the same label must not overlap.
+    If *labels* is NULL, all annotations have label 0.
+
+    *active* is work space for up to *nannotations* indices and
+    *seen* needs to be set to -1 for each label.
+
+    The counts are the same as the ones computed by the counters
+    for each label separately.
+    '''
+    cdef Py_ssize_t x = 0, y, j, nactive = 0, nxt = 0
+    cdef Segment s, a
+    cdef Position midpoint
+    cdef int label = 0
+    cdef bint count_segments = modes & (
+        1 << COUNT_SEGMENTS | 1 << COUNT_SEGMENT_MIDPOINTS)
+    cdef bint gallop = useGallop(nsegments, nannotations)
+
+    while x < nsegments:
+        s = segments[x]
+
+        # remove annotations ending before this segment
+        y = 0
+        for j from 0 <= j < nactive:
+            if annotations[active[j]].end > s.start:
+                active[y] = active[j]
+                y += 1
+        nactive = y
+
+        # skip annotations ending before this segment. Ends
+        # are only sorted if all annotations are from one track.
+        if gallop and labels == NULL:
+            nxt = gallopEnd(annotations, nxt, nannotations, s.start)
+
+        # add annotations starting before the end of this segment.
+        # This is the first segment overlapping them.
+        while nxt < nannotations and annotations[nxt].start < s.end:
+            a = annotations[nxt]
+            if a.end > s.start:
+                active[nactive] = nxt
+                nactive += 1
+                if labels != NULL:
+                    label = labels[nxt]
+                if modes & 1 << COUNT_ANNOTATIONS:
+                    counts[COUNT_ANNOTATIONS * nlabels + label] += 1
+                if modes & 1 << COUNT_ANNOTATION_MIDPOINTS:
+                    midpoint = a.start + (a.end - a.start) // 2
+                    if s.start <= midpoint < s.end:
+                        counts[COUNT_ANNOTATION_MIDPOINTS * nlabels + label] += 1
+            nxt += 1
+
+        if nactive == 0:
+            if nxt == nannotations:
+                break
+            # skip segments ending before the next annotation
+            if gallop:
+                x = gallopEnd(segments, x + 1, nsegments,
+                              annotations[nxt].start)
+            else:
+                x += 1
+            continue
+
+        # active annotations overlap this segment and are
+        # sorted by start.
+        midpoint = s.start + (s.end - s.start) // 2
+        for j from 0 <= j < nactive:
+            a = annotations[active[j]]
+            if labels != NULL:
+                label = labels[active[j]]
+            if modes & 1 << COUNT_NUCLEOTIDES:
+                counts[COUNT_NUCLEOTIDES * nlabels + label] += \
+                    segment_overlap_raw(s, a)
+            # only the first annotation of a label counts
+            if not count_segments or seen[label] == x:
+                continue
+            seen[label] = x
+            if modes & 1 << COUNT_SEGMENTS:
+                counts[COUNT_SEGMENTS * nlabels + label] += 1
+            if modes & 1 << COUNT_SEGMENT_MIDPOINTS and \
+               a.start <= midpoint < a.end:
+                counts[COUNT_SEGMENT_MIDPOINTS * nlabels + label] += 1
+        x += 1
+
+
+cdef Py_ssize_t countClasses(Segment * segments,
+                             Py_ssize_t nsegments,
+                             Segment * intervals,
+                             int * classes,
+                             Py_ssize_t nintervals,
+                             uint64_t * class_counts,
+                             int * touched) nogil:
+    '''add the bases of *segments* overlapping *intervals* to
+    *class_counts* by class.
+
+    Both *segments* and *intervals* need to be sorted and
+    non-overlapping. The ids of classes with bases are stored in
+    *touched*, their number is returned.
+    '''
+    cdef Py_ssize_t this_idx = 0
+    cdef Py_ssize_t other_idx = 0
+    cdef Py_ssize_t ntouched = 0
+    cdef int class_id
+    while this_idx < nsegments and other_idx < nintervals:
+        if segments[this_idx].end <= intervals[other_idx].start:
+            this_idx += 1
+        elif intervals[other_idx].end <= segments[this_idx].start:
+            other_idx += 1
+        else:
+            class_id = classes[other_idx]
+            if class_counts[class_id] == 0:
+                touched[ntouched] = class_id
+                ntouched += 1
+            class_counts[class_id] += segment_overlap_raw(
+                segments[this_idx], intervals[other_idx])
+            if segments[this_idx].end < intervals[other_idx].end:
+                this_idx += 1
+            elif intervals[other_idx].end < segments[this_idx].end:
+                other_idx += 1
+            else:
+                this_idx += 1
+                other_idx += 1
+    return ntouched
+
+
+cdef class ElementaryIntervalIndex:
+    '''index of the elementary intervals of all tracks in an
+    :class:`IntervalCollection`.
+
+    Each contig is split at all segment boundaries into elementary
+    intervals. All bases in an elementary interval are covered by
+    the same set of tracks, its class. The number of classes is
+    usually much smaller than the number of tracks times segments
+    in large collections of overlapping annotations.
+
+    Nucleotide overlap of a sample with all tracks is computed by
+    overlapping the sample once with the elementary intervals and
+    distributing the bases per class to the tracks in the class.
+    Only :class:`CounterNucleotideOverlap` and
+    :class:`CounterNucleotideDensity` are supported.
+    '''
+
+    cdef readonly list tracks
+    cdef dict contigs
+    # tracks per class, tracks of class i are
+    # class_tracks[class_offsets[i]:class_offsets[i+1]]
+    cdef numpy.ndarray class_offsets
+    cdef numpy.ndarray class_tracks
+    cdef readonly Py_ssize_t nintervals
+
+    def __init__(self, annotations=None, unreduce=None):
+
+        if unreduce:
+            (self.tracks, self.contigs,
+             self.class_offsets, self.class_tracks) = unreduce
+            self.nintervals = sum([len(v[1]) for v in self.contigs.values()])
+            return
+
+        cdef SegmentList segmentlist
+        cdef numpy.ndarray[numpy.uint32_t, ndim=1] positions
+        cdef numpy.ndarray[numpy.int32_t, ndim=1] labels
+        cdef numpy.ndarray[numpy.uint32_t, ndim=2] segments
+        cdef numpy.ndarray[numpy.int32_t, ndim=1] classes
+        cdef Py_ssize_t x, y, n, nevents
+        cdef Position pos, last_end
+        cdef int label, last_class, class_id
+
+        self.tracks = list(annotations.tracks)
+        self.contigs = {}
+        self.nintervals = 0
+
+        collected = collections.defaultdict(list)
+        for label, track in enumerate(self.tracks):
+            for contig, segmentlist in annotations[track].items():
+                assert segmentlist.isNormalized, \
+                    "non-normalized segment list for %s:%s" % (track, contig)
+                if len(segmentlist) > 0:
+                    collected[contig].append((label, segmentlist))
+
+        class_ids = {}
+        for contig, lists in collected.items():
+            # collect boundaries. Labels of segment ends are stored
+            # as -label - 1.
+            n = sum([len(segmentlist) for label, segmentlist in lists])
+            positions = numpy.empty(2 * n, dtype=numpy.uint32)
+            labels = numpy.empty(2 * n, dtype=numpy.int32)
+            y = 0
+            for label, segmentlist in lists:
+                for x from 0 <= x < segmentlist.nsegments:
+                    positions[y] = segmentlist.segments[x].start
+                    labels[y] = label
+                    positions[y + 1] = segmentlist.segments[x].end
+                    labels[y + 1] = -label - 1
+                    y += 2
+            order = numpy.argsort(positions, kind="mergesort")
+            positions = numpy.ascontiguousarray(positions[order])
+            labels = numpy.ascontiguousarray(labels[order])
+
+            segments = numpy.empty((2 * n, 2), dtype=numpy.uint32)
+            classes = numpy.empty(2 * n, dtype=numpy.int32)
+            active = collections.Counter()
+            nevents = 2 * n
+            x = y = 0
+            last_class = -1
+            last_end = 0
+            while x < nevents:
+                pos = positions[x]
+                while x < nevents and positions[x] == pos:
+                    label = labels[x]
+                    if label >= 0:
+                        active[label] += 1
+                    else:
+                        active[-label - 1] -= 1
+                        if active[-label - 1] == 0:
+                            del active[-label - 1]
+                    x += 1
+                if not active:
+                    continue
+                key = tuple(sorted(active))
+                class_id = class_ids.setdefault(key, len(class_ids))
+                # extend previous interval if it is adjacent
+                # and has the same class
+                if y > 0 and last_end == pos and last_class == class_id:
+                    segments[y - 1, 1] = positions[x]
+                else:
+                    segments[y, 0] = pos
+                    segments[y, 1] = positions[x]
+                    classes[y] = class_id
+                    y += 1
+                last_end = positions[x]
+                last_class = class_id
+
+            self.contigs[contig] = (
+                numpy.ascontiguousarray(segments[:y]),
+                numpy.ascontiguousarray(classes[:y]))
+            self.nintervals += y
+
+        self.class_offsets = numpy.zeros(len(class_ids) + 1, dtype=numpy.int64)
+        for key, class_id in class_ids.items():
+            self.class_offsets[class_id + 1] = len(key)
+        self.class_offsets = numpy.cumsum(self.class_offsets)
+        self.class_tracks = numpy.empty(self.class_offsets[-1],
+                                        dtype=numpy.int32)
+        for key, class_id in class_ids.items():
+            self.class_tracks[self.class_offsets[class_id]:
+                              self.class_offsets[class_id + 1]] = key
+
+    def __reduce__(self):
+        return (buildElementaryIntervalIndex,
+                (self.tracks, self.contigs,
+                 self.class_offsets, self.class_tracks))
+
+    property nclasses:
+        '''number of classes.'''
+        def __get__(self):
+            return len(self.class_offsets) - 1
+
+    def countIntervals(self, contig):
+        '''return the number of elementary intervals on *contig*.'''
+        if contig in self.contigs:
+            return len(self.contigs[contig][1])
+        return 0
+
+    def supports(self, counter):
+        '''return True if *counter* can be computed with this index.'''
+        return getCountMode(counter) in (COUNT_NUCLEOTIDES, COUNT_DENSITY)
+
+    def count(self, counter, SegmentList segments, contig,
+              SegmentList workspace=None):
+        '''count *segments* on *contig* against all tracks
+        with *counter*.
+
+        returns: a numpy array with a count for each track in
+        :attr:`tracks`.
+        '''
+        cdef int mode = getCountMode(counter)
+        if mode != COUNT_NUCLEOTIDES and mode != COUNT_DENSITY:
+            raise ValueError("counter %s not supported by index" %
+                             counter.name)
+        assert segments.isNormalized, "counting non-normalized segment list"
+
+        cdef numpy.ndarray[numpy.uint64_t, ndim=1] counts = \
+            numpy.zeros(len(self.tracks), dtype=numpy.uint64)
+        cdef numpy.ndarray[numpy.uint32_t, ndim=2] intervals
+        cdef numpy.ndarray[numpy.int32_t, ndim=1] classes
+        cdef numpy.ndarray[numpy.int64_t, ndim=1] class_offsets = \
+            self.class_offsets
+        cdef numpy.ndarray[numpy.int32_t, ndim=1] class_tracks = \
+            self.class_tracks
+        cdef uint64_t * c = <uint64_t*>counts.data
+        cdef int64_t * offsets = <int64_t*>class_offsets.data
+        cdef int * tracks = <int*>class_tracks.data
+        cdef uint64_t * class_counts
+        cdef int * touched
+        cdef Py_ssize_t ntouched = 0, x, y, nclasses = self.nclasses
+        cdef Py_ssize_t nintervals
+        cdef int class_id
+
+        if contig in self.contigs and segments.nsegments > 0:
+            intervals, classes = self.contigs[contig]
+            nintervals = len(classes)
+            class_counts = <uint64_t*>calloc(nclasses, sizeof(uint64_t))
+            touched = <int*>malloc(nclasses * sizeof(int))
+            if not class_counts or not touched:
+                free(class_counts)
+                free(touched)
+                raise MemoryError(
+                    "out of memory when allocation %i bytes" %
+                    (nclasses * (sizeof(uint64_t) + sizeof(int))))
+            with nogil:
+                ntouched = countClasses(segments.segments,
+                                        segments.nsegments,
+                                        <Segment*>intervals.data,
+                                        <int*>classes.data,
+                                        nintervals,
+                                        class_counts,
+                                        touched)
+                # distribute bases to tracks
+                for x from 0 <= x < ntouched:
+                    class_id = touched[x]
+                    for y from offsets[class_id] <= y < offsets[class_id + 1]:
+                        c[tracks[y]] += class_counts[class_id]
+            free(class_counts)
+            free(touched)
+
+        if mode == COUNT_DENSITY:
+            if workspace is None or len(workspace) == 0:
+                return numpy.zeros(len(self.tracks), dtype=numpy.float)
+            return counts / float(len(workspace))
+        return counts.astype(numpy.int64)
+
+
+def buildElementaryIntervalIndex(*args):
+    '''pickling helper function.
+
+    Return a re-constructed ElementaryIntervalIndex object.
+    '''
+    return ElementaryIntervalIndex(unreduce=args)
+
+
+cdef class AnnotationIndex:
+    '''index of the segments of all tracks in an
+    :class:`IntervalCollection`.
+
+    The segments of all tracks are combined per contig into a
+    single list sorted by start and labelled with the track they
+    come from. A sample can then be counted against all tracks in a
+    single pass, see :meth:`count`, instead of separately for each
+    track.
+
+    Nucleotide overlaps are counted with an
+    :class:`ElementaryIntervalIndex` if the annotations split into
+    fewer elementary intervals than there are segments, i.e., if
+    tracks overlap substantially. If a sample has few segments
+    compared to the annotations on a contig, nucleotide overlaps
+    are instead computed per track with binary searches and prefix
+    sums (see :class:`PrefixSumIndex`).
+
+    The index is read-only, later changes to the annotations are
+    not reflected.
+    '''
+
+    cdef readonly list tracks
+    cdef dict contigs
+    # segments sorted by track with prefix sums per contig
+    cdef dict prefix_sums
+    cdef readonly ElementaryIntervalIndex elementary
+
+    def __init__(self, annotations=None, unreduce=None):
+
+        if unreduce:
+            (self.tracks, self.contigs,
+             self.prefix_sums, self.elementary) = unreduce
+            return
+
+        cdef SegmentList segmentlist
+        cdef numpy.ndarray[numpy.uint32_t, ndim=2] segments
+        cdef numpy.ndarray[numpy.int32_t, ndim=1] labels
+        cdef numpy.ndarray[numpy.int64_t, ndim=1] offsets
+        cdef Py_ssize_t x, n, search_cost
+        cdef int label
+
+        self.tracks = list(annotations.tracks)
+        self.contigs = {}
+        self.prefix_sums = {}
+
+        collected = collections.defaultdict(list)
+        for label, track in enumerate(self.tracks):
+            for contig, segmentlist in annotations[track].items():
+                assert segmentlist.isNormalized, \
+                    "non-normalized segment list for %s:%s" % (track, contig)
+                if len(segmentlist) > 0:
+                    collected[contig].append((label, segmentlist))
+
+        for contig, lists in collected.items():
+            n = sum([len(segmentlist) for label, segmentlist in lists])
+            segments = numpy.empty((n, 2), dtype=numpy.uint32)
+            labels = numpy.empty(n, dtype=numpy.int32)
+            offsets = numpy.zeros(len(self.tracks) + 1, dtype=numpy.int64)
+            search_cost = 0
+            n = 0
+            for label, segmentlist in lists:
+                for x from 0 <= x < segmentlist.nsegments:
+                    segments[n, 0] = segmentlist.segments[x].start
+                    segments[n, 1] = segmentlist.segments[x].end
+                    labels[n] = label
+                    n += 1
+                offsets[label + 1] = segmentlist.nsegments
+                search_cost += searchCost(segmentlist.nsegments)
+            self.prefix_sums[contig] = (
+                segments,
+                buildCumulative(segments),
+                numpy.cumsum(offsets),
+                search_cost)
+            order = numpy.argsort(segments[:, 0], kind="mergesort")
+            self.contigs[contig] = (
+                numpy.ascontiguousarray(segments[order]),
+                numpy.ascontiguousarray(labels[order]))
+
+        self.elementary = ElementaryIntervalIndex(annotations)
+        if self.elementary.nintervals >= sum(
+                [len(v[1]) for v in self.contigs.values()]):
+            self.elementary = None
+
+    def __reduce__(self):
+        return (buildAnnotationIndex,
+                (self.tracks, self.contigs,
+                 self.prefix_sums, self.elementary))
+
+    def supports(self, counter):
+        '''return True if *counter* can be computed with this index.'''
+        return getCountMode(counter) >= 0
+
+    def count(self, counter, SegmentList segments, contig,
+              SegmentList workspace=None):
+        '''count *segments* on *contig* against all tracks
+        with *counter*.
+
+        returns: a numpy array with a count for each track in
+        :attr:`tracks`.
+        '''
+        return self.countMany([counter], segments, contig, workspace)[0]
+
+    def countMany(self, counters, SegmentList segments, contig,
+                  SegmentList workspace=None):
+        '''count *segments* on *contig* against all tracks
+        with each counter in *counters*.
+
+        All counts are computed together in a single sweep.
+
+        returns: a list with a numpy array for each counter. The
+        arrays contain a count for each track in :attr:`tracks`.
+        '''
+        cdef int mode, modes = 0
+        cdef list count_modes = []
+        for counter in counters:
+            mode = getCountMode(counter)
+            if mode < 0:
+                raise ValueError("counter %s not supported by index" %
+                                 counter.name)
+            if mode == COUNT_DENSITY:
+                mode = COUNT_NUCLEOTIDES
+            modes |= 1 << mode
+            count_modes.append(mode)
+        assert segments.isNormalized, "counting non-normalized segment list"
+
+        cdef Py_ssize_t ntracks = len(self.tracks)
+        cdef numpy.ndarray[numpy.uint64_t, ndim=2] counts = \
+            numpy.zeros((COUNT_ANNOTATION_MIDPOINTS + 1, ntracks),
+                        dtype=numpy.uint64)
+        cdef numpy.ndarray[numpy.uint32_t, ndim=2] annotations
+        cdef numpy.ndarray[numpy.int32_t, ndim=1] labels
+        cdef numpy.ndarray[numpy.uint64_t, ndim=1] cumulative
+        cdef numpy.ndarray[numpy.int64_t, ndim=1] offsets
+        cdef uint64_t * c = <uint64_t*>counts.data
+        cdef Py_ssize_t * active
+        cdef Py_ssize_t * seen
+        cdef Py_ssize_t nannotations, x, search_cost
+        cdef int64_t * o
+
+        if modes & 1 << COUNT_NUCLEOTIDES and \
+           contig in self.prefix_sums and segments.nsegments > 0:
+            annotations, cumulative, offsets, search_cost = \
+                self.prefix_sums[contig]
+            # cost of a single sweep through all annotations
+            # or elementary intervals on this contig
+            if self.elementary is not None:
+                nannotations = self.elementary.countIntervals(contig)
+            else:
+                nannotations = len(annotations)
+            if segments.nsegments * search_cost < \
+               segments.nsegments + nannotations:
+                o = <int64_t*>offsets.data
+                with nogil:
+                    for x from 0 <= x < ntracks:
+                        if o[x] == o[x + 1]:
+                            continue
+                        c[COUNT_NUCLEOTIDES * ntracks + x] = \
+                            overlapWithPrefixSums(
+                                segments.segments,
+                                segments.nsegments,
+                                <Segment*>annotations.data,
+                                <uint64_t*>cumulative.data,
+                                o[x],
+                                o[x + 1])
+                modes &= ~(1 << COUNT_NUCLEOTIDES)
+            elif self.elementary is not None:
+                counts[COUNT_NUCLEOTIDES] = self.elementary.count(
+                    CounterNucleotideOverlap(), segments, contig)
+                modes &= ~(1 << COUNT_NUCLEOTIDES)
+
+        if modes and contig in self.contigs and segments.nsegments > 0:
+            annotations, labels = self.contigs[contig]
+            nannotations = len(labels)
+            active = <Py_ssize_t*>malloc(
+                (nannotations + ntracks) * sizeof(Py_ssize_t))
+            if not active:
+                raise MemoryError(
+                    "out of memory when allocation %i bytes" %
+                    ((nannotations + ntracks) * sizeof(Py_ssize_t)))
+            seen = active + nannotations
+            with nogil:
+                for x from 0 <= x < ntracks:
+                    seen[x] = -1
+                countTracks(segments.segments,
+                            segments.nsegments,
+                            <Segment*>annotations.data,
+                            <int*>labels.data,
+                            nannotations,
+                            modes,
+                            active,
+                            seen,
+                            c,
+                            ntracks)
+            free(active)
+
+        result = []
+        for counter, mode in zip(counters, count_modes):
+            if type(counter) is CounterNucleotideDensity:
+                if workspace is None or len(workspace) == 0:
+                    result.append(numpy.zeros(ntracks, dtype=numpy.float))
+                else:
+                    result.append(counts[mode] / float(len(workspace)))
+            else:
+                result.append(counts[mode].astype(numpy.int64))
+        return result
+
+
+def buildAnnotationIndex(*args):
+    '''pickling helper function.
+
+    Return a re-constructed AnnotationIndex object.
+    '''
+    return AnnotationIndex(unreduce=args)
+
+cdef class CounterFused(Counter):
+    '''compute several counters between two segment lists
+    in a single sweep.
+
+    Calling the object returns a list with a value for each
+    counter in :attr:`counters`. Counters that can not be fused
+    (see :meth:`AnnotationIndex.supports`) are computed separately.
+    '''
+
+    name = "fused"
+
+    cdef readonly list counters
+    cdef int modes
+
+    def __init__(self, counters):
+        cdef int mode
+        self.counters = list(counters)
+        self.modes = 0
+        for counter in self.counters:
+            mode = getCountMode(counter)
+            if mode == COUNT_DENSITY:
+                mode = COUNT_NUCLEOTIDES
+            if mode >= 0:
+                self.modes |= 1 << mode
+
+    def __reduce__(self):
+        return (buildCounterFused, (self.counters,))
+
+    def __call__(self, segments, annotations, workspace=None):
+        '''return a list of counts between *segments* and
+        *annotations*, one for each counter.'''
+
+        if not (isinstance(segments, SegmentList) and
+                isinstance(annotations, SegmentList) and
+                segments.isNormalized and annotations.isNormalized):
+            return [counter(segments, annotations, workspace)
+                    for counter in self.counters]
+
+        cdef SegmentList s = segments
+        cdef SegmentList a = annotations
+        cdef uint64_t counts[COUNT_ANNOTATION_MIDPOINTS + 1]
+        cdef Py_ssize_t * active = NULL
+        cdef Py_ssize_t seen = -1
+        cdef int mode
+
+        memset(counts, 0, sizeof(counts))
+        if self.modes and s.nsegments > 0 and a.nsegments > 0:
+            active = <Py_ssize_t*>malloc(a.nsegments * sizeof(Py_ssize_t))
+            if not active:
+                raise MemoryError(
+                    "out of memory when allocation %i bytes" %
+                    (a.nsegments * sizeof(Py_ssize_t)))
+            with nogil:
+                countTracks(s.segments,
+                            s.nsegments,
+                            a.segments,
+                            NULL,
+                            a.nsegments,
+                            self.modes,
+                            active,
+                            &seen,
+                            counts,
+                            1)
+            free(active)
+
+        result = []
+        for counter in self.counters:
+            mode = getCountMode(counter)
+            if mode < 0:
+                result.append(counter(segments, annotations, workspace))
+            elif mode == COUNT_DENSITY:
+                if len(workspace) == 0:
+                    result.append(0)
+                else:
+                    result.append(
+                        float(counts[COUNT_NUCLEOTIDES]) / len(workspace))
+            else:
+                result.append(counts[mode])
+        return result
+
+
+def buildCounterFused(*args):
+    '''pickling helper function.
+
+    Return a re-constructed CounterFused object.
+    '''
+    return CounterFused(*args)
+
+
 ############################################################
 ############################################################
 ############################################################
@@ -1636,9 +3897,16 @@ cdef EnrichmentStatistics * makeEnrichmentStatistics(observed,
                                                      samples,
                                                      reference,
                                                      pseudo_count):
+    '''compute enrichment statistics.
+
+    *samples* is a contiguous array of doubles. The statistics
+    refer to the memory of *samples* instead of a copy, so the
+    caller needs to keep *samples* alive.
+    '''
 
     cdef EnrichmentStatistics * stats 
     cdef Position offset, i, l
+    cdef double [::1] values
 
     l = len(samples)
     if l < 1:
@@ -1648,13 +3916,13 @@ cdef EnrichmentStatistics * makeEnrichmentStatistics(observed,
     if not stats:
         raise MemoryError("out of memory when allocation %i bytes" % sizeof(EnrichmentStatistics) )
 
-    stats.samples = <double*>calloc( l, sizeof(double))
+    values = samples
+    stats.samples = &values[0]
     stats.sorted2sample = <int*>calloc( l, sizeof(int))
     stats.sample2sorted = <int*>calloc( l, sizeof(int))
 
     stats.observed = observed
     stats.nsamples = l 
-    for i from 0 <= i < l: stats.samples[i] = float(samples[i])
 
     # create index of sorted values
     r = numpy.argsort( samples )
@@ -1748,6 +4016,7 @@ cdef class AnnotatorResult(object):
     cdef:
         EnrichmentStatistics * stats
         str track, annotation, counter
+        object samples_data
 
     def __init__( self,
                   track,
@@ -1760,8 +4029,11 @@ cdef class AnnotatorResult(object):
         self.track = track
         self.annotation = annotation
         self.counter = counter
+        # arrays of counts are used without copying
+        self.samples_data = numpy.ascontiguousarray(samples,
+                                                    dtype=numpy.float64)
         self.stats = makeEnrichmentStatistics(observed, 
-                                              samples,
+                                              self.samples_data,
                                               reference,
                                               pseudo_count)
 
@@ -1794,7 +4066,6 @@ cdef class AnnotatorResult(object):
 
     def __dealloc__(self):
         if self.stats != NULL:
-            free(self.stats.samples)
             free(self.stats.sorted2sample)
             free(self.stats.sample2sorted)
             free(self.stats)
@@ -1833,11 +4104,7 @@ cdef class AnnotatorResult(object):
 
     property samples:
         def __get__(self): 
-            cdef Position x
-            r = numpy.zeros( self.nsamples, dtype = numpy.float )
-            for x from 0 <= x < self.stats.nsamples:
-                r[x] = self.stats.samples[x]
-            return r
+            return numpy.array(self.samples_data)
 
     property format_observed:
         def __set__(self,f): self.format_observed = f
@@ -1914,13 +4181,14 @@ cdef class AnnotatorResultExtended(AnnotatorResult):
         self.annotation_nsegments = annotation_segments.counts()
         self.annotation_size = annotation_segments.sum()
 
-        overlap = track_segments.clone()
-        try:
+        if any([isinstance(x, PositionList)
+                for x in annotation_segments.getSegmentLists()]):
+            # positions within segments
+            overlap = annotation_segments.clone()
+            overlap.intersect(track_segments)
+        else:
+            overlap = track_segments.clone()
             overlap.intersect(annotation_segments)
-        except TypeError:
-            # TODO: intersection between SegmentList with PositionList
-            # needs still to be implemented.
-            pass
 
         self.overlap_nsegments = overlap.counts()
         self.overlap_size = overlap.sum()
@@ -2197,9 +4465,59 @@ def computeCounts(counter,
 
             temp_segs, temp_annos, temp_workspace = workspace_generator(
                 segs, annos, workspace)
-            vals = [counter(segs[isochore], annos[isochore], workspace[isochore])
-                    for isochore in isochores ]
-            f(counts, track, annotation, aggregator(vals))
+            f(counts, track, annotation,
+              counter.countContigs(segs, annos, workspace,
+                                   isochores, aggregator))
+
+    return counts
+
+def computeMultipleCounts(counters,
+                          aggregator,
+                          segments,
+                          annotations,
+                          workspace,
+                          workspace_generator,
+                          append=False):
+    '''collect counts from each counter in *counters* between all
+    combinations of *segments* and *annotations*.
+
+    The built-in counters are computed together with a
+    :class:`CounterFused`.
+
+    returns: a list with the counts for each counter as
+    returned by :func:`computeCounts`.
+    '''
+
+    if append:
+        counts = [collections.defaultdict(list) for counter in counters]
+        f = _append
+    else:
+        counts = [collections.defaultdict(_defdictfloat)
+                  for counter in counters]
+        f = _set
+
+    fused_ids = [x for x, counter in enumerate(counters)
+                 if getCountMode(counter) >= 0]
+    fused = CounterFused([counters[x] for x in fused_ids])
+    isochores = workspace.keys()
+
+    for track in segments.tracks:
+        segs = segments[track]
+
+        for annotation in annotations.tracks:
+            annos = annotations[annotation]
+
+            temp_segs, temp_annos, temp_workspace = workspace_generator(
+                segs, annos, workspace)
+            vals = [fused(segs[isochore], annos[isochore], workspace[isochore])
+                    for isochore in isochores]
+            for x, counter in enumerate(counters):
+                if x in fused_ids:
+                    value = aggregator([v[fused_ids.index(x)] for v in vals])
+                else:
+                    value = counter.countContigs(segs, annos, workspace,
+                                                 isochores, aggregator)
+                f(counts[x], track, annotation, value)
 
     return counts
 
@@ -2634,12 +4952,34 @@ cdef class IntervalContainer(object):
         if mm == <void *>-1:
             raise ValueError("could not create memory mapped file")
 
-        # copy all segment lists to shared memory
+        # copy all segment lists to shared memory and record
+        # their location for other processes to attach to
         cdef off_t offset = 0
         cdef CoordinateList clist
-        for clist in self.getSegmentLists():
+        self.shared_layout = []
+        for key, clist in self.getSegmentListItems():
+            if isinstance(clist, SegmentList):
+                flag = (<SegmentList>clist).flag
+            else:
+                flag = ((<PositionList>clist).is_sorted,
+                        (<PositionList>clist).is_normalized)
+            self.shared_layout.append(
+                (key, clist.__class__.__name__, offset, len(clist), flag))
             offset = clist.toMMAP(mm, fd, offset)
-        
+
+    def getManifest(self):
+        '''return a manifest of the data in shared memory.
+
+        The manifest can be pickled and used by other processes
+        to attach to the shared data with :func:`attachIntervals`.
+        '''
+        assert self.shared_fd != -1, "manifest of unshared container"
+        return (self.__class__.__name__,
+                self.name,
+                self.shared_fn,
+                self.counts() * sizeof(Segment),
+                self.shared_layout)
+
     def __dealloc__(self):
 
         cdef int error
@@ -2684,7 +5024,7 @@ cdef class IntervalContainer(object):
         # munmap( self.mmap, 
         #        self.mmap_bytes)
                 
-        fn = self.shared_fn 
+        fn = force_bytes(self.shared_fn)
         fd = shm_unlink(fn)
         error = errno
         if fd == -1:
@@ -2696,6 +5036,7 @@ cdef class IntervalContainer(object):
                     "at %s" % self.shared_fn)
         
         self.shared_fd = -1
+        self.shared_layout = None
 
     def sum(self):
         '''return sum of all segment lists.'''
@@ -2764,9 +5105,17 @@ cdef class IntervalDictionary(IntervalContainer):
         for contig, segmentlist in self.intervals.items():
             yield segmentlist
 
+    def getSegmentListItems(self):
+        '''yield tuples of (key, segmentlist) for all segment lists.
+
+        The key is a tuple of (contig,).
+        '''
+        for contig, segmentlist in self.intervals.items():
+            yield (contig,), segmentlist
+
     def intersect(self, other):
         '''intersect with intervals in other.'''
-        for contig, segmentlist in self.intervals.items():
+        for contig, segmentlist in list(self.intervals.items()):
             if contig in other:
                 segmentlist.intersect(other[contig])
             else:
@@ -2906,6 +5255,15 @@ cdef class IntervalCollection(IntervalContainer):
             for contig, segmentlist in v.items():
                 yield segmentlist
 
+    def getSegmentListItems(self):
+        '''yield tuples of (key, segmentlist) for all segment lists.
+
+        The key is a tuple of (track, contig).
+        '''
+        for track, v in self.intervals.items():
+            for contig, segmentlist in v.items():
+                yield (track, contig), segmentlist
+
     def load(self, filenames, allow_multiple=False, ignore_tracks=False):
         '''load segments from filenames.'''
         self.intervals = readFromBed(filenames,
@@ -3054,6 +5412,54 @@ cdef class IntervalCollection(IntervalContainer):
                 else:
                     del vv[contig]
 
+    def getAliases(self):
+        '''return a dictionary mapping each track to the first
+        track with identical intervals.
+
+        Tracks are grouped by a fingerprint of the segments on each
+        non-empty contig and then compared. Tracks with intervals
+        that are not :class:`SegmentList` map to themselves.
+        '''
+        cdef SegmentList segmentlist
+        aliases = {}
+        representatives = collections.defaultdict(list)
+        for track, vv in self.intervals.items():
+            contigs = sorted([contig for contig, x in vv.items()
+                              if len(x) > 0])
+            if not all([isinstance(vv[contig], SegmentList)
+                        for contig in contigs]):
+                aliases[track] = track
+                continue
+
+            fingerprint = hashlib.sha1()
+            for contig in contigs:
+                segmentlist = vv[contig]
+                fingerprint.update(force_bytes(contig) + b"\0")
+                fingerprint.update(PyBytes_FromStringAndSize(
+                    <char*>segmentlist.segments,
+                    segmentlist.nsegments * sizeof(Segment)))
+            key = fingerprint.digest()
+
+            aliases[track] = track
+            for other in representatives[key]:
+                if all([vv[contig] == self.intervals[other][contig]
+                        for contig in contigs]):
+                    aliases[track] = other
+                    break
+            else:
+                representatives[key].append(track)
+        return aliases
+
+    def subset(self, tracks):
+        '''return a new collection with *tracks*.
+
+        The segment lists are not copied.
+        '''
+        cdef IntervalCollection result = IntervalCollection(self.name)
+        for track in tracks:
+            result.intervals[track] = self.intervals[track]
+        return result
+
     def restrict(self, restrict):
         '''remove all tracks except those in restrict.'''
         if restrict in (list, tuple, set):
@@ -3151,6 +5557,57 @@ def buildIntervalCollection(*args):
     return IntervalCollection(unreduce=args)
 
 
+def attachIntervals(manifest):
+    '''return an interval container using the data in shared memory
+    described by *manifest* (see :meth:`IntervalContainer.getManifest`).
+
+    The memory is mapped copy-on-write, modifications of the
+    intervals remain private to the calling process. The memory stays
+    mapped for the lifetime of the process.
+    '''
+    container_type, name, filename, nbytes, layout = manifest
+
+    if container_type == "IntervalCollection":
+        container = IntervalCollection(name)
+    else:
+        container = IntervalDictionary(name)
+
+    cdef void * mm = NULL
+    cdef int fd
+    if nbytes > 0:
+        f = force_bytes(filename)
+        fd = shm_open(f, O_RDONLY, 0)
+        if fd == -1:
+            error = errno
+            raise OSError("could not open shared memory at %s; "
+                          "ERRNO=%i" % (filename, error))
+        mm = mmap(NULL, nbytes, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0)
+        error = errno
+        close(fd)
+        if mm == <void *>-1:
+            raise OSError("could not map shared memory at %s; "
+                          "ERRNO=%i" % (filename, error))
+
+    cdef SegmentList segmentlist
+    cdef PositionList positionlist
+    for key, list_type, offset, n, flag in layout:
+        if list_type == "SegmentList":
+            segmentlist = SegmentList()
+            segmentlist.flag = flag
+            if n > 0:
+                segmentlist.attachMMAP(mm, offset, n)
+            clist = segmentlist
+        else:
+            positionlist = PositionList()
+            positionlist.is_sorted, positionlist.is_normalized = flag
+            if n > 0:
+                positionlist.attachMMAP(mm, offset, n)
+            clist = positionlist
+        container.add(*(key + (clist,)))
+
+    return container
+
+
 cdef class Samples(object):
     '''a collection of samples.
 
@@ -36,6 +36,7 @@ cdef class PositionList(CoordinateList):
         self, Position start, Position end)
     cpdef Position intersectionWithSegments(
         self, SegmentList other, mode = *)
+    cpdef Position overlapWithSegments(self, SegmentList other)
     cpdef void intersect(self, SegmentList other)
     cpdef PositionList clone(self)
 
@@ -48,3 +49,4 @@ cdef class PositionList(CoordinateList):
     # Functions overloaded from CoordinateList
     cdef off_t toMMAP(self, void *, int, off_t)
     cdef void fromMMAP(self)
+    cdef void attachMMAP(self, void *, off_t, size_t)
@@ -6,7 +6,7 @@ cimport cython
 from cpython.bytes cimport PyBytes_AsString, PyBytes_FromStringAndSize
 from cpython cimport PyBytes_Check, PyUnicode_Check
 from libc.stdlib cimport qsort, calloc, malloc, realloc, free
-from libc.string cimport memcpy
+from libc.string cimport memcpy, memmove
 from libc.errno cimport errno
 from posix.types cimport off_t
 from posix.mman cimport mmap, munmap, shm_open, shm_unlink
@@ -14,7 +14,7 @@ from posix.mman cimport MAP_SHARED, PROT_READ, PROT_WRITE
 from posix.stat cimport S_IRUSR, S_IWUSR
 from posix.fcntl cimport O_CREAT, O_RDWR, O_RDONLY
 
-from SegmentList cimport Position, Segment, SegmentList
+from SegmentList cimport Position, Segment, SegmentList, gallopEnd
 
 cdef bytes force_bytes(object s, encoding="ascii"):
     """convert string or unicode object to bytes, assuming
@@ -38,6 +38,60 @@ cdef extern from *:
 cdef int cmpPosition(const_void_ptr s1, const_void_ptr s2) nogil: 
     return (<Position*>s1)[0] - (<Position*>s2)[0]
 
+cdef inline Py_ssize_t gallopPosition(Position * positions,
+                                      Py_ssize_t lo,
+                                      Py_ssize_t hi,
+                                      Position pos) nogil:
+    '''return index of first position in *lo* to *hi* at or
+    after *pos*.
+
+    The search is exponential from *lo* before bisecting.
+    '''
+    cdef Py_ssize_t bound = 1, mid
+    while lo + bound < hi and positions[lo + bound] < pos:
+        bound *= 2
+    if lo + bound < hi:
+        hi = lo + bound
+    lo += bound // 2
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if positions[mid] < pos:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+cdef Py_ssize_t findPositionsInSegments(Position * positions,
+                                        Py_ssize_t npositions,
+                                        Segment * segments,
+                                        Py_ssize_t nsegments,
+                                        Position * result) nogil:
+    '''return the number of sorted *positions* within sorted,
+    non-overlapping *segments*.
+
+    The range of positions within each segment is found with two
+    searches. Segments without positions and runs of positions
+    outside segments are skipped with exponential searches. The
+    cost is thus determined by the smaller of the two lists.
+
+    If *result* is not NULL, the positions within segments are
+    stored in it. *result* may be *positions*.
+    '''
+    cdef Py_ssize_t x = 0, lo = 0, hi, n = 0
+    while x < nsegments and lo < npositions:
+        # skip segments ending at or before the next position
+        x = gallopEnd(segments, x, nsegments, positions[lo])
+        if x == nsegments:
+            break
+        lo = gallopPosition(positions, lo, npositions, segments[x].start)
+        hi = gallopPosition(positions, lo, npositions, segments[x].end)
+        if result != NULL and hi > lo:
+            memmove(result + n, positions + lo, (hi - lo) * sizeof(Position))
+        n += hi - lo
+        lo = hi
+        x += 1
+    return n
+
 
 cdef class PositionList:
     '''list of segments.
@@ -512,33 +566,33 @@ cdef class PositionList:
         assert self.is_sorted, "Intersection from unsorted positions"
         assert other.isNormalized, "Intersection with non-normalized segments"
 
-        cdef int this_idx, other_idx, last_this_idx, last_other_idx
-        this_idx = other_idx = 0
-        last_this_idx = last_other_idx = -1
-        cdef Position this_position = -1
-        cdef Segment other_segment = Segment(0,0)
-        cdef Position noverlap = 0
-
-        while this_idx < self.npositions and other_idx < other.nsegments:
-            if last_this_idx != this_idx:
-                this_position = self.positions[this_idx]
-                last_this_idx = this_idx
-            if last_other_idx != other_idx:
-                other_segment = other.segments[other_idx]
-                last_other_idx = other_idx
-
-            # skip segments in this not overlapping other
-            if this_position < other_segment.start:
-                this_idx += 1
-            # skip segments in other not overlapping this
-            elif other_segment.end <= this_position:
-                other_idx += 1
-            else:
-                noverlap += 1
-                this_idx += 1
-
+        cdef Position noverlap
+        with nogil:
+            noverlap = findPositionsInSegments(self.positions,
+                                               self.npositions,
+                                               other.segments,
+                                               other.nsegments,
+                                               NULL)
         return noverlap
 
+    cpdef Position overlapWithSegments(self, SegmentList other):
+        """return number of nucleotides overlapping with *other*.
+
+        Each position covers a single nucleotide, thus this
+        is the number of positions within *other*.
+
+        Arguments
+        ---------
+        other : SegmentList
+             SegmentList to overlap with
+
+        Returns
+        -------
+        overlap : int
+            Number of positions
+        """
+        return self.intersectionWithSegments(other)
+
     cpdef void intersect(self, SegmentList other):
         '''intersect this position list with a SegmentList.
 
@@ -556,33 +610,12 @@ cdef class PositionList:
             self.clear()
             return
 
-        cdef int this_idx, other_idx, last_this_idx, last_other_idx, working_idx
-        this_idx = other_idx = working_idx = 0
-        last_this_idx = last_other_idx = -1
-        cdef Position this_position = -1
-        cdef Segment other_segment = Segment(0,0)
-        cdef Position noverlap = 0
-
-        while this_idx < self.npositions and other_idx < other.nsegments:
-            if last_this_idx != this_idx:
-                this_position = self.positions[this_idx]
-                last_this_idx = this_idx
-            if last_other_idx != other_idx:
-                other_segment = other.segments[other_idx]
-                last_other_idx = other_idx
-
-            # skip segments in this not overlapping other
-            if this_position < other_segment.start:
-                this_idx += 1
-            # skip segments in other not overlapping this
-            elif other_segment.end <= this_position:
-                other_idx += 1
-            else:
-                self.positions[working_idx] = this_position
-                working_idx += 1
-                this_idx += 1
-
-        self.npositions = working_idx
+        with nogil:
+            self.npositions = findPositionsInSegments(self.positions,
+                                                      self.npositions,
+                                                      other.segments,
+                                                      other.nsegments,
+                                                      self.positions)
 
     def __str__(self):
         return str(self.asList())
@@ -678,6 +711,24 @@ cdef class PositionList:
 
         return offset + self.npositions
 
+    cdef void attachMMAP(self,
+                         void * mmap,
+                         off_t offset,
+                         size_t n):
+        '''use the *n* positions in shared memory at *mmap*
+        with *offset* as contents of the list.
+
+        The list becomes a slave of the shared memory.
+        '''
+        if self.positions != NULL and not self.is_shared:
+            free(self.positions)
+
+        self.positions = <Position *>mmap + offset
+        self.npositions = n
+        self.allocated = 0
+        self.is_shared = True
+        self.is_slave = True
+
 def buildPositionList(*args):
     '''pickling helper function.
     
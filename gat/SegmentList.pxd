@@ -37,6 +37,80 @@ cdef struct Segment:
     Position start
     Position end
 
+#####################################################
+#####################################################
+## searching in sorted, non-overlapping segments
+#####################################################
+# True if merging lists of the given sizes should gallop
+cdef bint useGallop(size_t a, size_t b) nogil
+
+# number of nucleotides overlapping between two lists
+cdef Position overlapSegmentArrays(Segment * segments,
+                                   Py_ssize_t nsegments,
+                                   Segment * other,
+                                   Py_ssize_t nother) nogil
+
+# number of segments overlapping with another list
+cdef Position intersectSegmentArrays(Segment * segments,
+                                     Py_ssize_t nsegments,
+                                     Segment * other,
+                                     Py_ssize_t nother,
+                                     bint midpoint) nogil
+
+cdef inline Py_ssize_t searchEnd(Segment * segments,
+                                 Py_ssize_t lo,
+                                 Py_ssize_t hi,
+                                 Position pos) nogil:
+    '''return index of first segment in *lo* to *hi* ending
+    after *pos*.'''
+    cdef Py_ssize_t mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if segments[mid].end <= pos:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+cdef inline Py_ssize_t searchStart(Segment * segments,
+                                   Py_ssize_t lo,
+                                   Py_ssize_t hi,
+                                   Position pos) nogil:
+    '''return index of first segment in *lo* to *hi* starting
+    at or after *pos*.'''
+    cdef Py_ssize_t mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if segments[mid].start < pos:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+cdef inline Py_ssize_t gallopEnd(Segment * segments,
+                                 Py_ssize_t lo,
+                                 Py_ssize_t hi,
+                                 Position pos) nogil:
+    '''as :func:`searchEnd`, but search exponentially from *lo*
+    before bisecting. Faster if the result is close to *lo*.'''
+    cdef Py_ssize_t bound = 1
+    while lo + bound < hi and segments[lo + bound].end <= pos:
+        bound *= 2
+    return searchEnd(segments, lo + bound // 2,
+                     lo + bound if lo + bound < hi else hi, pos)
+
+cdef inline Py_ssize_t gallopStart(Segment * segments,
+                                   Py_ssize_t lo,
+                                   Py_ssize_t hi,
+                                   Position pos) nogil:
+    '''as :func:`searchStart`, but search exponentially from *lo*
+    before bisecting. Faster if the result is close to *lo*.'''
+    cdef Py_ssize_t bound = 1
+    while lo + bound < hi and segments[lo + bound].start < pos:
+        bound *= 2
+    return searchStart(segments, lo + bound // 2,
+                       lo + bound if lo + bound < hi else hi, pos)
+
 #####################################################
 #####################################################
 ## definition of segmentlist
@@ -95,4 +169,5 @@ cdef class SegmentList(CoordinateList):
     # Functions overloaded from CoordinateList
     cdef off_t toMMAP(self, void *, int, off_t)
     cdef void fromMMAP(self)
+    cdef void attachMMAP(self, void *, off_t, size_t)
 
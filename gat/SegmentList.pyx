@@ -143,6 +143,110 @@ DEF SEG_NORMALIZED = 1
 DEF SEG_SHARED = 2
 DEF SEG_SLAVE = 4
 
+# Minimum size ratio between two lists for galloping
+# through the larger list when merging, see test/benchmark_SegmentList.py
+cdef int GALLOP_RATIO = 16
+
+def setGallopRatio(int ratio):
+    '''set the minimum size ratio between two lists for galloping.
+
+    A ratio of 0 always gallops. Returns the previous ratio.
+    '''
+    global GALLOP_RATIO
+    previous = GALLOP_RATIO
+    GALLOP_RATIO = ratio
+    return previous
+
+cdef bint useGallop(size_t a, size_t b) nogil:
+    '''return True if merging lists of sizes *a* and *b* should
+    gallop over non-overlapping runs.'''
+    return a > GALLOP_RATIO * b or b > GALLOP_RATIO * a
+
+cdef Position overlapSegmentArrays(Segment * segments,
+                                   Py_ssize_t nsegments,
+                                   Segment * other,
+                                   Py_ssize_t nother) nogil:
+    '''return the number of nucleotides overlapping between
+    two sorted arrays of non-overlapping segments.
+
+    See :meth:`SegmentList.overlapWithSegments`.
+    '''
+    cdef Py_ssize_t this_idx = 0
+    cdef Py_ssize_t other_idx = 0
+    cdef Position overlap = 0
+    # gallop over runs of segments if list sizes differ
+    cdef bint gallop = useGallop(nsegments, nother)
+
+    while this_idx < nsegments and other_idx < nother:
+        # skip segments in this not overlapping other
+        if segments[this_idx].end <= other[other_idx].start:
+            if gallop:
+                this_idx = gallopEnd(segments, this_idx, nsegments,
+                                     other[other_idx].start)
+            else:
+                this_idx += 1
+        # skip segments in other not overlapping this
+        elif other[other_idx].end <= segments[this_idx].start:
+            if gallop:
+                other_idx = gallopEnd(other, other_idx, nother,
+                                      segments[this_idx].start)
+            else:
+                other_idx += 1
+        else:
+            overlap += segment_overlap_raw(segments[this_idx],
+                                           other[other_idx])
+            if segments[this_idx].end < other[other_idx].end:
+                this_idx += 1
+            elif other[other_idx].end < segments[this_idx].end:
+                other_idx += 1
+            else:
+                this_idx += 1
+                other_idx += 1
+    return overlap
+
+cdef Position intersectSegmentArrays(Segment * segments,
+                                     Py_ssize_t nsegments,
+                                     Segment * other,
+                                     Py_ssize_t nother,
+                                     bint midpoint) nogil:
+    '''return the number of segments in *segments* overlapping
+    with *other*. Both need to be sorted and non-overlapping.
+
+    If *midpoint* is set, only segments with their midpoint
+    in the first overlapping segment in *other* are counted.
+
+    See :meth:`SegmentList.intersectionWithSegments`.
+    '''
+    cdef Py_ssize_t this_idx = 0
+    cdef Py_ssize_t other_idx = 0
+    cdef Position noverlap = 0
+    # gallop over runs of segments if list sizes differ
+    cdef bint gallop = useGallop(nsegments, nother)
+
+    while this_idx < nsegments and other_idx < nother:
+        # skip segments in this not overlapping other
+        if segments[this_idx].end <= other[other_idx].start:
+            if gallop:
+                this_idx = gallopEnd(segments, this_idx, nsegments,
+                                     other[other_idx].start)
+            else:
+                this_idx += 1
+        # skip segments in other not overlapping this
+        elif other[other_idx].end <= segments[this_idx].start:
+            if gallop:
+                other_idx = gallopEnd(other, other_idx, nother,
+                                      segments[this_idx].start)
+            else:
+                other_idx += 1
+        else:
+            if not midpoint or other[other_idx].start <= \
+               segments[this_idx].start + \
+               (segments[this_idx].end - segments[this_idx].start) // 2 \
+               < other[other_idx].end:
+                noverlap += 1
+            this_idx += 1
+    return noverlap
+
 cdef class SegmentList:
     '''list of segments.
 
@@ -475,11 +579,37 @@ cdef class SegmentList:
 
         return offset + self.nsegments
 
+    cdef void attachMMAP(self,
+                         void * mmap,
+                         off_t offset,
+                         size_t n):
+        '''use the *n* segments in shared memory at *mmap*
+        with *offset* as contents of the list.
+
+        The list becomes a slave of the shared memory.
+        '''
+        if self.segments != NULL and not self.is_shared:
+            free(self.segments)
+
+        self.segments = <Segment *>mmap + offset
+        self.nsegments = n
+        self.allocated = 0
+        self.is_shared = True
+        self.is_slave = True
+
     cpdef sort(self):
         '''sort segments.'''
+        cdef size_t idx
         if self.nsegments == 0:
             return
 
+        # skip sorting if already sorted
+        for idx from 1 <= idx < self.nsegments:
+            if self.segments[idx-1].start > self.segments[idx].start:
+                break
+        else:
+            return
+
         qsort(<void*>self.segments,
               self.nsegments,
               sizeof(Segment),
@@ -1036,43 +1166,12 @@ cdef class SegmentList:
         if other.segments == self.segments:
             return self.sum()
 
-        cdef int this_idx, other_idx, working_idx, last_this_idx, last_other_idx
-        this_idx = other_idx = 0
-        last_this_idx = last_other_idx = -1
-        cdef Segment this_segment = Segment(0,0)
-        cdef Segment other_segment = Segment(0,0)
-
         cdef Position overlap
-        overlap = 0
-
-        while this_idx < self.nsegments and other_idx < other.nsegments:
-
-            # print "this=", this_idx, self.nsegments, "other=", other_idx, other.nsegments
-            if last_this_idx != this_idx:
-                this_segment = self.segments[this_idx]
-                last_this_idx = this_idx
-            if last_other_idx != other_idx:
-                other_segment = other.segments[other_idx]
-                last_other_idx = other_idx
-
-            # print this_segment, other_segment
-            # skip segments in this not overlapping other
-            if this_segment.end <= other_segment.start:
-                this_idx += 1
-            # skip segments in other not overlapping this
-            elif other_segment.end <= this_segment.start:
-                other_idx += 1
-            else:
-                # deal with overlap
-                overlap += segment_overlap_raw(this_segment, other_segment)
-                if this_segment.end < other_segment.end:
-                    this_idx += 1
-                elif other_segment.end < this_segment.end:
-                    other_idx += 1
-                else:
-                    this_idx += 1
-                    other_idx += 1
-
+        with nogil:
+            overlap = overlapSegmentArrays(self.segments,
+                                           self.nsegments,
+                                           other.segments,
+                                           other.nsegments)
         return overlap
 
     cpdef Position intersectionWithSegments(
@@ -1105,44 +1204,14 @@ cdef class SegmentList:
         # avoid self-self comparison
         if other.segments == self.segments: return self.sum()
 
-        cdef int this_idx, other_idx, last_this_idx, last_other_idx
-        this_idx = other_idx = 0
-        last_this_idx = last_other_idx = -1
-        cdef Segment this_segment = Segment(0,0)
-        cdef Segment other_segment = Segment(0,0)
-
-        cdef int midpoint_overlap = mode == "midpoint"
-
+        cdef bint midpoint_overlap = mode == "midpoint"
         cdef Position noverlap
-        noverlap = 0
-
-        while this_idx < self.nsegments and other_idx < other.nsegments:
-
-            # print "this=", this_idx, self.nsegments, "other=", other_idx, other.nsegments
-            if last_this_idx != this_idx:
-                this_segment = self.segments[this_idx]
-                last_this_idx = this_idx
-            if last_other_idx != other_idx:
-                other_segment = other.segments[other_idx]
-                last_other_idx = other_idx
-
-            # skip segments in this not overlapping other
-            if this_segment.end <= other_segment.start:
-                this_idx += 1
-            # skip segments in other not overlapping this
-            elif other_segment.end <= this_segment.start:
-                other_idx += 1
-            else:
-                # deal with overlap
-                if midpoint_overlap:
-                    if other_segment.start <= this_segment.start + \
-                       (this_segment.end - this_segment.start) // 2 \
-                            < other_segment.end:
-                        noverlap += 1
-                else:
-                    noverlap += 1
-                this_idx += 1
-
+        with nogil:
+            noverlap = intersectSegmentArrays(self.segments,
+                                              self.nsegments,
+                                              other.segments,
+                                              other.nsegments,
+                                              midpoint_overlap)
         return noverlap
 
     def getLengthDistribution( self, bucket_size = 0, nbuckets = 100000):
@@ -1226,6 +1295,9 @@ cdef class SegmentList:
         last_this_idx = last_other_idx = -1
         cdef Segment this_segment = Segment(0,0)
         cdef Segment other_segment = Segment(0,0)
+        # gallop over runs of segments if list sizes differ
+        cdef bint gallop = useGallop(self.nsegments, other.nsegments)
+        cdef Py_ssize_t idx
 
         cdef Segment * new_segments
         cdef size_t allocated
@@ -1260,9 +1332,27 @@ cdef class SegmentList:
                     new_segments[working_idx] = this_segment
                     working_idx += 1
                 this_idx += 1
+                if gallop:
+                    # copy run of segments not overlapping other
+                    idx = gallopEnd(self.segments, this_idx,
+                                    self.nsegments, other_segment.start)
+                    if working_idx + idx - this_idx >= allocated:
+                        allocated = 2 * (working_idx + idx - this_idx)
+                        new_segments = <Segment*>realloc(
+                            new_segments, allocated * sizeof(Segment))
+                        assert new_segments != NULL
+                    memcpy(new_segments + working_idx,
+                           self.segments + this_idx,
+                           (idx - this_idx) * sizeof(Segment))
+                    working_idx += idx - this_idx
+                    this_idx = idx
             # skip segments in other not overlapping this
             elif other_segment.end <= this_segment.start:
-                other_idx += 1
+                if gallop:
+                    other_idx = gallopEnd(other.segments, other_idx,
+                                          other.nsegments, this_segment.start)
+                else:
+                    other_idx += 1
             else:
                 # deal with overlap
                 if this_segment.start < other_segment.start:
@@ -1271,13 +1361,27 @@ cdef class SegmentList:
                     new_segments[working_idx].end = other_segment.start
                     working_idx += 1
 
-                this_segment.start = other_segment.end
+                # other might overlap following segments in this
+                if other_segment.end >= this_segment.end:
+                    this_idx += 1
+                else:
+                    this_segment.start = other_segment.end
+
+        # output remaining segments, the current one might be truncated
+        while this_idx < self.nsegments:
+            if working_idx >= allocated:
+                allocated *= 2
+                new_segments = <Segment*>realloc(new_segments, allocated * sizeof(Segment))
+                assert new_segments != NULL
+
+            if last_this_idx != this_idx:
+                this_segment = self.segments[this_idx]
+                last_this_idx = this_idx
 
-        # output last
-        if this_segment.start < this_segment.end:
-            new_segments[working_idx].start = this_segment.start
-            new_segments[working_idx].end = this_segment.end
-            working_idx += 1
+            if this_segment.start < this_segment.end:
+                new_segments[working_idx] = this_segment
+                working_idx += 1
+            this_idx += 1
 
         free(self.segments)
         self.segments = new_segments
@@ -1425,6 +1529,8 @@ cdef class SegmentList:
         last_this_idx = last_other_idx = -1
         cdef Segment this_segment = Segment(0,0)
         cdef Segment other_segment = Segment(0,0)
+        # gallop over runs of segments if list sizes differ
+        cdef bint gallop = useGallop(self.nsegments, other.nsegments)
         # for negative segments, do not use -1
         cdef Position last_start = self.segments[0].start - 1
 
@@ -1441,10 +1547,18 @@ cdef class SegmentList:
             # print this_segment, other_segment
             # skip segments in this not overlapping other
             if this_segment.end <= other_segment.start:
-                this_idx += 1
+                if gallop:
+                    this_idx = gallopEnd(self.segments, this_idx,
+                                         self.nsegments, other_segment.start)
+                else:
+                    this_idx += 1
             # skip segments in other not overlapping this
             elif other_segment.end <= this_segment.start:
-                other_idx += 1
+                if gallop:
+                    other_idx = gallopEnd(other.segments, other_idx,
+                                          other.nsegments, this_segment.start)
+                else:
+                    other_idx += 1
             else:
                 # deal with overlap
                 if last_start != this_segment.start:
@@ -1504,6 +1618,8 @@ cdef class SegmentList:
         last_this_idx = last_other_idx = -1
         cdef Segment this_segment = Segment(0,0)
         cdef Segment other_segment = Segment(0,0)
+        # gallop over runs of segments if list sizes differ
+        cdef bint gallop = useGallop(self.nsegments, other.nsegments)
 
         while this_idx < self.nsegments and other_idx < other.nsegments:
 
@@ -1518,10 +1634,18 @@ cdef class SegmentList:
             # print this_segment, other_segment
             # skip segments in this not overlapping other
             if this_segment.end <= other_segment.start:
-                this_idx += 1
+                if gallop:
+                    this_idx = gallopEnd(self.segments, this_idx,
+                                         self.nsegments, other_segment.start)
+                else:
+                    this_idx += 1
             # skip segments in other not overlapping this
             elif other_segment.end <= this_segment.start:
-                other_idx += 1
+                if gallop:
+                    other_idx = gallopEnd(other.segments, other_idx,
+                                          other.nsegments, this_segment.start)
+                else:
+                    other_idx += 1
             else:
                 # deal with overlap
                 new_segments[working_idx].start = lmax(this_segment.start,
@@ -2,7 +2,6 @@ import os
 import re
 import optparse
 import collections
-import gzip
 import numpy
 
 import gat.Bed as Bed
@@ -11,10 +10,17 @@ import gat.Experiment as E
 import gat.Stats as Stats
 import gat.IO as IO
 
+import gat.SegmentList as SegmentList
 import gat.Engine as Engine
 
 import multiprocessing.pool
 import multiprocessing
+import concurrent.futures
+import threading
+import pickle
+import hashlib
+import shutil
+import tempfile
 
 
 def readFromBedOld(filenames, name="track"):
@@ -218,10 +224,18 @@ def buildParser(usage=None):
                  "segment-overlap",
                  "segment-midoverlap",
                  "annotation-overlap",
-                 "annotation-midoverlap"),
+                 "annotation-midoverlap",
+                 "distance-mean",
+                 "distance-median",
+                 "distance-within"),
         help="quantity to use for estimating enrichment "
         "[default=%default].")
 
+    group.add_option(
+        "--distance-threshold", dest="distance_threshold", type="int",
+        help="maximum distance of a segment to the closest annotation "
+        "for the distance-within counter [default=%default].")
+
     group.add_option(
         "-m", "--sampler", dest="sampler", type="choice",
         choices=("annotator",
@@ -253,6 +267,14 @@ def buildParser(usage=None):
         "to determine the size of the region for "
         "shifthing [default=%default].")
 
+    group.add_option(
+        "--free-gaps", dest="free_gaps", action="store_true",
+        help="if the sampling method is 'brute-force', place segments "
+        "directly into free gaps of the workspace instead of rejecting "
+        "positions overlapping previously sampled segments. Segments "
+        "are placed fully within the workspace and the last segment "
+        "is shortened [default=%default].")
+
     group.add_option(
         "--bucket-size", dest="bucket_size", type="int",
         help="size of a bin for histogram of segment lengths. "
@@ -262,7 +284,8 @@ def buildParser(usage=None):
     group.add_option(
         "--nbuckets", dest="nbuckets", type="int",
         help="number of bins for histogram of segment "
-        "lengths [default=%default]")
+        "lengths. If 0, segment lengths are sampled exactly "
+        "from the observed lengths [default=%default]")
 
     parser.add_option_group(group)
 
@@ -324,11 +347,39 @@ def buildParser(usage=None):
         help="number of threads to use for sampling "
         "[default=%default]")
 
+    group.add_option(
+        "--parallel-backend", dest="parallel_backend", type="choice",
+        choices=("processes", "threads"),
+        help="how to run samples in parallel if --num-threads is set. "
+        "*processes* - a pool of processes sharing data through "
+        "shared memory, "
+        "*threads* - a pool of threads within a single process "
+        "[default=%default].")
+
+    group.add_option(
+        "--sample-block-size", dest="sample_block_size", type="int",
+        help="number of samples to compute in a worker at a time. "
+        "If 0, the size is chosen automatically "
+        "[default=%default].")
+
     group.add_option(
         "--random-seed", dest='random_seed', type="int",
         help="random seed to initialize number generator "
         "with [%default].")
 
+    group.add_option(
+        "--random-number-generator", dest="random_number_generator",
+        type="choice",
+        choices=("xoshiro", "numpy"),
+        help="random number generator to use for sampling. "
+        "*xoshiro* - fast generator implemented in C, "
+        "*numpy* - numpy's global generator as used by previous "
+        "versions of gat. Samplers use random numbers in a different "
+        "order than previous versions, so previous results are not "
+        "reproduced for the annotator sampler. *numpy* can not be "
+        "used with the threads backend "
+        "[%default].")
+
     parser.add_option_group(group)
 
     group = OptionGroup(parser, "Workspace manipulation (experimental)")
@@ -392,7 +443,9 @@ def buildParser(usage=None):
         conditional_expansion=None,
         conditional_extension=None,
         counters=[],
+        distance_threshold=1000,
         enable_split_tracks=False,
+        free_gaps=False,
         ignore_segment_tracks=True,
         input_filename_counts=None,
         input_filename_descriptions=None,
@@ -409,13 +462,16 @@ def buildParser(usage=None):
         output_stats=[],
         output_tables_pattern="%s.tsv.gz",
         overlapping_annotations=False,
+        parallel_backend="processes",
         pseudo_count=1.0,
         pvalue_method="empirical",
         qvalue_lambda=None,
         qvalue_method="BH",
         qvalue_pi0_method="smoother",
+        random_number_generator="xoshiro",
         random_seed=None,
         restrict_workspace=False,
+        sample_block_size=0,
         sample_files=[],
         sampler="annotator",
         segment_files=[],
@@ -484,48 +540,191 @@ class DummyAnnotatorResult:
                           self.format_pvalue % self.qvalue))
 
 
+# largest number of samples computed by a worker at a time
+# if the block size is chosen automatically
+MAX_SAMPLE_BLOCK_SIZE = 1000
+
 WorkData = collections.namedtuple("WorkData",
-                                  "track sample_id sampler segments "
+                                  "track sample_ids sampler segments "
                                   "annotations contig_annotations "
                                   "workspace contig_workspace "
-                                  "counters ")
+                                  "counters annotation_index")
 
 
-def computeSample(args):
-    '''compute a single sample.
+def buildAnnotationIndex(annotations):
+    '''return an index for counting against all tracks in
+    *annotations* at once.
+
+    Returns None if the annotations can not be indexed.
+    '''
+    for segmentlist in annotations.getSegmentLists():
+        if not isinstance(segmentlist, SegmentList.SegmentList):
+            return None
+    return Engine.AnnotationIndex(annotations)
+
+
+def expandAliases(counts, tracks, aliases):
+    '''return a dictionary with the counts for each annotation
+    track in *tracks*.
+
+    *counts* contains the counts of the tracks that have been
+    counted, the counts of other tracks are taken from the track
+    they are an alias of (see :meth:`IntervalCollection.getAliases`).
+    '''
+    return collections.OrderedDict(
+        [(track, counts[aliases[track]]) for track in tracks])
+
+
+def buildCountsArray(shape, filename=None, mode="w+"):
+    '''return an array of zeros for the counts of the samples of a
+    track. *shape* is a tuple of the number of counters, annotations
+    and samples.
+
+    If *filename* is given, the array is mapped to this file with
+    *mode*, so that it can be filled by several processes.
+    '''
+    if filename is None or 0 in shape:
+        return numpy.zeros(shape, dtype=numpy.float64)
+    return numpy.memmap(filename, dtype=numpy.float64, mode=mode,
+                        shape=shape)
+
+
+def computeSampleBlock(workdata,
+                       counts,
+                       annotation=None,
+                       samples_outfile=None,
+                       metrics_outfile=None):
+    '''compute a block of samples.
+
+    Samples are computed for each sample id in the ``sample_ids`` of
+    *workdata*. The counts are stored in *counts*, an array with the
+    dimensions counters x annotations x samples (see
+    :func:`buildCountsArray`). If *annotation* is given, only the
+    counts for *annotation* are stored.
+
+    If the output files are given as directory names, the output of
+    the block is written to files of its own in these directories
+    (see :func:`getPartFilename`).
     '''
 
-    workdata, samples_outfile, metrics_outfile, lock = args
+    # files of parallel workers are merged later, see mergeParts
+    opened = []
+    if isinstance(samples_outfile, str):
+        samples_outfile = IOTools.openFile(
+            getPartFilename(samples_outfile,
+                            workdata.track,
+                            workdata.sample_ids), "w")
+        opened.append(samples_outfile)
+    if isinstance(metrics_outfile, str):
+        metrics_outfile = IOTools.openFile(
+            getPartFilename(metrics_outfile,
+                            workdata.track,
+                            workdata.sample_ids), "w")
+        opened.append(metrics_outfile)
+
+    tracks = list(workdata.annotations.tracks)
+    if annotation is not None:
+        columns = slice(tracks.index(annotation),
+                        tracks.index(annotation) + 1)
+        tracks = [annotation]
+    else:
+        columns = slice(None)
+
+    for sample_id in workdata.sample_ids:
+        counts_per_track = computeSample(workdata,
+                                         sample_id,
+                                         samples_outfile,
+                                         metrics_outfile)
+        for counter_id, r in enumerate(counts_per_track):
+            counts[counter_id, columns, sample_id] = [
+                r[track] for track in tracks]
+
+    for outfile in opened:
+        outfile.close()
+
+
+def getCountsFilename(dirname, track):
+    '''return the name of the file in *dirname* receiving the
+    counts of *track* (see :func:`buildCountsArray`).'''
+    return os.path.join(dirname, "%s.counts" %
+                        hashlib.md5(track.encode("utf-8")).hexdigest())
+
+
+def getPartFilename(dirname, stream, sample_ids):
+    '''return the name of the file in *dirname* receiving the output
+    of the block of samples *sample_ids* in random number
+    stream *stream*.'''
+    return os.path.join(dirname, "%s_%i.part" % (
+        hashlib.md5(stream.encode("utf-8")).hexdigest(),
+        sample_ids[0]))
+
+
+def buildPartDirectories(output_samples, output_metrics):
+    '''create a temporary directory for the output of parallel
+    workers.
+
+    returns the name of the directory and a dictionary with the
+    directories for ``samples`` and ``metrics``. The directories are
+    None if the output is not required.
+    '''
+    dirnames = {"samples": None, "metrics": None}
+    if not (output_samples or output_metrics):
+        return None, dirnames
+
+    tmpdir = tempfile.mkdtemp(prefix="gat_")
+    for section, required in (("samples", output_samples),
+                              ("metrics", output_metrics)):
+        if required:
+            dirnames[section] = os.path.join(tmpdir, section)
+            os.mkdir(dirnames[section])
+    return tmpdir, dirnames
+
+
+def mergeParts(outfile, dirname, blocks):
+    '''append the output of *blocks* from *dirname* to *outfile*.
+
+    *blocks* is a list of tuples of (stream, sample_ids), see
+    :func:`getPartFilename`. The files of the blocks are removed.
+    '''
+    for stream, sample_ids in blocks:
+        filename = getPartFilename(dirname, stream, sample_ids)
+        with IOTools.openFile(filename) as infile:
+            shutil.copyfileobj(infile, outfile)
+        os.unlink(filename)
+
+
+def computeSample(workdata, sample_id, samples_outfile, metrics_outfile):
+    '''compute a single sample.
+
+    The sample and its metrics are written to the files
+    *samples_outfile* and *metrics_outfile*, if given.
+    '''
 
     (track,
-     sample_id,
+     sample_ids,
      sampler,
      segs,
      annotations,
      contig_annotations,
      workspace,
      contig_workspace,
-     counters) = workdata
+     counters,
+     annotation_index) = workdata
 
     # E.debug("track=%s, sample=%s - started" % (track, str(sample_id)))
 
+    # use an independent random number stream for each sample, so
+    # that results do not depend on the order or process in which
+    # samples are computed.
+    sampler.getRandomNumberGenerator().seedStream(track, sample_id)
+
     counts = E.Counter()
 
     sample_id = str(sample_id)
 
-    outf_samples = samples_outfile
-
     if samples_outfile:
-        if lock:
-            lock.acquire()
-            outf_samples = IOTools.openFile(samples_outfile, "a")
-
         samples_outfile.write("track name=%s\n" % sample_id)
 
-        if lock:
-            outf_samples.close()
-            lock.release()
-
     sample = Engine.IntervalDictionary()
 
     for isochore in list(segs.keys()):
@@ -547,50 +746,298 @@ def computeSample(args):
 
         # save sample
         if samples_outfile:
-            if lock:
-                lock.acquire()
-                outf_samples = IOTools.openFile(samples_outfile, "a")
-
             for start, end in r:
-                outf_samples.write("%s\t%i\t%i\n" % (isochore, start, end))
-
-            if lock:
-                outf_samples.close()
-                lock.release()
+                samples_outfile.write("%s\t%i\t%i\n" % (isochore, start, end))
 
     # re-combine isochores
     # adjacent intervals are merged.
     sample.fromIsochores()
 
     if metrics_outfile:
-        if lock:
-            lock.acquire()
-            outf = IOTools.openFile(metrics_outfile, "a")
-        else:
-            outf = metrics_outfile
-
-        IO.outputMetrics(outf, sample, workspace, track, sample_id)
-
-        if lock:
-            outf.close()
-            lock.release()
+        IO.outputMetrics(metrics_outfile, sample, workspace, track, sample_id)
 
     counts_per_track = [collections.defaultdict(float) for x in counters]
-    # compute counts for each counter
+
+    # count all annotations for all supported counters
+    # in a single pass per contig
+    if annotation_index is not None:
+        indexed = [counter_id for counter_id, counter in enumerate(counters)
+                   if annotation_index.supports(counter)]
+    else:
+        indexed = []
+
+    if indexed:
+        values = [numpy.zeros(len(annotation_index.tracks), dtype=numpy.int64)
+                  for x in indexed]
+        for contig in list(sample.keys()):
+            contig_values = annotation_index.countMany(
+                [counters[x] for x in indexed],
+                sample[contig],
+                contig,
+                contig_workspace[contig])
+            values = [x + y for x, y in zip(values, contig_values)]
+        for counter_id, v in zip(indexed, values):
+            counts_per_track[counter_id].update(
+                zip(annotation_index.tracks, v.tolist()))
+
+    # compute counts for the remaining counters
     for counter_id, counter in enumerate(counters):
         # TODO: choose aggregator
+        if counter_id in indexed:
+            continue
+
         for annotation in annotations.tracks:
-            counts_per_track[counter_id][annotation] = sum([
-                counter(sample[contig],
-                        contig_annotations[annotation][contig],
-                        contig_workspace[contig])
-                for contig in list(sample.keys())])
+            counts_per_track[counter_id][annotation] = counter.countContigs(
+                sample,
+                contig_annotations[annotation],
+                contig_workspace,
+                list(sample.keys()))
 
     # E.debug("track=%s, sample=%s - completed" % (track,str(sample_id )))
 
     return counts_per_track
 
 
+# data of a worker process in a SamplingPool, see initializeWorker
+WORKER_DATA = {}
+
+
+def initializeWorker(manifests,
+                     sampler,
+                     workspace_generator,
+                     counters,
+                     num_samples,
+                     counts_dirname,
+                     samples_dirname,
+                     metrics_dirname):
+    '''set up a worker process of a :class:`SamplingPool`.
+
+    The worker attaches to the interval collections in shared memory
+    described by *manifests*, a dictionary of manifests (see
+    :meth:`Engine.IntervalContainer.getManifest`).
+
+    Counts are stored in the arrays of each track in
+    *counts_dirname* (see :meth:`SamplingPool.buildCounts`). If
+    given, samples and sample metrics are written to files in
+    *samples_dirname* and *metrics_dirname*, respectively.
+    '''
+    WORKER_DATA.clear()
+    for key, manifest in manifests.items():
+        WORKER_DATA[key] = Engine.attachIntervals(manifest)
+
+    WORKER_DATA.update({
+        "sampler": sampler,
+        "workspace_generator": workspace_generator,
+        "counters": counters,
+        "shape": (len(counters),
+                  len(WORKER_DATA["annotations"]),
+                  num_samples),
+        "counts_dirname": counts_dirname,
+        "counts": {},
+        "samples_dirname": samples_dirname,
+        "metrics_dirname": metrics_dirname,
+        "annotation_index": buildAnnotationIndex(
+            WORKER_DATA["contig_annotations"]),
+        "generated": None})
+
+
+def computeSampleTask(task):
+    '''compute a block of samples in a worker of a :class:`SamplingPool`.
+
+    *task* is a tuple of (track, annotation, sample_ids, stream).
+    Samples for *track* are computed in the workspace generated for
+    *annotation*. If *annotation* is None, the workspace is not
+    conditional on annotations. *stream* identifies the random
+    number stream of the samples.
+
+    returns the number of samples computed.
+    '''
+    track, annotation, sample_ids, stream = task
+    data = WORKER_DATA
+
+    # consecutive tasks usually work on the same generated workspace
+    generated = data["generated"]
+    if generated is None or generated[0] != (track, annotation):
+        # sampler set ups refer to the previous workspace
+        data["sampler"].clearCache()
+        if annotation is None:
+            annos = None
+        else:
+            annos = data["annotations"][annotation]
+        temp_segs, _, temp_workspace = data["workspace_generator"](
+            data["segments"][track], annos, data["workspace"])
+        generated = data["generated"] = ((track, annotation),
+                                         temp_segs,
+                                         temp_workspace)
+
+    workdata = WorkData(stream,
+                        sample_ids,
+                        data["sampler"],
+                        generated[1],
+                        data["annotations"],
+                        data["contig_annotations"],
+                        generated[2],
+                        data["contig_workspace"],
+                        data["counters"],
+                        data["annotation_index"])
+
+    counts = data["counts"].get(track)
+    if counts is None:
+        counts = data["counts"][track] = buildCountsArray(
+            data["shape"],
+            getCountsFilename(data["counts_dirname"], track),
+            mode="r+")
+
+    computeSampleBlock(workdata,
+                       counts,
+                       annotation,
+                       data["samples_dirname"],
+                       data["metrics_dirname"])
+
+    return len(sample_ids)
+
+
+class SamplingPool:
+    '''a persistent pool of worker processes for sampling.
+
+    The segments, annotations and workspace are moved to shared
+    memory once. Each worker attaches to the shared data when it is
+    started, so that tasks only need to name the samples to compute
+    (see :func:`computeSampleTask`). The same pool can be used for
+    all tracks.
+
+    Workers store counts directly in the array of a track shared by
+    all workers (see :meth:`buildCounts`). Workers write samples and
+    sample metrics to files of their own, which are merged with
+    :meth:`mergeOutput`.
+
+    Call :meth:`close` to stop the workers and to move the data
+    back to private memory.
+    '''
+
+    def __init__(self,
+                 num_threads,
+                 sampler,
+                 workspace_generator,
+                 counters,
+                 segments,
+                 annotations,
+                 workspace,
+                 num_samples,
+                 output_samples=False,
+                 output_metrics=False):
+
+        contig_annotations = annotations.clone()
+        contig_annotations.fromIsochores()
+        contig_annotations.setName("contig_" + annotations.getName())
+
+        contig_workspace = workspace.clone()
+        contig_workspace.fromIsochores()
+
+        self.shared = collections.OrderedDict((
+            ("segments", segments),
+            ("annotations", annotations),
+            ("workspace", workspace),
+            ("contig_annotations", contig_annotations),
+            ("contig_workspace", contig_workspace)))
+
+        E.info("setting up shared data for multi-processing")
+        manifests = {}
+        for key, container in self.shared.items():
+            container.share(key)
+            manifests[key] = container.getManifest()
+
+        self.tmpdir, self.dirnames = buildPartDirectories(
+            output_samples, output_metrics)
+
+        # counts are kept in memory backed files if possible
+        if os.path.isdir("/dev/shm"):
+            self.countsdir = tempfile.mkdtemp(prefix="gat_", dir="/dev/shm")
+        else:
+            self.countsdir = tempfile.mkdtemp(prefix="gat_")
+        self.shape = (len(counters), len(annotations), num_samples)
+
+        E.info("generating processpool with %i threads" % num_threads)
+        self.pool = multiprocessing.Pool(
+            num_threads,
+            initializer=initializeWorker,
+            initargs=(manifests,
+                      sampler,
+                      workspace_generator,
+                      counters,
+                      num_samples,
+                      self.countsdir,
+                      self.dirnames["samples"],
+                      self.dirnames["metrics"]))
+
+    def buildCounts(self, track):
+        '''return the array receiving the counts of *track* (see
+        :func:`buildCountsArray`).
+
+        The array is shared with the workers and needs to be built
+        before the tasks of *track* are computed. It remains valid
+        after the pool has been closed.
+        '''
+        return buildCountsArray(self.shape,
+                                getCountsFilename(self.countsdir, track))
+
+    def computeTasks(self, scheduled):
+        '''compute the tasks in *scheduled*, a list of tuples of
+        (cost, task).
+
+        Tasks are sent to the workers in order of decreasing cost,
+        so that the cheap tasks keep all workers busy at the end.
+        '''
+        order = sorted(list(range(len(scheduled))),
+                       key=lambda x: -scheduled[x][0])
+        n = sum([len(task[2]) for cost, task in scheduled])
+
+        E.info("computing %i samples in %i blocks" % (n, len(scheduled)))
+
+        done = 0
+        for r in self.pool.imap(computeSampleTask,
+                                [scheduled[x][1] for x in order]):
+            done += r
+            E.info("%i/%i done (%5.2f)" % (done, n, 100.0 * done / n))
+
+    def mergeOutput(self, section, outfile, scheduled):
+        '''append the output *section* (``samples`` or ``metrics``)
+        of the tasks in *scheduled* to *outfile*.'''
+        if self.dirnames[section] is None:
+            return
+        mergeParts(outfile,
+                   self.dirnames[section],
+                   [(task[3], task[2]) for cost, task in scheduled])
+
+    def close(self):
+        '''stop the workers and retrieve the shared data.'''
+        self.pool.close()
+        self.pool.join()
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir)
+        # arrays of counts stay mapped
+        shutil.rmtree(self.countsdir)
+
+        E.info("retrieving private data")
+        for container in self.shared.values():
+            container.unshare()
+
+
+def checkParallelBackend(sampler, num_threads, parallel_backend):
+    '''check if *sampler* can be used with *num_threads* workers
+    of *parallel_backend*.
+
+    Raises a ValueError if *sampler* uses numpy's global random
+    number generator in threads, as threads would share its state.
+    '''
+    if num_threads > 0 and parallel_backend == "threads" and \
+       isinstance(sampler.getRandomNumberGenerator(),
+                  Engine.NumpyRandomNumberGenerator):
+        raise ValueError(
+            "the numpy random number generator can not be used "
+            "with the threads backend")
+
+
 class UnconditionalSampler:
 
     def __init__(self,
@@ -601,7 +1048,10 @@ class UnconditionalSampler:
                  workspace_generator,
                  counters,
                  outfiles,
-                 num_threads=1):
+                 num_threads=1,
+                 parallel_backend="processes",
+                 sample_block_size=0,
+                 pool=None):
         self.num_samples = num_samples
         self.samples = samples
         self.samples_outfile = samples_outfile
@@ -618,9 +1068,35 @@ class UnconditionalSampler:
                 "sample\tisochore\tnsegments\tnnucleotides\tmean\t"
                 "std\tmin\tq1\tmedian\tq3\tmax\n")
 
+        if sampler is not None:
+            checkParallelBackend(sampler, num_threads, parallel_backend)
+
         self.last_sample_id = None
         self.all_lengths = []
         self.num_threads = num_threads
+        self.parallel_backend = parallel_backend
+        self.sample_block_size = sample_block_size
+        self.pool = pool
+
+    def usePool(self):
+        '''return True if samples are computed in a
+        :class:`SamplingPool` of worker processes.'''
+        return self.num_threads > 0 and self.parallel_backend == "processes"
+
+    def getSampleBlocks(self):
+        '''return the sample ids to compute as a list of blocks.
+
+        If no block size is given, the size is chosen such that each
+        worker receives several blocks.
+        '''
+        block_size = self.sample_block_size
+        if block_size <= 0:
+            block_size = max(1, min(
+                MAX_SAMPLE_BLOCK_SIZE,
+                self.num_samples // (4 * max(1, self.num_threads))))
+
+        return [range(x, min(x + block_size, self.num_samples))
+                for x in range(0, self.num_samples, block_size)]
 
     def outputSampleStats(self, sample_id, isochore, sample):
 
@@ -651,74 +1127,168 @@ class UnconditionalSampler:
             self.all_lengths.extend(l)
             _write(sample_id, isochore, numpy.sort(numpy.array(l)))
 
-    def computeSamples(self, work, report_interval=100):
-        '''compute samples according to work.
+    def buildCounts(self, annotations):
+        '''return an array receiving the counts of the samples
+        against *annotations* (see :func:`buildCountsArray`).'''
+        return buildCountsArray((len(self.counters),
+                                 len(annotations),
+                                 self.num_samples))
 
-        returns a list of results.
-        '''
-        n = len(work)
+    def computeSamples(self, work, counts, annotation=None):
+        '''compute samples according to work, a list of blocks
+        of samples, and store them in *counts* (see
+        :func:`computeSampleBlock`).
 
-        E.debug('sampling will work on %i items' % n)
+        Samples are computed serially or in a pool of threads.
+        '''
+        n = sum([len(w.sample_ids) for w in work])
 
-        results = []
+        E.debug('sampling will work on %i samples in %i blocks' %
+                (n, len(work)))
 
         if self.num_threads == 0:
-            for i, w in enumerate(work):
-                r = computeSample(
-                    (w, self.samples_outfile, self.outfile_sample_metrics,
-                     None))
-                if i % report_interval == 0:
-                    E.info("%i/%i done (%5.2f)" % (i, n, 100.0 * i / n))
-                results.append(r)
+            for x, w in enumerate(work):
+                computeSampleBlock(w,
+                                   counts,
+                                   annotation,
+                                   self.samples_outfile,
+                                   self.outfile_sample_metrics)
+                self.reportProgress(work[:x + 1], n)
         else:
-            E.info("generating processpool with %i threads for %i items" %
-                   (self.num_threads, len(work)))
+            self.computeSamplesInThreads(work, n, counts, annotation)
 
-            manager = multiprocessing.Manager()
+        # release set up cached for the segments in this work
+        self.sampler.clearCache()
 
-            lock = manager.Lock()
+    def computeSamplesInPool(self, scheduled, track, segs, annotations,
+                             workspace):
+        '''compute samples according to *scheduled* in a
+        :class:`SamplingPool` (see :meth:`buildTasks`).
 
-            pool = multiprocessing.Pool(self.num_threads)
+        If the sampler has not been given a pool, a pool is created
+        for *segs* of *track* and closed afterwards.
 
-            # use file names - not files when multiprocessing
-            samples_outfile, metrics_outfile = None, None
+        returns an array of counts (see :meth:`SamplingPool.buildCounts`).
+        '''
+        pool = self.pool
+        if pool is None:
+            segments = Engine.IntervalCollection("segments")
+            for contig, segmentlist in segs.items():
+                segments.add(track, contig, segmentlist)
+            pool = SamplingPool(self.num_threads,
+                                self.sampler,
+                                self.workspace_generator,
+                                self.counters,
+                                segments,
+                                annotations,
+                                workspace,
+                                self.num_samples,
+                                self.samples_outfile is not None,
+                                self.outfile_sample_metrics is not None)
+        try:
+            counts = pool.buildCounts(track)
+            pool.computeTasks(scheduled)
             if self.samples_outfile:
-                samples_outfile = self.samples_outfile.name
-                self.samples_outfile.flush()
+                pool.mergeOutput("samples", self.samples_outfile, scheduled)
             if self.outfile_sample_metrics:
-                metrics_outfile = self.outfile_sample_metrics.name
-                self.outfile_sample_metrics.flush()
+                pool.mergeOutput("metrics",
+                                 self.outfile_sample_metrics,
+                                 scheduled)
+        finally:
+            if pool is not self.pool:
+                pool.close()
+
+        return counts
+
+    def buildTasks(self, track, segs, annotations, workspace):
+        '''return the tasks to compute the samples of *track* in a
+        :class:`SamplingPool` (see :func:`computeSampleTask`).
+
+        returns a list of tuples of (cost, task). The cost is
+        estimated as the product of the workspace size, the number of
+        segments and the number of samples of a task. Returns None if
+        the workspace is empty.
+        '''
+        E.info("workspace without conditioning: %i segments, %i nucleotides" %
+               (workspace.counts(),
+                workspace.sum()))
 
-            ww = [(w, samples_outfile, metrics_outfile, lock) for w in work]
+        temp_segs, _, temp_workspace = self.workspace_generator(
+            segs, None, workspace)
 
-            for i, r in enumerate(pool.imap_unordered(computeSample, ww)):
-                if i % report_interval == 0:
-                    E.info("%i/%i done (%5.2f)" % (i, n, 100.0 * i / n))
-                results.append(r)
+        if workspace.sum() == 0:
+            E.warn("empty workspace - no computation performed")
+            return None
 
-            pool.close()
-            pool.join()
+        cost = temp_workspace.sum() * temp_segs.counts()
+        return [(cost * len(x), (track, None, x, track))
+                for x in self.getSampleBlocks()]
+
+    def reportProgress(self, work, n):
+        '''report the number of samples in *work* out of *n*.'''
+        done = sum([len(w.sample_ids) for w in work])
+        E.info("%i/%i done (%5.2f)" % (done, n, 100.0 * done / n))
 
-        return results
+    def computeSamplesInThreads(self, work, n, counts, annotation=None):
+        '''compute samples according to work in a pool of threads.
+
+        Threads use the data in *work* directly and store counts
+        in *counts*. Each thread uses its own copy of the sampler, as
+        samplers keep state between samples. Threads write samples
+        and sample metrics to files of their own, which are merged at
+        the end.
+        '''
+        E.info("generating threadpool with %i threads for %i samples "
+               "in %i blocks" % (self.num_threads, n, len(work)))
+
+        local = threading.local()
+
+        tmpdir, dirnames = buildPartDirectories(
+            self.samples_outfile is not None,
+            self.outfile_sample_metrics is not None)
+
+        def _computeSampleBlock(w):
+            if not hasattr(local, "sampler"):
+                local.sampler = pickle.loads(pickle.dumps(w.sampler))
+            computeSampleBlock(w._replace(sampler=local.sampler),
+                               counts,
+                               annotation,
+                               dirnames["samples"],
+                               dirnames["metrics"])
+            return w
+
+        done = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    self.num_threads) as executor:
+                for w in executor.map(_computeSampleBlock, work):
+                    done.append(w)
+                    self.reportProgress(done, n)
+
+            blocks = [(w.track, w.sample_ids) for w in work]
+            if self.samples_outfile:
+                mergeParts(self.samples_outfile, dirnames["samples"], blocks)
+            if self.outfile_sample_metrics:
+                mergeParts(self.outfile_sample_metrics,
+                           dirnames["metrics"],
+                           blocks)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir)
 
     def sample(self, track, counts, counters, segs,
                annotations, workspace,
                outfiles):
         '''sample and return counts.
 
-        Return a list of counted results for each counter.
+        Return an array of counts with the dimensions counters x
+        annotations x samples.
         '''
 
         E.info("performing unconditional sampling")
-        counts_per_track = [collections.defaultdict(list) for x in counters]
 
-        # rebuild non-isochore annotations and workspace
-        contig_annotations = annotations.clone()
-        contig_annotations.fromIsochores()
-        contig_annotations.setName("contig_" + annotations.getName())
-
-        contig_workspace = workspace.clone()
-        contig_workspace.fromIsochores()
+        if self.usePool():
+            return self.sampleInPool(track, segs, annotations, workspace)
 
         E.info("workspace without conditioning: %i segments, %i nucleotides" %
                (workspace.counts(),
@@ -735,6 +1305,16 @@ class UnconditionalSampler:
             E.warn("empty workspace - no computation performed")
             return None
 
+        # rebuild non-isochore annotations and workspace
+        contig_annotations = annotations.clone()
+        contig_annotations.fromIsochores()
+        contig_annotations.setName("contig_" + annotations.getName())
+
+        contig_workspace = workspace.clone()
+        contig_workspace.fromIsochores()
+
+        annotation_index = buildAnnotationIndex(contig_annotations)
+
         work = [WorkData(track,
                          x,
                          self.sampler,
@@ -744,38 +1324,35 @@ class UnconditionalSampler:
                          temp_workspace,
                          contig_workspace,
                          counters,
-                         ) for x in range(self.num_samples)]
+                         annotation_index,
+                         ) for x in self.getSampleBlocks()]
 
-        if self.num_threads > 0:
-            E.info("setting up shared data for multi-processing")
-            annotations.share()
-            contig_annotations.share()
-            contig_workspace.share("contig_workspace")
-            temp_segs.share("generated_segments")
-            temp_workspace.share("generated_workspace")
+        counts = self.buildCounts(annotations)
 
         E.info("sampling started")
-        results = self.computeSamples(work)
+        self.computeSamples(work, counts)
         E.info("sampling completed")
 
-        if self.num_threads > 0:
-            E.info("retrieving private data")
-            annotations.unshare()
-            contig_annotations.unshare()
-            contig_workspace.unshare()
-            temp_segs.unshare()
-            temp_workspace.unshare()
-
-        # collate results
-        for result in results:
-            for counter_id, counter in enumerate(counters):
-                for annotation in annotations.tracks:
-                    counts_per_track[counter_id][annotation].append(
-                        result[counter_id][annotation])
-
         self.outputSampleStats(None, "", [])
 
-        return counts_per_track
+        return counts
+
+    def sampleInPool(self, track, segs, annotations, workspace):
+        '''sample in a :class:`SamplingPool` and return counts.
+
+        Return an array of counts with the dimensions counters x
+        annotations x samples.
+        '''
+        scheduled = self.buildTasks(track, segs, annotations, workspace)
+        if scheduled is None:
+            return None
+
+        E.info("sampling started")
+        counts = self.computeSamplesInPool(
+            scheduled, track, segs, annotations, workspace)
+        E.info("sampling completed")
+
+        return counts
 
 
 class ConditionalSampler(UnconditionalSampler):
@@ -785,11 +1362,13 @@ class ConditionalSampler(UnconditionalSampler):
         '''conditional sampling - sample using only those
         segments that contain both a segment and an annotation.
 
-        return dictionary with counts per track
+        return an array of counts (see :meth:`UnconditionalSampler.sample`).
         '''
 
         E.info("performing conditional sampling")
-        counts_per_track = [collections.defaultdict(list) for x in counters]
+
+        if self.usePool():
+            return self.sampleInPool(track, segs, annotations, workspace)
 
         # rebuild non-isochore annotations and workspace
         contig_annotations = annotations.clone()
@@ -799,10 +1378,7 @@ class ConditionalSampler(UnconditionalSampler):
         contig_workspace = workspace.clone()
         contig_workspace.fromIsochores()
 
-        E.info("setting up shared data for multi-processing")
-        annotations.share()
-        contig_annotations.share()
-        contig_workspace.share("contig_workspace")
+        annotation_index = buildAnnotationIndex(contig_annotations)
 
         E.info("workspace without conditioning: %i segments, %i nucleotides" %
                (workspace.counts(),
@@ -812,6 +1388,8 @@ class ConditionalSampler(UnconditionalSampler):
             E.warn("empty workspace - no computation performed")
             return None
 
+        counts = self.buildCounts(annotations)
+
         # compute samples conditionally - need to proceed by annotation
         for annoid, annotation in enumerate(annotations.tracks):
 
@@ -820,16 +1398,12 @@ class ConditionalSampler(UnconditionalSampler):
             temp_segs, temp_annotations, temp_workspace = \
                 self.workspace_generator(segs, annos, workspace)
 
-            # set up sharing
-            temp_segs.share("generated_segments")
-            temp_workspace.share("generated_workspace")
-
             E.info("workspace for annotation %s: %i segments, %i nucleotides" %
                    (annotation,
                     temp_workspace.counts(),
                     temp_workspace.sum()))
 
-            work = [WorkData('_'.join((track, annoid)),
+            work = [WorkData("%s_%i" % (track, annoid),
                              x,
                              self.sampler,
                              temp_segs,
@@ -838,18 +1412,47 @@ class ConditionalSampler(UnconditionalSampler):
                              temp_workspace,
                              contig_workspace,
                              counters,
-                             ) for x in range(self.num_samples)]
+                             annotation_index,
+                             ) for x in self.getSampleBlocks()]
 
             E.info("sampling for annotation '%s' started" % annotation)
-            results = self.computeSamples(work)
+            self.computeSamples(work, counts, annotation)
             E.info("sampling for annotation '%s' completed" % annotation)
 
-            for result in results:
-                for counter_id, counter in enumerate(counters):
-                    counts_per_track[counter_id][annotation].append(
-                        result[counter_id][annotation])
+        return counts
 
-        return counts_per_track
+    def buildTasks(self, track, segs, annotations, workspace):
+        '''return the tasks to compute the samples of *track* in a
+        :class:`SamplingPool`, one set of tasks for each annotation
+        (see :meth:`UnconditionalSampler.buildTasks`).
+        '''
+        E.info("workspace without conditioning: %i segments, %i nucleotides" %
+               (workspace.counts(),
+                workspace.sum()))
+
+        if workspace.sum() == 0:
+            E.warn("empty workspace - no computation performed")
+            return None
+
+        scheduled = []
+        for annoid, annotation in enumerate(annotations.tracks):
+            temp_segs, temp_annotations, temp_workspace = \
+                self.workspace_generator(segs,
+                                         annotations[annotation],
+                                         workspace)
+
+            E.info("workspace for annotation %s: %i segments, %i nucleotides" %
+                   (annotation,
+                    temp_workspace.counts(),
+                    temp_workspace.sum()))
+
+            cost = temp_workspace.sum() * temp_segs.counts()
+            stream = "%s_%i" % (track, annoid)
+            scheduled.extend(
+                [(cost * len(x), (track, annotation, x, stream))
+                 for x in self.getSampleBlocks()])
+
+        return scheduled
 
 
 def run(segments,
@@ -893,6 +1496,16 @@ def run(segments,
 
     reference
        data with reference observed and expected values.
+
+    num_threads
+       number of workers for sampling. If 0, sample serially.
+
+    parallel_backend
+       run workers as ``processes`` or ``threads``.
+
+    sample_block_size
+       number of samples sent to a worker at a time. If 0, the
+       size is chosen automatically.
     '''
 
     # get arguments
@@ -905,6 +1518,10 @@ def run(segments,
     output_samples_pattern = kwargs.get("output_samples_pattern", None)
     outfiles = kwargs.get("outfiles", {})
     num_threads = kwargs.get("num_threads", 0)
+    parallel_backend = kwargs.get("parallel_backend", "processes")
+    sample_block_size = kwargs.get("sample_block_size", 0)
+
+    checkParallelBackend(sampler, num_threads, parallel_backend)
 
     ##################################################
     ##################################################
@@ -924,20 +1541,34 @@ def run(segments,
                              )
         E.info("wrote summary metrics for segments to %s" % str(outfile))
 
+    ##################################################
+    ##################################################
+    ##################################################
+    # count identical annotation tracks only once
+    aliases = annotations.getAliases()
+    counted_annotations = annotations.subset(
+        [x for x in annotations.tracks if aliases[x] == x])
+    if len(counted_annotations) < len(annotations):
+        E.info("%i annotation tracks are identical to other tracks "
+               "and will be counted once" %
+               (len(annotations) - len(counted_annotations)))
+
     ##################################################
     ##################################################
     ##################################################
     # collect observed counts from segments
     E.info("collecting observed counts")
-    observed_counts = []
-    for counter in counters:
-        observed_counts.append(Engine.computeCounts(
-            counter=counter,
-            aggregator=sum,
-            segments=segments,
-            annotations=annotations,
-            workspace=workspace,
-            workspace_generator=workspace_generator))
+    observed_counts = Engine.computeMultipleCounts(
+        counters=counters,
+        aggregator=sum,
+        segments=segments,
+        annotations=counted_annotations,
+        workspace=workspace,
+        workspace_generator=workspace_generator)
+    observed_counts = [
+        dict([(track, expandAliases(r, annotations.tracks, aliases))
+              for track, r in observed_count.items()])
+        for observed_count in observed_counts]
 
     ##################################################
     ##################################################
@@ -962,28 +1593,50 @@ def run(segments,
     else:
         samples = Engine.Samples()
 
+    # arrays of counts for each track, the counts of an annotation
+    # are in the column of the track it is an alias of
     sampled_counts = {}
+    columns = dict([(track, list(counted_annotations.tracks).index(
+        aliases[track])) for track in annotations.tracks])
 
     counts = E.Counter()
 
     ntracks = len(segments.tracks)
 
+    output_samples = bool(output_samples_pattern) and not sample_files
+
+    # re-use a single pool of worker processes for all tracks
+    if num_threads > 0 and parallel_backend == "processes" and ntracks > 0:
+        pool = SamplingPool(num_threads,
+                            sampler,
+                            workspace_generator,
+                            counters,
+                            segments,
+                            counted_annotations,
+                            workspace,
+                            num_samples,
+                            output_samples,
+                            "sample_metrics" in outfiles)
+    else:
+        pool = None
+
+    # tasks of all tracks for the pool and the range of tasks
+    # for each track
+    scheduled = []
+    scheduled_tracks = []
+
     for ntrack, track in enumerate(segments.tracks):
 
         segs = segments[track]
 
         E.info("sampling: %s: %i/%i" % (track, ntrack + 1, ntracks))
 
-        if output_samples_pattern and not sample_files:
+        # samples computed in the pool are saved after sampling
+        if output_samples and pool is None:
             filename = re.sub("%s", track, output_samples_pattern)
             E.debug("saving samples to %s" % filename)
-            dirname = os.path.dirname(filename)
-            if dirname and not os.path.exists(dirname):
-                os.makedirs(dirname)
-            if filename.endswith(".gz"):
-                samples_outfile = gzip.open(filename, "w")
-            else:
-                samples_outfile = open(filename, "w")
+            samples_outfile = IOTools.openFile(filename, "w",
+                                               create_dir=True)
         else:
             samples_outfile = None
 
@@ -995,7 +1648,10 @@ def run(segments,
                                                workspace_generator,
                                                counters,
                                                outfiles,
-                                               num_threads=num_threads)
+                                               num_threads=num_threads,
+                                               parallel_backend=parallel_backend,
+                                               sample_block_size=sample_block_size,
+                                               pool=pool)
         else:
             outer_sampler = UnconditionalSampler(num_samples,
                                                  samples,
@@ -1004,10 +1660,29 @@ def run(segments,
                                                  workspace_generator,
                                                  counters,
                                                  outfiles,
-                                                 num_threads=num_threads)
+                                                 num_threads=num_threads,
+                                                 parallel_backend=parallel_backend,
+                                                 sample_block_size=sample_block_size,
+                                                 pool=pool)
+
+        if pool is not None:
+            # schedule the samples of all tracks together, see below
+            track_tasks = outer_sampler.buildTasks(
+                track, segs, counted_annotations, workspace)
+
+            # skip empty tracks
+            if track_tasks is None:
+                continue
+
+            scheduled_tracks.append((track,
+                                     len(scheduled),
+                                     len(scheduled) + len(track_tasks)))
+            scheduled.extend(track_tasks)
+            continue
 
         counts_per_track = outer_sampler.sample(
-            track, counts, counters, segs, annotations, workspace, outfiles)
+            track, counts, counters, segs, counted_annotations, workspace,
+            outfiles)
 
         # skip empty tracks
         if counts_per_track is None:
@@ -1028,6 +1703,31 @@ def run(segments,
             # clean up samples
             del samples[track]
 
+    if pool is not None:
+        # compute the tasks of all tracks in a single pool, so that
+        # workers are not idle at the boundaries between tracks
+        try:
+            for track, first, last in scheduled_tracks:
+                sampled_counts[track] = pool.buildCounts(track)
+
+            pool.computeTasks(scheduled)
+
+            # save output of workers in the order of samples
+            for track, first, last in scheduled_tracks:
+                if output_samples:
+                    filename = re.sub("%s", track, output_samples_pattern)
+                    E.debug("saving samples to %s" % filename)
+                    with IOTools.openFile(filename, "w",
+                                          create_dir=True) as outfile:
+                        pool.mergeOutput("samples", outfile,
+                                         scheduled[first:last])
+            if "sample_metrics" in outfiles:
+                pool.mergeOutput("metrics",
+                                 outfiles["sample_metrics"],
+                                 scheduled)
+        finally:
+            pool.close()
+
     E.info("sampling finished")
 
     # build annotator results
@@ -1060,7 +1760,8 @@ def run(segments,
                     annotation=annotation,
                     counter=counter.name,
                     observed=observed,
-                    samples=sampled_counts[track][counter_id][annotation],
+                    samples=sampled_counts[track][
+                        counter_id, columns[annotation]],
                     track_segments=temp_segs,
                     annotation_segments=temp_annos,
                     workspace=temp_workspace,
@@ -137,10 +137,20 @@ def fromSegments(options, args):
     elif options.sampler == "global-permutation":
         sampler = Engine.SamplerGlobalPermutation()
     elif options.sampler == "brute-force":
-        sampler = Engine.SamplerBruteForce()
+        sampler = Engine.SamplerBruteForce(free_gaps=options.free_gaps)
     elif options.sampler == "uniform":
         sampler = Engine.SamplerUniform()
 
+    # initialize random number generator
+    if options.random_number_generator == "xoshiro":
+        rng = Engine.RandomNumberGenerator(seed=options.random_seed)
+    elif options.random_number_generator == "numpy":
+        rng = Engine.NumpyRandomNumberGenerator()
+    else:
+        raise ValueError("unknown random number generator '%s'" %
+                         options.random_number_generator)
+    sampler.setRandomNumberGenerator(rng)
+
     # initialize counter
     counters = []
     for counter in options.counters:
@@ -156,6 +166,13 @@ def fromSegments(options, args):
             counters.append(Engine.CounterSegmentMidpointOverlap())
         elif counter == "annotation-midoverlap":
             counters.append(Engine.CounterAnnotationMidpointOverlap())
+        elif counter == "distance-mean":
+            counters.append(Engine.CounterDistanceMean())
+        elif counter == "distance-median":
+            counters.append(Engine.CounterDistanceMedian())
+        elif counter == "distance-within":
+            counters.append(Engine.CounterDistanceWithin(
+                options.distance_threshold))
         else:
             raise ValueError("unknown counter '%s'" % counter)
 
@@ -215,7 +232,9 @@ def fromSegments(options, args):
         conditional_extension=options.conditional_extension,
         reference=options.reference,
         pseudo_count=options.pseudo_count,
-        num_threads=options.num_threads)
+        num_threads=options.num_threads,
+        parallel_backend=options.parallel_backend,
+        sample_block_size=options.sample_block_size)
 
     return annotator_results
 
@@ -0,0 +1,74 @@
+'''benchmark merge kernels in SegmentList with and without galloping.
+
+A list of *large* segments is merged with lists of decreasing size.
+For each size ratio, the time per call is reported for the linear
+merge and the galloping merge. The ratio at which galloping
+becomes faster determines GALLOP_RATIO in SegmentList.pyx.
+
+Usage::
+
+    python benchmark_SegmentList.py [large] [repeats]
+'''
+
+import sys
+import random
+import timeit
+
+from gat.SegmentList import SegmentList, setGallopRatio
+
+
+def randomSegments(nsegments, span, seed):
+    '''return a normalized list of *nsegments* random segments
+    within *span*.'''
+    rng = random.Random(seed)
+    starts = sorted(rng.sample(range(0, span, 10), nsegments))
+    return SegmentList(
+        iter=((x, x + rng.randint(1, 20)) for x in starts),
+        normalize=True)
+
+
+def inplace(method):
+    def _f(a, b):
+        c = a.clone()
+        getattr(c, method)(b)
+    return _f
+
+KERNELS = (
+    ("overlapWithSegments",
+     lambda a, b: a.overlapWithSegments(b)),
+    ("intersectionWithSegments",
+     lambda a, b: a.intersectionWithSegments(b)),
+    ("intersect", inplace("intersect")),
+    ("filter", inplace("filter")),
+    ("subtract", inplace("subtract")))
+
+
+def main(argv):
+
+    large = int(argv[1]) if len(argv) > 1 else 1000000
+    repeats = int(argv[2]) if len(argv) > 2 else 5
+    span = large * 100
+
+    big = randomSegments(large, span, 1)
+    ratios = (1, 2, 4, 8, 16, 32, 64, 256, 1024, 4096)
+    previous = setGallopRatio(0)
+
+    print("kernel\tratio\tlinear\tgallop\tspeedup")
+    for name, kernel in KERNELS:
+        for ratio in ratios:
+            small = randomSegments(large // ratio, span, 2)
+            times = []
+            for gallop_ratio in (2 ** 30, 0):
+                setGallopRatio(gallop_ratio)
+                times.append(min(timeit.repeat(
+                    lambda: kernel(big, small),
+                    number=1,
+                    repeat=repeats)))
+            print("%s\t%i\t%.6f\t%.6f\t%.2f" % (
+                name, ratio, times[0], times[1], times[0] / times[1]))
+
+    setGallopRatio(previous)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
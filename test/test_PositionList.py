@@ -126,5 +126,19 @@ class TestPositionList(GatTest):
             else:
                 self.assertEqual(0, len(pp))
 
+    def testIntersectSparse(self):
+        '''few segments and runs of positions are skipped.'''
+        positions = list(range(0, 100000, 7))
+        ss = SegmentList(iter=[(x, x + 30) for x in (5, 50000, 99990)],
+                         normalize=True)
+        expected = [x for x in positions
+                    if any(start <= x < end for start, end in ss)]
+
+        pp = PositionList(iter=positions, sort=True)
+        self.assertEqual(len(expected), pp.intersectionWithSegments(ss))
+        self.assertEqual(len(expected), pp.overlapWithSegments(ss))
+        pp.intersect(ss)
+        self.assertEqual(expected, pp.asList())
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,7 @@ import unittest
 import random
 import pickle
 
-from gat.SegmentList import SegmentList
+from gat.SegmentList import SegmentList, setGallopRatio
 
 
 class GatTest(unittest.TestCase):
@@ -483,6 +483,57 @@ class TestSegmentListSubtract(GatTest):
         a.subtract(b)
         self.assertEqual(a.asList(), [(10000, 12000)])
 
+    def testEmptySubtraction(self):
+        b = SegmentList(clone=self.a)
+        b.subtract(SegmentList())
+        self.assertEqual(b.asList(), self.a.asList())
+
+    def testRemainingSegments(self):
+        b = SegmentList(iter=[(0, 5), (900, 2000)], normalize=True)
+        self.a.subtract(b)
+        self.assertEqual(self.a.asList()[0], (5, 10))
+        self.assertEqual(len(self.a), 9)
+
+    def testSpanningSubtraction(self):
+        b = SegmentList(iter=[(5, 105), (250, 260)], normalize=True)
+        self.a.subtract(b)
+        self.assertEqual(self.a.asList()[:3], [(0, 5), (105, 110), (200, 210)])
+        self.assertEqual(len(self.a), 10)
+
+
+class TestSegmentListGalloping(GatTest):
+    '''galloping merges return the same results as linear merges.'''
+
+    def randomSegments(self, rng, nsegments):
+        starts = sorted(rng.sample(range(0, 100000, 5), nsegments))
+        return SegmentList(
+            iter=((x, x + rng.randint(1, 200)) for x in starts),
+            normalize=True)
+
+    def compute(self, a, b):
+        result = [a.overlapWithSegments(b),
+                  a.intersectionWithSegments(b),
+                  a.intersectionWithSegments(b, mode="midpoint")]
+        for method in ("intersect", "filter", "subtract"):
+            c = a.clone()
+            getattr(c, method)(b)
+            result.append(c.asList())
+        return result
+
+    def testGalloping(self):
+        rng = random.Random(1)
+        for x in range(50):
+            a = self.randomSegments(rng, rng.choice((0, 1, 10, 2000)))
+            b = self.randomSegments(rng, rng.choice((0, 1, 10, 2000)))
+            previous = setGallopRatio(2 ** 30)
+            try:
+                expected = self.compute(a, b) + self.compute(b, a)
+                setGallopRatio(0)
+                self.assertEqual(self.compute(a, b) + self.compute(b, a),
+                                 expected)
+            finally:
+                setGallopRatio(previous)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,13 +2,27 @@
 
 import unittest
 import os
+import pickle
+import concurrent.futures
+import io
 import numpy
 
 from gat.Engine import AnnotatorResult, IntervalCollection, \
     Samples, SamplesCached, computeFDR, \
-    SamplerAnnotator
+    SamplerAnnotator, SamplerSegments, EmpiricalLengthSampler, \
+    SamplerLocalPermutation, SamplerGlobalPermutation, SamplerShift, \
+    SegmentListSampler, WorkspaceCoverage, FreeGapIndex, \
+    RandomNumberGenerator, NumpyRandomNumberGenerator, \
+    AnnotationIndex, ElementaryIntervalIndex, PrefixSumIndex, \
+    CounterNucleotideOverlap, CounterNucleotideDensity, \
+    CounterSegmentOverlap, CounterSegmentMidpointOverlap, \
+    CounterAnnotationOverlap, CounterAnnotationMidpointOverlap, \
+    CounterFused, UnconditionalWorkspace, \
+    CounterDistanceMean, CounterDistanceMedian, CounterDistanceWithin, \
+    attachIntervals
 
 from gat.SegmentList import SegmentList
+import gat
 
 
 class GatTest(unittest.TestCase):
@@ -51,6 +65,43 @@ class TestIntervalCollection(GatTest):
         aa = self.a.clone()
         aa.share()
 
+    def testAttach(self):
+        '''attach to shared intervals through a manifest.'''
+        aa = self.a.clone()
+        aa.share("testAttach")
+        b = attachIntervals(pickle.loads(pickle.dumps(aa.getManifest())))
+        self.assertEqual(list(self.a.tracks), list(b.tracks))
+        for t in b.tracks:
+            for x in list(self.a[t].keys()):
+                self.assertEqual(self.a[t][x], b[t][x])
+        aa.unshare()
+        self.assertEqual(self.a.sum(), aa.sum())
+
+    def testAliases(self):
+        '''identical tracks are aliases of the first one.'''
+        aa = self.a.clone()
+        for contig, segmentlist in self.a["track1"].items():
+            aa.add("track3", contig, segmentlist.clone())
+        aa.add("track4", "contig1", self.a["track1"]["contig1"].clone())
+        aliases = aa.getAliases()
+        self.assertEqual(aliases, {"track1": "track1",
+                                   "track2": "track2",
+                                   "track3": "track1",
+                                   "track4": "track4"})
+        self.assertEqual(
+            list(aa.subset(["track2", "track4"]).tracks),
+            ["track2", "track4"])
+
+    def testAliasesPositions(self):
+        '''tracks of positions are aliases of themselves.'''
+        aa = self.a.clone()
+        for contig, segmentlist in self.a["track1"].items():
+            aa.add("track3", contig, segmentlist.clone())
+        aa.toPositions("midpoint")
+        self.assertEqual(aa.getAliases(), {"track1": "track1",
+                                           "track2": "track2",
+                                           "track3": "track3"})
+
 
 class TestToFromIsochores(GatTest):
 
@@ -128,6 +179,20 @@ class TestPValue(GatTest):
 
         self.assertEqual(result.pvalue, 0.57)
 
+    def testSamplesFromArray(self):
+        '''samples can be given as a row of an array of counts.'''
+        values = numpy.arange(100, dtype=numpy.float64)
+        counts = numpy.vstack([values[::-1], values])
+        result = AnnotatorResult(
+            "test", "test", "na", 60, counts[1], reference=None, pseudo_count=0)
+        expected = AnnotatorResult(
+            "test", "test", "na", 60, list(values), reference=None, pseudo_count=0)
+        del counts
+
+        self.assertEqual(result.pvalue, expected.pvalue)
+        self.assertEqual(result.expected, expected.expected)
+        self.assertEqual(list(result.samples), list(values))
+
 
 class TestSamples(GatTest):
 
@@ -230,6 +295,457 @@ class TestCaching(GatTest):
             os.remove("test.cache.idx")
 
 
+class TestRandomNumberGenerator(GatTest):
+
+    def testSeed(self):
+        a = RandomNumberGenerator(seed=1)
+        b = RandomNumberGenerator(seed=1)
+        self.assertEqual([a.randint(0, 100) for x in range(5000)],
+                         [b.randint(0, 100) for x in range(5000)])
+
+    def testRange(self):
+        rng = RandomNumberGenerator(seed=1)
+        values = [rng.randint(-5, 5) for x in range(10000)]
+        self.assertEqual(min(values), -5)
+        self.assertEqual(max(values), 4)
+        self.assertRaises(ValueError, rng.randint, 5, 5)
+        values = [rng.random() for x in range(10000)]
+        self.assertTrue(min(values) >= 0.0)
+        self.assertTrue(max(values) < 1.0)
+
+    def testPickling(self):
+        a = RandomNumberGenerator(seed=1)
+        a.randint(0, 100)
+        b = pickle.loads(pickle.dumps(a))
+        self.assertEqual([a.randint(0, 100) for x in range(5000)],
+                         [b.randint(0, 100) for x in range(5000)])
+
+    def testSeedStream(self):
+        for rng_type in (RandomNumberGenerator,
+                         NumpyRandomNumberGenerator):
+            a = rng_type(seed=1)
+            a.seedStream("track", 5)
+            first = [a.randint(0, 100) for x in range(100)]
+            # streams depend only on the key, not on prior draws
+            b = pickle.loads(pickle.dumps(rng_type(seed=1)))
+            b.randint(0, 100)
+            b.seedStream("track", 5)
+            self.assertEqual(first, [b.randint(0, 100) for x in range(100)])
+            a.seedStream("track", 6)
+            self.assertNotEqual(first,
+                                [a.randint(0, 100) for x in range(100)])
+
+    def testShuffle(self):
+        rng = RandomNumberGenerator(seed=1)
+        values = list(range(100))
+        rng.shuffle(values)
+        self.assertEqual(sorted(values), list(range(100)))
+        self.assertNotEqual(values, list(range(100)))
+
+    def testSamplerReproducible(self):
+        workspace = SegmentList(
+            iter=((x, x + 500) for x in range(0, 100000, 1000)),
+            normalize=True)
+        segments = SegmentList(
+            iter=((x, x + 50) for x in range(100, 90000, 5000)),
+            normalize=True)
+
+        for rng_type in (RandomNumberGenerator,
+                         NumpyRandomNumberGenerator):
+            samples = []
+            for x in range(2):
+                sampler = SamplerSegments()
+                sampler.setRandomNumberGenerator(rng_type(seed=1))
+                samples.append(sampler.sample(segments, workspace))
+            self.assertEqual(samples[0], samples[1])
+
+
+class TestEmpiricalLengthSampler(GatTest):
+
+    def testSample(self):
+        '''only observed lengths are sampled, including very long ones.'''
+        segments = SegmentList(
+            iter=((0, 10), (100, 150), (200, 10000000), (20000000, 20000010)),
+            normalize=True)
+        sampler = EmpiricalLengthSampler(segments, RandomNumberGenerator(seed=1))
+        self.assertEqual(len(sampler), 4)
+        values = [sampler.sample() for x in range(1000)]
+        self.assertEqual(set(values), set((10, 50, 10000000 - 200)))
+
+
+class TestSegmentListSampler(GatTest):
+
+    def testFragmentedWorkspace(self):
+        '''samples overlap the chosen workspace segment proportional
+        to its size.'''
+        workspace = SegmentList(
+            iter=((x, x + 1 + x % 7) for x in range(0, 100000, 10)),
+            normalize=True)
+        sampler = SegmentListSampler(workspace, RandomNumberGenerator(seed=1))
+        counts = numpy.zeros(7)
+        for x in range(20000):
+            start, end, overlap = sampler.sample(1)
+            self.assertEqual(end - start, 1)
+            self.assertTrue(overlap == 1)
+            self.assertTrue(workspace.overlapWithRange(start, end))
+            segment_start = start - start % 10
+            counts[segment_start % 7] += 1
+        fractions = counts / counts.sum()
+        expected = numpy.arange(1, 8) / 28.0
+        self.assertTrue(numpy.all(numpy.abs(fractions - expected) < 0.01))
+
+
+class TestWorkspaceCoverage(GatTest):
+
+    def testAddAndTrim(self):
+        '''coverage agrees with merging and intersecting.'''
+        workspace = SegmentList(
+            iter=((x, x + 70) for x in range(0, 10000, 100)),
+            normalize=True)
+        rng = numpy.random.RandomState(1)
+        coverage = WorkspaceCoverage(workspace, allocate=2)
+        segments = SegmentList()
+        for x in range(300):
+            start = rng.randint(0, 10000)
+            end = start + rng.randint(1, 200)
+            before = coverage.covered
+            gain = coverage.add(start, end)
+            self.assertEqual(gain, coverage.covered - before)
+            segments.add(start, end)
+            segments.merge(0)
+            self.assertEqual(coverage.asSegmentList(), segments)
+            intersection = segments.clone()
+            intersection.intersect(workspace)
+            self.assertEqual(coverage.covered, intersection.sum())
+            self.assertEqual(coverage.total, segments.sum())
+
+        before = coverage.covered
+        removed = coverage.trim_ends(segments[3][0], 500, 1)
+        self.assertEqual(removed, before - coverage.covered)
+        segments.trim_ends(segments[3][0], 500, 1)
+        segments.merge(0)
+        self.assertEqual(coverage.asSegmentList(), segments)
+        intersection = segments.clone()
+        intersection.intersect(workspace)
+        self.assertEqual(coverage.covered, intersection.sum())
+
+
+class TestFreeGapIndex(GatTest):
+
+    def testPlace(self):
+        '''placed segments fill the workspace without overlap.'''
+        workspace = SegmentList(
+            iter=((x, x + 10 + x % 13) for x in range(0, 1000, 50)),
+            normalize=True)
+        gaps = FreeGapIndex(workspace)
+        self.assertEqual(len(gaps), len(workspace))
+        rng = RandomNumberGenerator(seed=1)
+        placed = SegmentList()
+        for length in (5, 3, 1):
+            while gaps.weight(length) > 0:
+                # brute force count of valid positions
+                free = workspace.clone()
+                free.subtract(placed)
+                self.assertEqual(
+                    gaps.weight(length),
+                    sum([max(0, end - start - length + 1)
+                         for start, end in free]))
+                start = gaps.place(length, rng)
+                self.assertEqual(
+                    workspace.overlapWithRange(start, start + length), length)
+                self.assertEqual(
+                    placed.overlapWithRange(start, start + length), 0)
+                placed.add(start, start + length)
+                placed.normalize()
+        self.assertEqual(placed.sum(), workspace.sum())
+        self.assertEqual(len(gaps), 0)
+
+
+class TestPermutationSamplers(GatTest):
+
+    def testPermutation(self):
+        '''permutations keep the number of nucleotides and the
+        segments within the workspace.'''
+        workspace = SegmentList(
+            iter=((x, x + 900) for x in range(0, 100000, 1000)),
+            normalize=True)
+        segments = SegmentList(
+            iter=((x, x + 10 + x % 23) for x in range(100, 99000, 97)
+                  if x % 1000 < 850),
+            normalize=True)
+        for sampler in (SamplerLocalPermutation(), SamplerGlobalPermutation()):
+            sampler.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+            sample = sampler.sample(segments, workspace)
+            self.assertTrue(sample.isNormalized)
+            self.assertEqual(sample.sum(), segments.sum())
+            self.assertEqual(sample.overlapWithSegments(workspace),
+                             segments.sum())
+            self.assertNotEqual(sample, segments)
+
+    def testShift(self):
+        '''shifted segments stay within the workspace and keep their
+        size.'''
+        workspace = SegmentList(
+            iter=((x, x + 900) for x in range(0, 100000, 1000)),
+            normalize=True)
+        segments = SegmentList(
+            iter=((x, x + 10 + x % 23) for x in range(100, 99000, 997)
+                  if x % 1000 < 850),
+            normalize=True)
+        sampler = SamplerShift(radius=20)
+        sampler.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+        sample = sampler.sample(segments, workspace)
+        self.assertTrue(sample.isNormalized)
+        self.assertEqual(sample.sum(), segments.sum())
+        self.assertEqual(sample.overlapWithSegments(workspace),
+                         segments.sum())
+        self.assertNotEqual(sample, segments)
+
+    def testShiftWithoutRange(self):
+        '''segments without room to shift stay in place.'''
+        workspace = SegmentList(iter=[(0, 1000)], normalize=True)
+        segments = SegmentList(iter=[(100, 101), (500, 501)],
+                               normalize=True)
+        sampler = SamplerShift(radius=0.5)
+        sampler.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+        self.assertEqual(sampler.sample(segments, workspace), segments)
+
+
+class TestCountInThreads(GatTest):
+
+    def setUp(self):
+        self.workspace = SegmentList(
+            iter=((x, x + 900) for x in range(0, 100000, 1000)),
+            normalize=True)
+        self.segments = SegmentList(
+            iter=((x, x + 10 + x % 23) for x in range(100, 99000, 97)
+                  if x % 1000 < 850),
+            normalize=True)
+        self.annotations = SegmentList(
+            iter=((x, x + 50) for x in range(0, 100000, 333)),
+            normalize=True)
+
+    def testCountInThreads(self):
+        '''counters can be run from several threads.'''
+        sampler = SamplerGlobalPermutation()
+        sampler.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+        samples = [sampler.sample(self.segments, self.workspace)
+                   for x in range(20)]
+        counter = CounterSegmentOverlap()
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            counts = list(executor.map(
+                lambda x: counter(x, self.annotations),
+                samples))
+        self.assertEqual(counts,
+                         [counter(x, self.annotations) for x in samples])
+
+
+class TestAnnotationIndex(GatTest):
+
+    def testCount(self):
+        '''counts against all tracks are the same as counts
+        for each track separately.'''
+        annotations = IntervalCollection("test")
+        for track in range(10):
+            for contig in ("chr1", "chr2"):
+                annotations.add(
+                    "track%i" % track, contig,
+                    SegmentList(iter=((x, x + 10 * track + 5)
+                                      for x in range(track, 20000,
+                                                     (track + 1) * 97)),
+                                normalize=True))
+        segments = SegmentList(
+            iter=((x, x + 10 + x % 53) for x in range(100, 19000, 113)),
+            normalize=True)
+        workspace = SegmentList(iter=[(0, 20000)], normalize=True)
+
+        index = pickle.loads(pickle.dumps(AnnotationIndex(annotations)))
+        for counter in (CounterNucleotideOverlap(),
+                        CounterNucleotideDensity(),
+                        CounterSegmentOverlap(),
+                        CounterSegmentMidpointOverlap(),
+                        CounterAnnotationOverlap(),
+                        CounterAnnotationMidpointOverlap()):
+            self.assertTrue(index.supports(counter))
+            self.assertEqual(
+                list(index.count(counter, segments, "chr1", workspace)),
+                [counter(segments, annotations[track]["chr1"], workspace)
+                 for track in index.tracks])
+            self.assertEqual(
+                list(index.count(counter, segments, "chrX", workspace)),
+                [0] * len(index.tracks))
+
+    def testCountMany(self):
+        '''all counters are computed together in a fused sweep.'''
+        annotations = IntervalCollection("test")
+        for track in range(5):
+            annotations.add(
+                "track%i" % track, "chr1",
+                SegmentList(iter=((x, x + 10 * track + 5)
+                                  for x in range(track, 20000,
+                                                 (track + 1) * 97)),
+                            normalize=True))
+        segments = SegmentList(
+            iter=((x, x + 10 + x % 53) for x in range(100, 19000, 113)),
+            normalize=True)
+        workspace = SegmentList(iter=[(0, 20000)], normalize=True)
+        counters = [CounterNucleotideOverlap(),
+                    CounterNucleotideDensity(),
+                    CounterSegmentOverlap(),
+                    CounterSegmentMidpointOverlap(),
+                    CounterAnnotationOverlap(),
+                    CounterAnnotationMidpointOverlap()]
+
+        index = AnnotationIndex(annotations)
+        values = index.countMany(counters, segments, "chr1", workspace)
+        fused = pickle.loads(pickle.dumps(CounterFused(counters)))
+        for x, track in enumerate(index.tracks):
+            expected = [counter(segments, annotations[track]["chr1"],
+                                workspace)
+                        for counter in counters]
+            self.assertEqual([v[x] for v in values], expected)
+            self.assertEqual(
+                fused(segments, annotations[track]["chr1"], workspace),
+                expected)
+
+    def testElementaryIntervals(self):
+        '''elementary intervals are labelled by the set of
+        tracks covering them.'''
+        annotations = IntervalCollection("test")
+        for track, segments in (("a", [(0, 100), (200, 300)]),
+                                ("b", [(50, 150), (300, 400)]),
+                                ("c", [(0, 100)])):
+            annotations.add(track, "chr1",
+                            SegmentList(iter=segments, normalize=True))
+        index = ElementaryIntervalIndex(annotations)
+        # [0,50), [50,100), [100,150), [200,300), [300,400)
+        self.assertEqual(index.nintervals, 5)
+        # (a,c), (a,b,c), (b), (a)
+        self.assertEqual(index.nclasses, 4)
+
+        segments = SegmentList(iter=[(10, 60), (90, 210), (290, 310)],
+                               normalize=True)
+        counter = CounterNucleotideOverlap()
+        self.assertEqual(
+            list(index.count(counter, segments, "chr1")),
+            [counter(segments, annotations[track]["chr1"])
+             for track in index.tracks])
+        self.assertFalse(index.supports(CounterSegmentOverlap()))
+
+
+class TestDistanceCounters(GatTest):
+
+    def setUp(self):
+        self.segments = SegmentList(
+            iter=[(0, 10), (20, 30), (95, 105), (300, 310)],
+            normalize=True)
+        self.annotations = SegmentList(
+            iter=[(50, 100), (200, 250)],
+            normalize=True)
+
+    def testDistances(self):
+        '''distances are to the closest annotation on
+        either side.'''
+        counter = CounterDistanceMean()
+        self.assertEqual(
+            list(counter.distances(self.segments, self.annotations)),
+            [40, 20, 0, 50])
+        self.assertEqual(counter(self.segments, self.annotations), 27.5)
+        self.assertEqual(
+            CounterDistanceMedian()(self.segments, self.annotations), 30)
+        counter = pickle.loads(pickle.dumps(CounterDistanceWithin(40)))
+        self.assertEqual(counter(self.segments, self.annotations), 3)
+        self.assertEqual(counter(self.segments, SegmentList()), 0)
+
+    def testCountContigs(self):
+        '''distances are pooled across contigs.'''
+        segments = IntervalCollection("segments")
+        annotations = IntervalCollection("annotations")
+        for contig in ("chr1", "chr2"):
+            segments.add("segments", contig, self.segments.clone())
+            annotations.add("annotations", contig,
+                            self.annotations.clone())
+        segments.add("segments", "chr3", self.segments.clone())
+        counter = CounterDistanceMedian()
+        self.assertEqual(
+            counter.countContigs(segments["segments"],
+                                 annotations["annotations"],
+                                 None,
+                                 ["chr1", "chr2", "chr3"]),
+            30)
+
+
+class TestPrefixSumIndex(GatTest):
+
+    def setUp(self):
+        self.annotations = SegmentList(
+            iter=((x, x + 10 + x % 37) for x in range(0, 1000000, 97)),
+            normalize=True)
+        self.index = pickle.loads(pickle.dumps(
+            PrefixSumIndex(self.annotations)))
+
+    def testOverlap(self):
+        '''overlap is the same as with the segment list.'''
+        self.assertEqual(self.index.sum(), self.annotations.sum())
+        for start, end in ((0, 5), (3, 1000), (95, 97), (500, 500000),
+                           (999990, 2000000), (2000000, 3000000)):
+            self.assertEqual(self.index.overlapWithRange(start, end),
+                             self.annotations.overlapWithRange(start, end))
+
+        # few and many query segments
+        counter = CounterNucleotideOverlap()
+        for step in (100003, 1009, 13):
+            segments = SegmentList(
+                iter=((x, x + 7 + x % 11) for x in range(0, 1000000, step)),
+                normalize=True)
+            self.assertEqual(
+                self.index.overlapWithSegments(segments),
+                self.annotations.overlapWithSegments(segments))
+            self.assertEqual(
+                counter(segments, self.index),
+                counter(segments, self.annotations))
+
+    def testAnnotationIndex(self):
+        '''small samples are counted with prefix sums.'''
+        annotations = IntervalCollection("test")
+        annotations.add("a", "chr1", self.annotations)
+        annotations.add("b", "chr1", SegmentList(
+            iter=((x, x + 50) for x in range(0, 1000000, 1000)),
+            normalize=True))
+        index = AnnotationIndex(annotations)
+        segments = SegmentList(iter=[(100, 2000), (50000, 50100)],
+                               normalize=True)
+        counter = CounterNucleotideOverlap()
+        self.assertEqual(
+            list(index.count(counter, segments, "chr1")),
+            [counter(segments, annotations[track]["chr1"])
+             for track in index.tracks])
+
+
+class TestSamplerSetup(GatTest):
+
+    def testCachedSetup(self):
+        '''cached set up gives the same samples as a fresh one.'''
+        workspace = SegmentList(
+            iter=((x, x + 500) for x in range(0, 100000, 1000)),
+            normalize=True)
+        segments = SegmentList(
+            iter=((x, x + 50) for x in range(100, 90000, 5000)),
+            normalize=True)
+
+        cached = SamplerAnnotator()
+        cached.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+        for x in range(3):
+            cached.getRandomNumberGenerator().seedStream("track", x)
+            a = cached.sample(segments, workspace)
+            fresh = SamplerAnnotator()
+            fresh.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+            fresh.getRandomNumberGenerator().seedStream("track", x)
+            b = fresh.sample(segments, workspace)
+            self.assertEqual(a, b)
+        cached.clearCache()
+
+
 class TestStats(GatTest):
 
     ntracks = 10  # 17
@@ -318,5 +834,203 @@ class TestStats(GatTest):
         for r in results:
             self.assertTrue(r.qvalue > 0.5, "%f" % r.qvalue)
 
+
+class TestRun(GatTest):
+
+    def testAnnotationsToPoints(self):
+        '''run with annotations converted to points.'''
+        segments = IntervalCollection("segments")
+        segments.add("segments", "chr1",
+                     SegmentList(iter=((x, x + 50)
+                                       for x in range(0, 100000, 1000)),
+                                 normalize=True))
+        annotations = IntervalCollection("annotations")
+        for track in ("track1", "track2"):
+            annotations.add(track, "chr1",
+                            SegmentList(iter=((x, x + 200)
+                                              for x in range(0, 100000, 700)),
+                                        normalize=True))
+        annotations.toPositions("midpoint")
+        workspace = IntervalCollection("workspace")
+        workspace.add("collapsed", "chr1",
+                      SegmentList(iter=[(0, 100000)], normalize=True))
+
+        sampler = SamplerAnnotator()
+        sampler.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+        results = gat.run(segments,
+                          annotations,
+                          workspace["collapsed"],
+                          sampler,
+                          [CounterNucleotideOverlap()],
+                          UnconditionalWorkspace(),
+                          num_samples=10)
+        self.assertEqual(sorted([x.annotation for x in results]),
+                         ["track1", "track2"])
+        for result in results:
+            self.assertEqual(result.nsamples, 10)
+
+
+class TestParallelBackends(GatTest):
+
+    def setUp(self):
+        self.segments = IntervalCollection("segments")
+        self.segments.add("segments", "chr1",
+                          SegmentList(iter=((x, x + 50)
+                                            for x in range(0, 100000, 1000)),
+                                      normalize=True))
+        self.annotations = IntervalCollection("annotations")
+        for track in range(3):
+            self.annotations.add(
+                "track%i" % track, "chr1",
+                SegmentList(iter=((x, x + 200)
+                                  for x in range(track * 100,
+                                                 100000,
+                                                 (track + 1) * 700)),
+                            normalize=True))
+        self.workspace = IntervalCollection("workspace")
+        self.workspace.add("collapsed", "chr1",
+                           SegmentList(iter=[(0, 100000)], normalize=True))
+        self.counters = [CounterNucleotideOverlap(), CounterSegmentOverlap()]
+
+    def sample(self, num_threads=0, backend="processes", sample_block_size=0,
+               samples_outfile=None, rng_type=RandomNumberGenerator):
+        sampler = SamplerAnnotator()
+        sampler.setRandomNumberGenerator(rng_type(seed=1))
+        outer_sampler = gat.UnconditionalSampler(
+            20, None, samples_outfile, sampler,
+            UnconditionalWorkspace(), self.counters, {},
+            num_threads=num_threads,
+            parallel_backend=backend,
+            sample_block_size=sample_block_size)
+        return outer_sampler.sample(
+            "segments", None, self.counters, self.segments["segments"],
+            self.annotations, self.workspace["collapsed"], {})
+
+    def assertCountsEqual(self, a, b):
+        self.assertEqual(a.shape, b.shape)
+        self.assertTrue(numpy.array_equal(a, b))
+
+    def testCountsShape(self):
+        '''counts are returned as counters x annotations x samples.'''
+        counts = self.sample()
+        self.assertEqual(counts.shape, (2, 3, 20))
+        self.assertTrue(counts.any())
+
+    def testThreads(self):
+        '''sampling in threads returns the same counts as
+        serial sampling.'''
+        self.assertCountsEqual(self.sample(0, "processes"),
+                               self.sample(3, "threads"))
+
+    def testProcesses(self):
+        '''sampling in a pool of processes returns the same counts as
+        serial sampling.'''
+        self.assertCountsEqual(self.sample(0, "processes"),
+                               self.sample(2, "processes"))
+
+    def testNumpyGenerator(self):
+        '''samples drawn with numpy's generator do not depend on
+        the number of workers or the size of sample blocks.'''
+        expected = self.sample(rng_type=NumpyRandomNumberGenerator)
+        self.assertCountsEqual(
+            expected, self.sample(2, "processes", sample_block_size=3,
+                                  rng_type=NumpyRandomNumberGenerator))
+        self.assertCountsEqual(
+            expected, self.sample(sample_block_size=7,
+                                  rng_type=NumpyRandomNumberGenerator))
+
+    def testNumpyGeneratorInThreads(self):
+        '''numpy's generator can not be shared between threads.'''
+        self.assertRaises(ValueError, self.sample, 3, "threads",
+                          rng_type=NumpyRandomNumberGenerator)
+        sampler = SamplerAnnotator()
+        sampler.setRandomNumberGenerator(NumpyRandomNumberGenerator(seed=1))
+        self.assertRaises(ValueError, gat.run,
+                          self.segments, self.annotations,
+                          self.workspace["collapsed"], sampler,
+                          self.counters, UnconditionalWorkspace(),
+                          num_threads=2, parallel_backend="threads")
+
+    def testSamplesOutput(self):
+        '''samples written by workers are saved in the order
+        of samples.'''
+        outputs = []
+        for num_threads, backend in ((0, "processes"),
+                                     (3, "threads"),
+                                     (2, "processes")):
+            outfile = io.StringIO()
+            self.sample(num_threads, backend, sample_block_size=3,
+                        samples_outfile=outfile)
+            outputs.append(outfile.getvalue())
+        self.assertEqual(
+            ["track name=%i" % x for x in range(20)],
+            [x for x in outputs[0].splitlines() if x.startswith("track")])
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+    def testSharedPool(self):
+        '''tasks of several tracks computed in a single pool return
+        the same counts as serial sampling.'''
+        segments = IntervalCollection("segments")
+        for track in ("segments", "shifted"):
+            for contig, segmentlist in self.segments["segments"].items():
+                segmentlist = segmentlist.clone()
+                if track == "shifted":
+                    segmentlist.shift(300)
+                segments.add(track, contig, segmentlist)
+
+        expected = {}
+        for track in segments.tracks:
+            sampler = SamplerAnnotator()
+            sampler.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+            outer_sampler = gat.UnconditionalSampler(
+                20, None, None, sampler,
+                UnconditionalWorkspace(), self.counters, {},
+                num_threads=0)
+            expected[track] = outer_sampler.sample(
+                track, None, self.counters, segments[track],
+                self.annotations, self.workspace["collapsed"], {})
+
+        sampler = SamplerAnnotator()
+        sampler.setRandomNumberGenerator(RandomNumberGenerator(seed=1))
+        pool = gat.SamplingPool(2, sampler, UnconditionalWorkspace(),
+                                self.counters, segments,
+                                self.annotations,
+                                self.workspace["collapsed"],
+                                20)
+        outer_sampler = gat.UnconditionalSampler(
+            20, None, None, sampler,
+            UnconditionalWorkspace(), self.counters, {},
+            num_threads=2, pool=pool)
+        scheduled = []
+        for track in segments.tracks:
+            scheduled.extend(outer_sampler.buildTasks(
+                track, segments[track], self.annotations,
+                self.workspace["collapsed"]))
+        counts = dict([(track, pool.buildCounts(track))
+                       for track in segments.tracks])
+        pool.computeTasks(scheduled)
+        pool.close()
+
+        for track in segments.tracks:
+            self.assertCountsEqual(expected[track], counts[track])
+
+    def testSampleBlocks(self):
+        '''counts do not depend on the size of sample blocks.'''
+        expected = self.sample(sample_block_size=1)
+        for sample_block_size in (0, 3, 20, 100):
+            self.assertCountsEqual(
+                expected, self.sample(sample_block_size=sample_block_size))
+        self.assertCountsEqual(expected,
+                               self.sample(3, "threads", sample_block_size=7))
+
+    def testGetSampleBlocks(self):
+        sampler = gat.UnconditionalSampler(
+            10, None, None, None, None, self.counters, {},
+            sample_block_size=4)
+        self.assertEqual([list(x) for x in sampler.getSampleBlocks()],
+                         [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+
 if __name__ == '__main__':
     unittest.main()
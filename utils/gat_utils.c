@@ -111,3 +111,49 @@ int fromCompressedFile( unsigned char * buffer, size_t uncompressed_size, FILE *
   free(compressed);
   return zok;
 }
+
+static inline uint64_t rotl(const uint64_t x, int k)
+{
+  return (x << k) | (x >> (64 - k));
+}
+
+// seed xoshiro256** state from a single 64-bit seed using splitmix64
+// as recommended by the authors of xoshiro.
+void xoshiro256_seed(xoshiro256_state * state, uint64_t seed)
+{
+  int i;
+  uint64_t z;
+  for (i = 0; i < 4; ++i)
+    {
+      seed += 0x9e3779b97f4a7c15ULL;
+      z = seed;
+      z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+      z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+      state->s[i] = z ^ (z >> 31);
+    }
+}
+
+uint64_t xoshiro256_next(xoshiro256_state * state)
+{
+  uint64_t * s = state->s;
+  const uint64_t result = rotl(s[1] * 5, 7) * 9;
+  const uint64_t t = s[1] << 17;
+
+  s[2] ^= s[0];
+  s[3] ^= s[1];
+  s[1] ^= s[2];
+  s[0] ^= s[3];
+
+  s[2] ^= t;
+
+  s[3] = rotl(s[3], 45);
+
+  return result;
+}
+
+void xoshiro256_fill(xoshiro256_state * state, uint64_t * buffer, size_t n)
+{
+  size_t i;
+  for (i = 0; i < n; ++i)
+    buffer[i] = xoshiro256_next(state);
+}
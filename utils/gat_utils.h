@@ -3,6 +3,7 @@
 
 #include <stdlib.h>
 #include <stdio.h>
+#include <stdint.h>
 
 // use bisection to return the index of the first element i in base
 // such that base[i] <= target. When there is no such index, return
@@ -24,5 +25,19 @@ int toCompressedFile( const unsigned char *, size_t, FILE *);
 
 int fromCompressedFile( unsigned char *, size_t, FILE *);
 
+// xoshiro256** pseudo random number generator, see
+// http://prng.di.unimi.it/. The state is seeded with splitmix64.
+typedef struct
+{
+  uint64_t s[4];
+} xoshiro256_state;
+
+void xoshiro256_seed(xoshiro256_state *, uint64_t);
+
+uint64_t xoshiro256_next(xoshiro256_state *);
+
+// fill *buffer* with *n* random numbers
+void xoshiro256_fill(xoshiro256_state *, uint64_t *, size_t);
+
 #endif
 		   